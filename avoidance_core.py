@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from scan_lib import RangeMinimumTable, TimeToCollisionMap, getScanGeometry, decimateScan
+from occupancy_grid import RollingOccupancyGrid
+from mode_manager import AvoidanceHysteresis
+from clock import WallClock
+from latency_monitor import LatencyMonitor
+import fuzzy_cbr
+import cbr
+
+
+# LaserScan fields the core reads, so recordings can be replayed without the ROS message types
+ScanData = namedtuple("ScanData", ["ranges", "angle_min", "angle_increment"])
+
+# Result of one planning cycle. command is True when a new velocity must be sent to the vehicle
+AvoidanceDecision = namedtuple("AvoidanceDecision", ["avoiding", "command", "v", "w", "scenario", "case"])
+
+
+class AvoidanceCore:
+    """Perception, DWA, fuzzy weighting and CBR, without any ROS dependency.
+
+    The ROS node feeds it with odometry and scans and turns its decisions into mode changes and setpoints. The offline
+    replay feeds it with recorded data instead.
+    """
+
+    ############################################################################
+    # region CONSTRUCTOR
+    ############################################################################
+    def __init__(self, case_base=None, log_info: Callable[[str], None] = print, clock=None) -> None:
+        """
+        Args:
+            case_base (cases.CaseDatabase): case base used by CBR, by default the casos.db file
+            log_info (Callable[[str], None]): information logger
+            clock (WallClock or SimClock): time source shared with CBR, by default the system clock
+        """
+        self.log_info = log_info
+        self.clock = clock if clock is not None else WallClock()
+        self.scan_stamp = 0.0  # [s] stamp of the scan being planned
+        self.last_command_time = 0.0  # [s] when the last velocity command was decided
+        self.latency = LatencyMonitor(window=500, enabled=False)  # Computing time of each stage of the planning cycle
+
+        # Parameters from obstacle avoidance algorithm
+        self.dt = 0.17  # Time step [s], DWA prediction horizon and minimum time between commands
+        self.odometry_dt = None  # [s] time between the last two odometry messages
+        self.previous_odometry_time = None  # [s] stamp of the last odometry
+        self.closest_obstacle_distance = 0
+        self.obstacle_angle = 0  # [RAD] angle of the closest obstacle in relation to the robot
+        self.x = 0  # Actual x position from odometry
+        self.y = 0  # Actual y position from odometry
+        self.theta = 0  # Actual orientation from odometry
+        self.v = 0  # Actual linear velocity from odometry
+        self.w = 0  # Actual angular velocity from odometry
+        self.max_v = 2.55  # Maximum linear velocity 2.55
+        self.max_w = np.pi  # Maximum angular velocity np.pi/2
+        self.best_v = None  # Best linear velocity
+        self.best_w = None  # Best angular velocity
+        self.min_v = 0.0  # Minimum linear velocity
+        self.max_acc_v = 0.9 #0.5  # Maximum linear acceleration 0.5
+        self.max_acc_w = np.pi/2  # Maximum angular acceleration
+        self.safety_distance_to_start = 6.0  # [meters] 5
+        self.safety_distance_wide_fov = 2.5  # [meters] obstacle distance to keep avoiding in the wide field of view
+        self.exit_distance_narrow_fov = 7.0  # [meters] free distance needed in the narrow field of view to go back to AUTO
+        self.exit_distance_wide_fov = 3.0  # [meters] free distance needed in the wide field of view to go back to AUTO
+        # The dwell times are measured in scan time, so a replay gives the same decisions as the live run
+        self.avoidance_hysteresis = AvoidanceHysteresis(min_avoid_dwell=1.0, min_free_dwell=0.3, clock=lambda: self.scan_stamp)
+        self.valid_ranges = None  # Lidar valid ranges
+        self.range_min_table = None  # Range-minimum index over the valid ranges, rebuilt every scan
+        self.dwa_clearance_half_width = 0  # Beams on each side of the DWA direction considered for clearance
+        self.occupancy_grid = RollingOccupancyGrid(size=200, resolution=0.1)  # Obstacles remembered around the robot
+        self.ttc_map = TimeToCollisionMap()  # Per-beam time to collision and obstacle approach speed, updated every scan
+        self.ttc_table = None  # Range-minimum index over the time to collision, rebuilt every scan
+        self.min_time_to_collision = 2.0  # [s] start avoiding right away if something ahead is closer than this in time
+
+        self.v_reso = 12  # Linear velocity resolution 25
+        self.w_reso = 12  # Angular velocity resolution 25
+
+        self.alpha = 0  # Robot alignment to the objective
+        self.beta = 0  # Distance to the obstacle
+        self.gamma = 0  # Foward speed
+
+        self.scan_geometry = None  # Beam angles and cos/sin tables, taken from the incoming LaserScan metadata
+        self.max_scan_beams = 640  # Scans with more beams are min-pooled down to this count before processing
+        self.narrow_fov = np.radians(60)  # [RAD] field of view to start the avoidance behavior
+        self.wide_fov = np.radians(180)  # [RAD] field of view to keep avoiding and to finish the avoidance
+        self.goal_angle = 0  # [degrees] goal direction in baselink frame
+
+        # CBR parameters
+        self.cbr = cbr.CBR(case_base=case_base, clock=self.clock)
+        self.scenario = None
+        # Scenario classification runs on this pool while DWA runs on the planner thread, None to run them in sequence
+        self.scenario_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scenario")
+
+        # Fuzzy parameters
+        self.fuzzy = fuzzy_cbr.Fuzzy()
+
+    # endregion
+    ############################################################################
+    # region STATE UPDATES
+    ############################################################################
+
+    def updateOdometry(self, x: float, y: float, theta: float, v: float, w: float, stamp: float) -> None:
+        """Update robot position, orientation and velocities.
+
+        Args:
+            x (float): x position in odometry frame [m]
+            y (float): y position in odometry frame [m]
+            theta (float): yaw in odometry frame [RAD]
+            v (float): linear velocity [m/s]
+            w (float): angular velocity [RAD/s]
+            stamp (float): odometry time [s]
+        """
+        self.x, self.y, self.theta = x, y, theta
+        self.v, self.w = v, w
+
+        # Measured apart from the planner time step, so the odometry rate does not change the DWA horizon
+        if self.previous_odometry_time is not None:
+            self.odometry_dt = stamp - self.previous_odometry_time
+        self.previous_odometry_time = stamp
+
+    # endregion
+    ############################################################################
+    # region AVOIDANCE METHODS
+    ############################################################################
+
+    def dynamicWindow(self):
+        """Calculate dynamic window obtaining the possible velocities for the next interval of time. 
+
+        Returns:
+            min_v (float): minimal linear velocity,
+            max_v (float): maximal linear velocity,
+            min_w (float): minimal angular velocity,
+            max_w (float): maximal angular velocity."""
+
+        # Calculate dynamic window
+        min_v = max(self.min_v, self.v - self.max_acc_v * self.dt) # The second part simulates the maximum deceleration
+        max_v = min(self.max_v, self.v + self.max_acc_v * self.dt) # The second part simulates the maximum acceleration
+        min_w = max(-self.max_w, self.w - self.max_acc_w * self.dt)
+        max_w = min(self.max_w, self.w + self.max_acc_w * self.dt)
+
+        return min_v, max_v, min_w, max_w
+
+    def dynamicWindowSafetyStop(self, dist_obst, w, approach_speed=0.0):
+        """
+        Calculate dynamic window to ensure that the robot can stop in time to avoid a collision.
+        Based on dynamic restriction. Works element-wise when the arguments are arrays.
+
+        Args:
+            dist_obst (float): distance to the closest obstacle.
+            w (float): angular velocity.
+            approach_speed (float): speed the obstacle itself moves towards the robot, from the time-to-collision map.
+        Returns:
+            safe_v_max (float): maximal linear velocity to stop in time,
+            safe_w_max (float): maximal angular velocity to stop in time."""
+
+        # While the robot brakes, the obstacle keeps closing in: v**2 / (2*a) + approach_speed * v / a <= dist_obst
+        # Receding obstacles are not trusted to keep going away
+        approach_speed = np.maximum(approach_speed, 0.0)
+        safe_v_max = np.minimum(
+            np.sqrt(approach_speed**2 + 2 * dist_obst * self.max_acc_v) - approach_speed, self.max_v)
+        safe_w_max = np.sign(w) * np.sqrt(2 * dist_obst * self.max_acc_w)
+
+        # Guarantees that the velocities are within the robot limits
+        safe_w_max = np.clip(safe_w_max, -self.max_w, self.max_w)
+
+        return safe_v_max, safe_w_max
+
+    def getFovIndexFromTheta(self, theta):
+        """
+        Convert an angle (theta) in relation to the global frame to the Lidar index.
+
+        Args:
+            theta: the angle in relation to the global frame (in radians).
+
+        Returns:
+            The corresponding index in the Lidar field of view.
+        """
+        # The geometry already guarantees that the index is within the array limits
+        return self.scan_geometry.angleToIndex(theta)
+
+    def objectiveFunction(self, min_v, max_v, min_w, max_w):
+        """Objective function to be maximazed.
+        Args:
+            min_v (float): minimal linear velocity,
+            max_v (float): maximal linear velocity,
+            min_w (float): minimal angular velocity,
+            max_w (float): maximal angular velocity.
+        Returns:
+            best_v (float): best linear velocity,
+            best_w (float): best angular velocity."""
+
+        max_cost = -float('inf')  # Initialize cost with negative infinity
+        best_v, best_w = 0, 0
+
+        if np.isinf(self.closest_obstacle_distance):
+            dist_obst = 1000
+        else:
+            dist_obst = self.closest_obstacle_distance
+
+        # Change angle from rad to degree just for the fuzzy logic
+        obstacle_angle = np.degrees(self.obstacle_angle)
+
+        # Apply fuzzy logic to discover alpha, beta and gamma
+        with self.latency.span("fuzzy"):
+            self.alpha, self.beta, self.gamma = self.fuzzy.IsolatedObstacle(obstacle_angle, dist_obst)
+
+        # The clearance only depends on w, so look it up once per angular velocity in the range-minimum table
+        w_samples = np.linspace(min_w, max_w, num=self.w_reso)
+        fov_indices = self.scan_geometry.angleToIndex(w_samples * self.dt)
+        clearances, clearance_beams = self.range_min_table.queryBatch(
+            fov_indices - self.dwa_clearance_half_width, fov_indices + self.dwa_clearance_half_width + 1)
+
+        # Speed the closest obstacle in each direction moves towards the robot, from the time-to-collision map
+        approach_speeds = self.ttc_map.approach_speed[clearance_beams]
+
+        # Obstacles remembered in the occupancy grid also limit the clearance, even if the current scan missed them
+        if self.occupancy_grid is not None:
+            grid_clearances = self.occupancy_grid.rayClearance(self.x, self.y, self.theta + w_samples * self.dt)
+            clearances = np.minimum(clearances, grid_clearances)
+
+        # Safety stop bounds for every direction at once, directions with no obstacle are not checked
+        safe_v_maxs, safe_w_maxs = self.dynamicWindowSafetyStop(
+            np.where(np.isinf(clearances), 0.0, clearances), w_samples, approach_speeds)
+
+        for v in np.linspace(min_v, max_v, num=self.v_reso):
+            for w, clearance, safe_v_max, safe_w_max in zip(w_samples, clearances, safe_v_maxs, safe_w_maxs):
+
+                # Preview the new robot orientation (theta) after applying w
+                theta_real = w * self.dt # Robot body frame
+                theta_next = self.theta + theta_real # Robot global frame
+
+                # Obtain the distance to the obstacle in that direction
+                dist_obst = clearance
+
+                # If no obstacle is on the curvature, this value is set to a large constant
+                if np.isinf(dist_obst):
+                    dist_obst = self.safety_distance_to_start #1000
+
+                else:
+                    if safe_w_max > 0 and w > 0:
+
+                        if safe_v_max < v or safe_w_max < w:
+                            continue
+                    else:
+                        if safe_v_max < v or safe_w_max > w:
+                            continue
+
+                cost = self.alpha * \
+                    self.headingCost(theta_next) + self.beta * \
+                    dist_obst + self.gamma * v
+
+                if cost > max_cost:
+
+                    max_cost = cost
+                    best_v, best_w = v, w
+
+        return best_v, best_w
+
+    def headingCost(self, theta_next):
+        """Evaluate the alignment of the robot with the goal.
+
+        Args:
+            v (float): linear velocity,
+            w (float): angular velocity.
+        Returns:
+            angle (float): angle between the robot heading and the goal angle."""
+        
+        # Calculate the goal angle in the global frame
+        goal_angle_global = np.deg2rad(self.goal_angle)
+
+        # Diference between test angle and heading
+        angle_diff = theta_next - goal_angle_global
+
+        # This is necessary to find the smallest angle
+        angle_diff = angle_diff % (2 * np.pi)
+        if angle_diff > np.pi:
+            angle_diff -= 2 * np.pi
+
+        angle = np.abs(angle_diff)
+        angle = np.pi - angle
+
+        return angle
+
+    def replanVelocity(self):
+        """Method to plan dynamic route.
+
+        Returns:
+            best_v (float): best linear velocity,
+            best_w (float): best angular velocity."""
+
+        min_v, max_v, min_w, max_w = self.dynamicWindow()
+
+        best_v, best_w = self.objectiveFunction(min_v, max_v, min_w, max_w)
+
+        best_v = min(best_v, self.max_v)
+        best_w = np.clip(best_w, -self.max_w, self.max_w)
+
+        return best_v, best_w
+
+    def closestObstacleInCentralFov(self, fov_positions=160, center_index=None):
+        """
+        Return the distance of the closest obstacle in the robot's central field of view (degrees)
+        and its angle relative to the LIDAR.
+
+        Args:
+            fov_positions: Number of positions in the central field of view.
+            center_index: Central index of the Lidar readings list, by default the beam pointing forward.
+
+        Returns:
+            Distance of the closest obstacle in the central field of view, or float('inf') if no obstacles are detected.
+        """
+        if center_index is None:
+            center_index = self.scan_geometry.angleToIndex(0.0)
+
+
+        # New index for the angle range considered
+        half_fov = fov_positions // 2
+        start_index = center_index - half_fov
+        end_index = center_index + half_fov
+
+        # Closest reading within the central field of view, from the range-minimum table built for this scan
+        min_distance, min_index = self.range_min_table.query(start_index, end_index)
+
+        # Calculate the relative angle between the robot and the closest obstacle
+        obstacle_angle = self.scan_geometry.angles[min_index] - self.scan_geometry.angles[center_index]
+
+        if min_distance == float('inf'):
+            return 1000, obstacle_angle
+
+        return min_distance, obstacle_angle
+
+    def averageFilter(self, window_size=10):
+        """
+        Apply average filter to smooth Lidar distance readings.
+
+        Args:
+            window_size: Size of the moving average window.
+
+        Returns:
+            Readings of smoothed distance.
+        """
+
+        # The moving average window should be normalized by dividing by the window size
+        kernel = np.ones(window_size) / window_size
+
+        # Apply the moving average filter
+        smoothed_ranges = np.convolve(self.valid_ranges, kernel, mode='same')
+
+        return smoothed_ranges
+    
+    ############################################################################
+    # region AUXILIARY FUNCTIONS
+    ############################################################################
+
+    def CBRAnalysis(self, main_dt):
+        """
+        Perform the CBR analysis to adjust the solution.
+        
+        Args:
+            main_dt (float): Main time step.
+
+        Returns:
+            str: Case status (New case or Old case).
+        """
+        
+        # Retrive case information
+        with self.latency.span("cbr_retrieve"):
+            case = self.cbr.Retrieve(self.closest_obstacle_distance, self.obstacle_angle, self.scenario)
+
+        # If there is no similar case
+        if case is None:
+
+            self.log_info("No similar case")
+
+            return "New case"
+        
+        v_case = case[4]
+        w_case = case[5]
+
+        # Revise and adjust new solution after DWA and Fuzzy
+        approach_speed = self.ttc_map.approach_speed[self.scan_geometry.angleToIndex(self.obstacle_angle)]
+        with self.latency.span("cbr_revise"):
+            new_v, new_w, situation = self.cbr.Revise(self.closest_obstacle_distance, self.best_v, self.best_w, v_case, w_case,
+                                                      main_dt, approach_speed=approach_speed)
+
+        # If the new solution is better then the case one, update velocities
+        if new_v is not None and new_w is not None:
+            
+            self.best_v = new_v
+            self.best_w = new_w
+
+            self.log_info("Modified case")
+
+            return situation
+
+        else:
+
+            self.log_info("New case")
+
+            return situation
+
+    def AdjustLaserScan(self, scan):
+        """
+        Adjust the Lidar scan data before processing it.
+        
+        Args:
+            scan (LaserScan): Lidar scan data.
+        """
+
+        # Beam angles come from the scan metadata, and are only recomputed if the Lidar configuration changes
+        self.scan_geometry = getScanGeometry(scan.angle_min, scan.angle_increment, len(scan.ranges))
+
+        # Make sure the scan values are valid before doing any math
+        self.valid_ranges = np.array(scan.ranges)
+        self.valid_ranges[self.valid_ranges == 0] = 1e6
+
+        # High resolution Lidars are pooled down to a fixed beam count, keeping the closest reading of each group
+        self.valid_ranges, self.scan_geometry = decimateScan(
+            self.valid_ranges, self.scan_geometry, self.max_scan_beams)
+
+        # Insert the unfiltered readings in the occupancy grid, at the current odometry pose
+        if self.occupancy_grid is not None:
+            self.occupancy_grid.update(self.valid_ranges, self.scan_geometry, self.x, self.y, self.theta)
+
+        # Apply average filter to smooth the Lidar readings and reduce noise
+        self.valid_ranges = self.averageFilter(window_size=5)
+
+        # Index the scan once so every window query in this cycle is O(1)
+        self.range_min_table = RangeMinimumTable(self.valid_ranges)
+
+        # Time to collision of every beam, from the range rates since the last scan and the current velocity
+        self.ttc_map.update(self.valid_ranges, self.scan_geometry, self.scan_stamp, self.v, self.theta)
+        self.ttc_table = RangeMinimumTable(self.ttc_map.ttc)
+
+    def classifyScenario(self, valid_ranges, v, pose, stamp, fov_positions, center_index):
+        """
+        Classify the scenario of the current scan with CBR. Runs on the scenario pool when it is available, so the
+        odometry is passed as it was when the cycle started.
+
+        Args:
+            valid_ranges (np.array): Ranges of the current scan.
+            v (float): Linear velocity of the robot.
+            pose (tuple): Robot [x, y, theta] in odometry frame.
+            stamp (float): Scan time [s].
+            fov_positions (int): Number of beams in the field of view to classify.
+            center_index (int): Beam pointing forward.
+
+        Returns:
+            str: Detected scenario.
+        """
+        with self.latency.span("scenario"):
+            return self.cbr.FindScenario(valid_ranges, v, stamp, fov_positions=fov_positions,
+                                         center_index=center_index, range_min_table=self.range_min_table,
+                                         geometry=self.scan_geometry, pose=pose,
+                                         approach_speed=self.ttc_map.approach_speed)
+
+    ############################################################################
+    # region PLANNING CYCLE
+    ############################################################################
+
+    def planAvoidance(self, scan, stamp: float = None) -> AvoidanceDecision:
+        """
+        One planning cycle: classify the scan, decide whether we must be avoiding obstacles and, if a new command is
+        due, find the best velocities with DWA and adjust them with CBR.
+
+        Args:
+            scan (LaserScan): Lidar scan data, any object with the ScanData fields.
+            stamp (float): Scan time [s], by default the clock time. Every time measure of the cycle uses it.
+
+        Returns:
+            AvoidanceDecision: what the vehicle must do.
+        """
+        if stamp is None:
+            stamp = self.clock.now()
+        self.scan_stamp = stamp
+
+        # Adjust laser scan data
+        with self.latency.span("preprocessing"):
+            self.AdjustLaserScan(scan)
+
+        # Field of view sizes in beams, adapted to the current scan resolution
+        fov_60 = self.scan_geometry.fovPositions(self.narrow_fov)
+        fov_180 = self.scan_geometry.fovPositions(self.wide_fov)
+        center_index = self.scan_geometry.angleToIndex(0.0)
+
+        with self.latency.span("fov_queries"):
+            # Verify the distance to the closest obstacle for 60 degrees in front of the robot
+            closest_in_fov_60, obstacle_angle_60 = self.closestObstacleInCentralFov(
+                fov_positions=fov_60, center_index=center_index)
+
+            # Verify the distance to the closest obstacle for 180 degrees in front of the robot
+            closest_in_fov_180, obstacle_angle_180 = self.closestObstacleInCentralFov(
+                fov_positions=fov_180, center_index=center_index)
+
+            if closest_in_fov_60 > self.safety_distance_to_start:
+                closest_in_fov = closest_in_fov_180
+                self.obstacle_angle = obstacle_angle_180
+                safety_distance = self.safety_distance_wide_fov
+                fov = fov_180
+
+            else:
+                # Minimun distance to start the avoidance behavior
+                closest_in_fov = closest_in_fov_60
+                self.obstacle_angle = obstacle_angle_60
+                safety_distance = self.safety_distance_to_start
+                fov = fov_60
+
+            # Shortest time to collision ahead, obstacles approaching fast are avoided before the distance thresholds
+            min_ttc_ahead, _ = self.ttc_table.query(center_index - fov_60 // 2, center_index + fov_60 // 2)
+
+        # Apply DBSCAN to find clusters and classify the scenario, concurrently with DWA when the pool is available,
+        # since both only read the valid ranges and the velocity (NumPy and sklearn release the GIL)
+        scenario_future = None
+        if self.scenario_pool is not None:
+            scenario_future = self.scenario_pool.submit(
+                self.classifyScenario, self.valid_ranges, self.v, (self.x, self.y, self.theta), stamp, fov, center_index)
+        else:
+            self.scenario = self.classifyScenario(
+                self.valid_ranges, self.v, (self.x, self.y, self.theta), stamp, fov, center_index)
+
+        # Start avoiding with the safety distances, but only stop once both fields of view are clear with the larger
+        # exit distances, and never switch before the minimum dwell times, unless an obstacle is really close
+        avoiding = self.avoidance_hysteresis.update(
+            enter=closest_in_fov < safety_distance,
+            exit=closest_in_fov_180 > self.exit_distance_wide_fov and closest_in_fov_60 > self.exit_distance_narrow_fov,
+            urgent=closest_in_fov < self.safety_distance_wide_fov or min_ttc_ahead < self.min_time_to_collision)
+
+        if avoiding:
+            self.closest_obstacle_distance = closest_in_fov
+
+            # REPLAN VELOCITY - DWA
+            with self.latency.span("dwa"):
+                self.best_v, self.best_w = self.replanVelocity()
+
+        # CBR needs the scenario, and the classifier state must not be shared with the next cycle
+        if scenario_future is not None:
+            with self.latency.span("scenario_wait"):
+                self.scenario = scenario_future.result()
+
+        main_dt = stamp - self.last_command_time
+        if not avoiding or main_dt < self.dt:
+            return AvoidanceDecision(avoiding, False, self.best_v, self.best_w, self.scenario, None)
+
+        self.log_info(
+            f"BEFORE CBR -> Best v: {self.best_v} m/s, Best w: {self.best_w} rad/s")
+
+        # CBR Analysis
+        case = self.CBRAnalysis(main_dt)
+
+        # Adjust velocities
+        self.best_v = min(self.best_v, self.max_v)
+        self.best_w = np.clip(self.best_w, -self.max_w, self.max_w)
+        self.last_command_time = stamp
+
+        # Retain performed obstacle avoidance
+        with self.latency.span("cbr_retain"):
+            self.cbr.Retain(case, self.closest_obstacle_distance, self.obstacle_angle, self.scenario, self.best_v, self.best_w)
+
+        return AvoidanceDecision(avoiding, True, self.best_v, self.best_w, self.scenario, case)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter
+from typing import Callable, Dict, Tuple
+import numpy as np
+from scipy.stats import mannwhitneyu
+import cases
+from avoidance_core import AvoidanceCore, ScanData
+from cbr import CBR
+from clock import SimClock
+from collision_lib import calculateBestTrajectoryGuidedPoint, createAngleTestSequence
+from frame_convertions import LocalProjection, worldToBaselink
+from fuzzy_cbr import Fuzzy
+from scan_lib import getScanGeometry
+from scenario_corpus import SCENARIOS, CorpusSpec, generateSample
+
+
+# Sizes of the case table for the database benchmarks
+CASE_TABLE_SIZES = (1000, 10000, 100000)
+
+
+def timeFunction(function: Callable[[], object], repeats: int = 20, min_time: float = 0.02) -> np.ndarray:
+    """Times a function like timeit: each sample runs it as many times as needed to take at least min_time, with the
+    garbage collector disabled
+
+    Args:
+        function (Callable[[], object]): function to time, called with no arguments
+        repeats (int): number of samples
+        min_time (float): minimum duration of a sample [s]
+
+    Returns:
+        np.ndarray: time per call of each sample [s]
+    """
+    # Warm up caches and lazy initializations, and find how many calls fill a sample
+    number = 1
+    while True:
+        start = perf_counter()
+        for _ in range(number):
+            function()
+        if perf_counter() - start >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+
+    samples = np.zeros(repeats)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeats):
+            start = perf_counter()
+            for _ in range(number):
+                function()
+            samples[i] = (perf_counter() - start) / number
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return samples
+
+
+def compareSamples(samples: np.ndarray, baseline: np.ndarray, alpha: float = 0.01,
+                   tolerance: float = 0.1) -> Tuple[float, float, str]:
+    """Compares timings with a baseline using the Mann-Whitney U test, which does not assume normal timings
+
+    Args:
+        samples (np.ndarray): current time per call [s]
+        baseline (np.ndarray): baseline time per call [s]
+        alpha (float): significance level of the test
+        tolerance (float): relative change of the median below which a significant difference is still ignored
+
+    Returns:
+        Tuple[float, float, str]: median ratio to the baseline, p-value of the slower test, and "regression",
+            "improvement" or "same"
+    """
+    ratio = np.median(samples) / np.median(baseline)
+    p_slower = mannwhitneyu(samples, baseline, alternative="greater").pvalue
+    p_faster = mannwhitneyu(samples, baseline, alternative="less").pvalue
+    if p_slower < alpha and ratio > 1 + tolerance:
+        return ratio, p_slower, "regression"
+    if p_faster < alpha and ratio < 1 - tolerance:
+        return ratio, p_slower, "improvement"
+
+    return ratio, p_slower, "same"
+
+
+############################################################################
+# region BENCHMARK SETUPS
+############################################################################
+
+def _syntheticScan(scenario: int = 0, frames: int = 1, num_beams: int = 640):
+    """Scans of a synthetic scene from the scenario corpus generator, as ScanData"""
+    spec = CorpusSpec(num_beams=num_beams, frames=frames)
+    _, ranges, poses = generateSample(spec, scenario)
+    angle_increment = (spec.angle_max - spec.angle_min) / (num_beams - 1)
+
+    return [ScanData(frame, spec.angle_min, angle_increment) for frame in ranges], poses
+
+
+def _planner():
+    """AvoidanceCore that has just processed a scan with an obstacle ahead, like at the start of a DWA cycle"""
+    core = AvoidanceCore(case_base=cases.CaseDatabase(":memory:"), log_info=lambda message: None, clock=SimClock())
+    core.scenario_pool = None
+    core.v, core.goal_angle = 1.0, 10.0
+    scans, _ = _syntheticScan()
+    core.scan_stamp = 0.0
+    core.AdjustLaserScan(scans[0])
+    core.closest_obstacle_distance, core.obstacle_angle = core.closestObstacleInCentralFov(
+        fov_positions=core.scan_geometry.fovPositions(core.narrow_fov))
+
+    return core
+
+
+def benchObjectiveFunction():
+    core = _planner()
+    window = core.dynamicWindow()
+    return lambda: core.objectiveFunction(*window)
+
+
+def benchIsolatedObstacle():
+    fuzzy = Fuzzy()
+    return lambda: fuzzy.IsolatedObstacle(20.0, 3.0)
+
+
+def benchFindScenario():
+    scans, poses = _syntheticScan(scenario=2, frames=20)
+    geometry = getScanGeometry(scans[0].angle_min, scans[0].angle_increment, len(scans[0].ranges))
+    fov = geometry.fovPositions(np.radians(60))
+    center_index = geometry.angleToIndex(0.0)
+    cbr = CBR(case_base=cases.CaseDatabase(":memory:"), clock=SimClock())
+
+    # Consecutive scans of a moving obstacle, so the change detector never skips the classification
+    frames = itertools.cycle([(np.array(scan.ranges, dtype=float), pose) for scan, pose in zip(scans, poses)])
+    stamps = itertools.count(0.0, 0.1)
+
+    def findScenario():
+        ranges, pose = next(frames)
+        return cbr.FindScenario(ranges, 1.0, next(stamps), fov_positions=fov, center_index=center_index,
+                                geometry=geometry, pose=pose)
+
+    return findScenario
+
+
+def _caseBase(num_cases: int, work_dir: str):
+    """Case base file with random cases of every scenario"""
+    path = os.path.join(work_dir, f"cases_{num_cases}.db")
+    if not os.path.exists(path):
+        case_base = cases.CaseDatabase(path)
+        rng = np.random.default_rng(num_cases)
+        rows = zip(rng.uniform(0.0, 10.0, num_cases), rng.uniform(-np.pi / 2, np.pi / 2, num_cases),
+                   rng.choice(SCENARIOS, num_cases), rng.uniform(0.0, 2.55, num_cases),
+                   rng.uniform(-np.pi, np.pi, num_cases))
+        conn = sqlite3.connect(case_base.db_name)
+        conn.executemany("INSERT INTO casos (distancia_obstaculo, angulo_obstaculo, cenarios, v, w) VALUES (?, ?, ?, ?, ?)",
+                         ((float(d), float(a), str(s), float(v), float(w)) for d, a, s, v, w in rows))
+        conn.commit()
+        conn.close()
+
+    return cases.CaseDatabase(path)
+
+
+def benchSearchSimilarCase(num_cases: int, work_dir: str):
+    case_base = _caseBase(num_cases, work_dir)
+    return lambda: case_base.SearchSimilarCase(3.0, 0.2, "Isolated obstacle", tolerance_distance=0.2)
+
+
+def benchAddCase(num_cases: int, work_dir: str):
+    case_base = _caseBase(num_cases, work_dir)
+    return lambda: case_base.AddCase(3.0, 0.2, "Isolated obstacle", 1.0, 0.3)
+
+
+def benchAverageFilter():
+    core = _planner()
+    return lambda: core.averageFilter(window_size=5)
+
+
+def benchClosestObstacleInCentralFov():
+    core = _planner()
+    fov = core.scan_geometry.fovPositions(core.wide_fov)
+    return lambda: core.closestObstacleInCentralFov(fov_positions=fov)
+
+
+def benchWorldToBaselink(projected: bool):
+    projection = LocalProjection(-22.9, -43.2) if projected else None
+    return lambda: worldToBaselink(-22.8995, -43.1995, -22.9, -43.2, 0.3, projection=projection)
+
+
+def benchCalculateBestTrajectoryGuidedPoint():
+    scans, _ = _syntheticScan(scenario=3)
+    geometry = getScanGeometry(scans[0].angle_min, scans[0].angle_increment, len(scans[0].ranges))
+    ranges = np.array(scans[0].ranges, dtype=float)
+    obstacles = geometry.toXY(np.where(np.isinf(ranges), 1e6, ranges))
+    obstacles = obstacles[np.hypot(*obstacles.T) < 10]
+    angle_tests = createAngleTestSequence(0, 5, 90, 'l')
+
+    return lambda: calculateBestTrajectoryGuidedPoint(angle_tests, 8.0, obstacles, 1.5)
+
+
+def benchmarkSetups(work_dir: str) -> Dict[str, Tuple[Callable[[], Callable[[], object]], int]]:
+    """Benchmarks by name, each with the function that builds the timed call and its number of samples
+
+    Args:
+        work_dir (str): directory for the case base files
+
+    Returns:
+        Dict[str, Tuple[Callable, int]]: setup function and samples per benchmark
+    """
+    setups = {
+        "objectiveFunction": (benchObjectiveFunction, 10),
+        "Fuzzy.IsolatedObstacle": (benchIsolatedObstacle, 10),
+        "CBR.FindScenario": (benchFindScenario, 20),
+        "averageFilter": (benchAverageFilter, 30),
+        "closestObstacleInCentralFov": (benchClosestObstacleInCentralFov, 30),
+        "worldToBaselink": (lambda: benchWorldToBaselink(False), 30),
+        "worldToBaselink[projection]": (lambda: benchWorldToBaselink(True), 30),
+        "calculateBestTrajectoryGuidedPoint": (benchCalculateBestTrajectoryGuidedPoint, 30),
+    }
+    for num_cases in CASE_TABLE_SIZES:
+        setups[f"CaseDatabase.SearchSimilarCase[{num_cases}]"] = (
+            lambda num_cases=num_cases: benchSearchSimilarCase(num_cases, work_dir), 20)
+        setups[f"CaseDatabase.AddCase[{num_cases}]"] = (
+            lambda num_cases=num_cases: benchAddCase(num_cases, work_dir), 20)
+
+    return setups
+
+# endregion
+############################################################################
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the planner hot paths and compare them with stored baselines.")
+    parser.add_argument("--filter", default="", help="only run the benchmarks with this text in the name")
+    parser.add_argument("--baseline", default="benchmark_baselines.json", help="baseline timings file")
+    parser.add_argument("--save", action="store_true", help="store the timings as the new baseline")
+    parser.add_argument("--alpha", type=float, default=0.01, help="significance level of the comparison")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change of the median to ignore")
+    args = parser.parse_args()
+
+    baseline = {"benchmarks": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("machine") != platform.node():
+            print(f"The baseline comes from {baseline.get('machine')}, timings from other machines are not comparable")
+
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, (setup, repeats) in benchmarkSetups(work_dir).items():
+            if args.filter not in name:
+                continue
+            samples = timeFunction(setup(), repeats=repeats)
+            results[name] = samples.tolist()
+
+            line = f"{name:<45} median {1e6 * np.median(samples):12.1f} us   p95 {1e6 * np.percentile(samples, 95):12.1f} us"
+            if name in baseline["benchmarks"]:
+                ratio, p_value, verdict = compareSamples(samples, np.array(baseline["benchmarks"][name]),
+                                                         args.alpha, args.tolerance)
+                line += f"   x{ratio:.2f} (p={p_value:.3f}) {verdict}"
+                if verdict == "regression":
+                    regressions.append(name)
+            print(line)
+
+    if args.save:
+        # Benchmarks that were not run keep their previous baseline
+        baseline["benchmarks"].update(results)
+        baseline.update(machine=platform.node(), python=platform.python_version())
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=1)
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
@@ -4,6 +4,8 @@ import math
 class CaseDatabase:
     def __init__(self, db_name='casos.db'):
         self.db_name = db_name
+        # An in-memory database only lives as long as its connection, so it keeps a single one open
+        self._memory_connection = sqlite3.connect(db_name, check_same_thread=False) if db_name == ':memory:' else None
         self.CreateTable()
 
     def _connect(self):
@@ -13,8 +15,36 @@ class CaseDatabase:
         Returns:
             sqlite3.Connection: Connection object
         """
+        if self._memory_connection is not None:
+            return self._memory_connection
         return sqlite3.connect(self.db_name)
 
+    def _release(self, conn):
+        """
+        Close a connection from _connect, unless it is the in-memory database one.
+        
+        Args:
+            conn (sqlite3.Connection): Connection object
+        """
+        if conn is not self._memory_connection:
+            conn.close()
+
+    def CopyFrom(self, db_name):
+        """
+        Replace the cases with the ones from another database file.
+        
+        Args:
+            db_name (str): Database file to copy
+        
+        Returns:
+            None
+        """
+        source = sqlite3.connect(db_name)
+        conn = self._connect()
+        source.backup(conn)
+        source.close()
+        self._release(conn)
+
     def CreateTable(self):
         """
         Create the table in the database if it does not exist.
@@ -35,7 +65,7 @@ class CaseDatabase:
             )
         ''')
         conn.commit()
-        conn.close()
+        self._release(conn)
 
     def AddCase(self, distancia_obstaculo, angulo_obstaculo, cenario, v, w):
         """
@@ -60,7 +90,7 @@ class CaseDatabase:
             ''', (distancia_obstaculo, angulo_obstaculo, cenario, v, w))
             case_id = c.lastrowid 
             conn.commit()
-            conn.close()
+            self._release(conn)
 
         except Exception as e:
             print(f"Erro ao adicionar caso: {e}")
@@ -96,7 +126,7 @@ class CaseDatabase:
         ''', (cenario, distancia_obstaculo - tolerance_distance, distancia_obstaculo + tolerance_distance, angulo_min, angulo_max))
 
         casos = c.fetchall()
-        conn.close()
+        self._release(conn)
 
         if not casos:
             return None # Return None if no similar cases are found
@@ -120,7 +150,7 @@ class CaseDatabase:
         c.execute('SELECT * FROM casos')
 
         casos = c.fetchall()
-        conn.close()
+        self._release(conn)
         return casos
 
 if __name__ == "__main__":
@@ -3,48 +3,97 @@ from sklearn.cluster import DBSCAN
 import matplotlib.pyplot as plt
 import cases
 import math
+from scan_lib import ScanChangeDetector, ScanRingBuffer, getScanGeometry
+from cluster_tracker import ClusterTracker
+from clock import WallClock
 
 class CBR:
-    def __init__(self):
+    def __init__(self, case_base=None, clock=None):
 
-        self.previous_clusters = None # Store previous clusters
+        self.clock = clock if clock is not None else WallClock() # Time source for the scans classified without a stamp
+        self.scan_history = ScanRingBuffer(capacity=5) # Last scans, with time and pose, for motion detection
+        self.beam_indices = None # Scan beam of each point in the last classified window
+        self.dead_reckoning_pose = np.zeros(3) # Pose integrated from v and w when no odometry pose is given
         self.extra_margin = 0.2 # Extra margin to consider noise
-        self.previous_time = None # Store previous time
+        self.moving_fraction = 0.3 # Fraction of the cluster beams that must be displaced to consider it moving
+        self.tracker = ClusterTracker() # Persistent cluster IDs and velocities across scans
+        self.cluster_track_ids = None # Track ID of each cluster label in the last classification
+        self.min_obstacle_speed = 0.5 # Tracked speed to consider an obstacle moving [m/s]
 
         self.tol = 0.2 # Tolerance for distance
 
+        # Skip the classification when the scene did not change, reusing the previous results
+        self.change_detector = ScanChangeDetector(num_bins=64, threshold=0.1)
+        self.scenario = None # Last classified scenario
+        self.cluster_labels = None # Cluster labels from the last classification
+        self.n_clusters = 0 # Number of clusters from the last classification
+
         self.max_v = 2.55  # Maximum linear velocity 2.55
         self.max_w = np.pi  # Maximum angular velocity np.pi/2
         self.max_acc_v = 0.9 #0.5  # Maximum linear acceleration 0.5
         self.max_acc_w = np.pi/2  # Maximum angular acceleration
         self.safety_distance = 2.0 # meter
 
-        # DataBase
-        self.db = cases.CaseDatabase()
+        # DataBase, the casos.db file unless another case base is given
+        self.db = case_base if case_base is not None else cases.CaseDatabase()
 
-    def FindScenario(self, valid_ranges, v, current_time, fov_positions=160, center_index=320):
+    def FindScenario(self, valid_ranges, v, current_time=None, fov_positions=160, center_index=320, range_min_table=None,
+                     geometry=None, pose=None, approach_speed=None, w=None):
         """
         Identify scenario based on the clusters found in the data.
         
         Args:
             valid_ranges (np.array): Array with valid ranges from the LiDAR sensor.
             v (float): Linear velocity of the robot.
-            current_time (float): Current time.
+            current_time (float): Scan time, by default the clock time.
+            range_min_table (RangeMinimumTable): Optional range-minimum index over valid_ranges, used to skip empty views.
+            geometry (ScanGeometry): Geometry of valid_ranges, by default the simulated Lidar 260 degrees field of view.
+            pose (tuple): Robot [x, y, theta] in odometry frame, by default integrated from v and w.
+            approach_speed (np.array): Per-beam obstacle approach speed from the time-to-collision map, if available.
+            w (float): Angular velocity of the robot, for the integrated pose. Without a pose nor w the robot motion is
+                unknown, so only the approach speed can detect moving obstacles.
         
         Returns:
             str: Detected scenario.
         """
+        if current_time is None:
+            current_time = self.clock.now()
+        if geometry is None:
+            geometry = getScanGeometry(-2.268889904022217, 4.537789821624756 / (len(valid_ranges) - 1), len(valid_ranges))
+        known_motion = pose is not None or w is not None
+        if pose is None:
+            if len(self.scan_history) > 0 and w is not None:
+                # Unicycle integration, with the heading in the middle of the interval
+                elapsed = current_time - self.scan_history.ordered()[1][-1]
+                heading = self.dead_reckoning_pose[2] + 0.5 * w * elapsed
+                self.dead_reckoning_pose += (v * elapsed * np.cos(heading), v * elapsed * np.sin(heading), w * elapsed)
+            pose = self.dead_reckoning_pose.copy()
+
+        # Every scan goes to the history, even when the classification is skipped
+        self.scan_history.push(valid_ranges, current_time, pose)
 
         # New index for the angle range considered
         half_fov = fov_positions // 2
         start_index = center_index - half_fov
         end_index = center_index + half_fov
 
+        # Nothing closer than the long distance filter in the view, so there is nothing to cluster
+        if range_min_table is not None and range_min_table.query(start_index, end_index)[0] >= 1e6:
+            return
+
         # Get the distances within the central field of view
         valid_ranges = valid_ranges[start_index:end_index]
 
-        # Filter long distances
-        valid_ranges = valid_ranges[valid_ranges < 1e6]
+        # Static scene, so the last scenario and clusters are still valid
+        window_key = (start_index, end_index)
+        if not self.change_detector.hasChanged(valid_ranges, key=window_key):
+            return self.scenario
+        window_ranges = valid_ranges
+
+        # Filter long distances, keeping the beam of each remaining point
+        short_distances = valid_ranges < 1e6
+        beam_indices = start_index + np.flatnonzero(short_distances)
+        valid_ranges = valid_ranges[short_distances]
 
         if valid_ranges.size == 0:
             return
@@ -54,92 +103,122 @@ class CBR:
         labels = db.labels_ # Labels from each point (identified cluster)        
         n_clusters = len(np.unique(labels[labels != -1])) # Number of clusters in labels, ignoring noise if present
 
-        # First iteration: store data and return
-        if self.previous_clusters is None:
-            self.previous_clusters = valid_ranges.copy() # Store current clusters
-            self.previous_time = current_time
+        # Associate the clusters to the tracks from previous scans
+        cluster_labels, centroid_angles, centroid_ranges = ClusterTracker.clusterCentroids(
+            geometry.angles[beam_indices], valid_ranges, labels)
+        track_ids = self.tracker.update(centroid_angles, centroid_ranges, pose, current_time)
+        cluster_track_ids = np.full(labels.max() + 1, -1)
+        cluster_track_ids[cluster_labels] = track_ids
+
+        # First iteration: nothing to compare with yet
+        if len(self.scan_history) < 2:
             return
-        
-        # Calculate time step
-        self.dt = current_time - self.previous_time
 
-        # Compare with previous clusters
-        moving_obstacle = self.DetectMovingObstacle(valid_ranges, labels, v)
+        # Compare with previous scans
+        moving_obstacle = self.DetectMovingObstacle(beam_indices, labels, geometry, cluster_track_ids, approach_speed,
+                                                    known_motion=known_motion)
 
         # Update stored values
-        self.previous_clusters = valid_ranges.copy()
-        self.previous_time = current_time
+        self.beam_indices = beam_indices
+        self.cluster_labels = labels
+        self.cluster_track_ids = cluster_track_ids
+        self.n_clusters = n_clusters
+        self.change_detector.setReference(window_ranges, key=window_key)
 
         # Classify scenario
 
         # Moving obstacle
         if moving_obstacle:
-            return "Moving obstacle"
+            self.scenario = "Moving obstacle"
         # Isolated obstacle
-        if n_clusters == 1:
-            return "Isolated obstacle"
+        elif n_clusters == 1:
+            self.scenario = "Isolated obstacle"
         # Narrow corridor
         elif n_clusters == 2:
-            return "Narrow corridor"
+            self.scenario = "Narrow corridor"
         # Unknown scenario
         elif n_clusters > 2:
-            return "Unknown scenario"
+            self.scenario = "Unknown scenario"
         else:
-            return None
+            self.scenario = None
 
-    def DetectMovingObstacle(self, valid_ranges, labels, v):
+        return self.scenario
+
+    def DetectMovingObstacle(self, beam_indices, labels, geometry, cluster_track_ids, approach_speed=None,
+                             known_motion=True):
         """
-        Detect if there is a moving obstacle based on the displacement of the clusters.
+        Detect if there is a moving obstacle. Clusters with a confirmed track use the tracked velocity, new clusters
+        use the approach speed of their beams and their displacement over the scan history, compensated for the robot motion.
         
         Args:
-            valid_ranges (np.array): Array with valid ranges from the LiDAR sensor.
+            beam_indices (np.array): Scan beam of each clustered point.
             labels (np.array): Array with the cluster labels.
-            v (float): Linear velocity of the robot.
+            geometry (ScanGeometry): Geometry of the scans.
+            cluster_track_ids (np.array): Track ID of each cluster label.
+            approach_speed (np.array): Per-beam obstacle approach speed from the time-to-collision map, if available.
+            known_motion (bool): Whether the scan poses follow the robot motion. The tracked velocities and the
+                displacement over the scan history are only used when they do.
         
         Returns:
             bool: True if movement is detected, False otherwise.
         """
 
-        prev = self.previous_clusters
+        # Tracked velocities, for all clusters at once
+        speeds, confirmed = self.tracker.trackSpeeds(cluster_track_ids)
+        if not known_motion:
+            confirmed = np.zeros_like(confirmed)
+        elif np.any(confirmed & (speeds > self.min_obstacle_speed)):
+            return True  # Movement detected
+
+        # Per-beam differences between the newest scan and each older one, all at once
+        if known_motion:
+            residuals, ages = self.scan_history.egoCompensatedResiduals(geometry)
 
         for cluster_label in np.unique(labels):
-            if cluster_label == -1:  # Ignore noise
-                continue
-            
-            try:
-                # Get points from current and previous cluster
-                current_cluster = valid_ranges[labels == cluster_label]
-                previous_cluster = prev[labels == cluster_label]
-            except:
+            if cluster_label == -1 or confirmed[cluster_label]:  # Ignore noise and tracked clusters
                 continue
 
-            if current_cluster.size == 0 or previous_cluster.size == 0:
-                continue
+            # Approaching on enough beams since the last scan, already known from the time-to-collision map
+            cluster_beams = beam_indices[labels == cluster_label]
+            if approach_speed is not None and np.mean(approach_speed[cluster_beams] > self.min_obstacle_speed) > self.moving_fraction:
+                return True  # Movement detected
 
-            # Define limit of variation to consider movement
-            expected_displacement = v * self.dt
-            threshold = expected_displacement + self.extra_margin
+            if not known_motion:
+                continue
 
-            # Calculate the average displacement of the cluster
-            real_displacement = np.abs(np.mean(current_cluster) - np.mean(previous_cluster))
+            # Displacement of the cluster beams against the oldest comparable scan in the window
+            cluster_residuals = np.abs(residuals[:, cluster_beams])
+            comparable = ~np.isnan(cluster_residuals)
+            scans = np.flatnonzero(np.any(comparable, axis=1) & (ages > 0))
+            if scans.size == 0:
+                continue
+            oldest = scans[0]
 
-            if real_displacement > threshold:
+            # Moving if enough beams moved beyond the noise margin, a few beams on the borders move with parallax only
+            displaced = cluster_residuals[oldest][comparable[oldest]] > self.extra_margin
+            if np.mean(displaced) > self.moving_fraction:
                 return True  # Movement detected
 
         return False  # No movement detected
     
-    def dynamicWindowSafetyStop(self, dist_obst, w):
+    def dynamicWindowSafetyStop(self, dist_obst, w, approach_speed=0.0):
         """
         Calculate dynamic window to ensure that the robot can stop in time to avoid a collision.
-        Based on dynamic restriction.
+        Based on dynamic restriction. Works element-wise when the arguments are arrays.
 
         Args:
             dist_obst (float): distance to the closest obstacle.
+            w (float): angular velocity.
+            approach_speed (float): speed the obstacle itself moves towards the robot, from the time-to-collision map.
         Returns:
             safe_v_max (float): maximal linear velocity to stop in time,
             safe_w_max (float): maximal angular velocity to stop in time."""
 
-        safe_v_max = min(np.sqrt(2 * dist_obst * self.max_acc_v), self.max_v)
+        # While the robot brakes, the obstacle keeps closing in: v**2 / (2*a) + approach_speed * v / a <= dist_obst
+        # Receding obstacles are not trusted to keep going away
+        approach_speed = np.maximum(approach_speed, 0.0)
+        safe_v_max = np.minimum(
+            np.sqrt(approach_speed**2 + 2 * dist_obst * self.max_acc_v) - approach_speed, self.max_v)
         safe_w_max = np.sign(w) * np.sqrt(2 * dist_obst * self.max_acc_w)
 
         # Guarantees that the velocities are within the robot limits
@@ -184,7 +263,7 @@ class CBR:
 
         return new_min_dist
 
-    def Revise(self, min_dist, best_v, best_w, v_case, w_case, dt):
+    def Revise(self, min_dist, best_v, best_w, v_case, w_case, dt, approach_speed=0.0):
         """
         Revise and adjust new solution after DWA and Fuzzy.
         
@@ -195,6 +274,7 @@ class CBR:
             v_case (float): Linear velocity from the past case.
             w_case (float): Angular velocity from the past case.
             dt (float): Time step.
+            approach_speed (float): Speed the closest obstacle moves towards the robot, from the time-to-collision map.
         
         Returns:
             tuple: New linear and angular velocities.
@@ -205,7 +285,7 @@ class CBR:
 
         # Check if it'll crash with the velocities from the modified case
         safe_v_max, safe_w_max = self.dynamicWindowSafetyStop(
-            min_dist, new_w)
+            min_dist, new_w, approach_speed)
         
         # print("safe_vel=", safe_v_max, safe_w_max)
         # print("new_vel=", new_v, new_w)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import threading
+from time import monotonic, sleep
+
+
+class WallClock:
+    """Monotonic time from the system, used when running live. It does not jump when the system clock is synchronized,
+    so durations and deadlines stay valid, but its origin is arbitrary: it is not a date.
+    """
+
+    def now(self) -> float:
+        """Current time [s]"""
+        return monotonic()
+
+    def sleep(self, duration: float) -> None:
+        if duration > 0:
+            sleep(duration)
+
+
+class SimClock:
+    """Time that only moves when it is advanced, so replays and simulations run as fast as the CPU allows and give
+    the same results on every run. Sleeping advances the time right away.
+    """
+
+    def __init__(self, start: float = 0.0) -> None:
+        """
+        Args:
+            start (float): initial time [s]
+        """
+        self._lock = threading.Lock()
+        self._time = start
+
+    def now(self) -> float:
+        """Current time [s]"""
+        with self._lock:
+            return self._time
+
+    def advance(self, duration: float) -> None:
+        """Moves the time forward
+
+        Args:
+            duration (float): time to add [s], negative values are ignored
+        """
+        with self._lock:
+            self._time += max(duration, 0.0)
+
+    def set(self, stamp: float) -> None:
+        """Moves the time to a stamp, it never goes backwards
+
+        Args:
+            stamp (float): new time [s]
+        """
+        with self._lock:
+            self._time = max(self._time, stamp)
+
+    def sleep(self, duration: float) -> None:
+        self.advance(duration)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import Tuple
+
+
+class ClusterTracker:
+    """Tracks Lidar clusters across scans, giving them persistent IDs and velocity estimates.
+
+    Tracks live in fixed size arrays. Positions and velocities are kept in the odometry frame, so the robot motion is
+    already compensated. Clusters are associated to tracks by centroid angle and range, with a greedy matching over
+    both lists sorted by angle.
+    """
+
+    def __init__(self, max_tracks: int = 32, angle_gate: float = np.radians(10), range_gate: float = 0.8,
+                 velocity_gain: float = 0.5, max_misses: int = 3, min_hits: int = 3) -> None:
+        """
+        Args:
+            max_tracks (int): maximum number of simultaneous tracks
+            angle_gate (float): largest centroid angle difference for an association [RAD]
+            range_gate (float): largest centroid range difference for an association [m]
+            velocity_gain (float): weight of each new velocity measurement in the filtered velocity, in [0, 1]
+            max_misses (int): scans a track can go unmatched before it is dropped
+            min_hits (int): matches needed before the track velocity is trusted
+        """
+        self.angle_gate = angle_gate
+        self.range_gate = range_gate
+        self.velocity_gain = velocity_gain
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+
+        self.ids = np.full(max_tracks, -1)  # track ID per slot, -1 for free slots
+        self.positions = np.zeros((max_tracks, 2))  # [x, y] in odometry frame [m]
+        self.velocities = np.zeros((max_tracks, 2))  # [vx, vy] in odometry frame [m/s]
+        self.last_times = np.zeros(max_tracks)  # [s]
+        self.hits = np.zeros(max_tracks, dtype=int)
+        self.misses = np.zeros(max_tracks, dtype=int)
+        self.next_id = 0
+
+    @staticmethod
+    def clusterCentroids(angles: np.ndarray, ranges: np.ndarray, labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Mean angle and range of each cluster, ignoring noise points
+
+        Args:
+            angles (np.ndarray): angle of each point in baselink frame [RAD]
+            ranges (np.ndarray): range of each point [m]
+            labels (np.ndarray): cluster label of each point, -1 for noise
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: cluster labels, centroid angles [RAD] and ranges [m]
+        """
+        clustered = labels >= 0
+        if not np.any(clustered):
+            return np.empty(0, dtype=int), np.empty(0), np.empty(0)
+        counts = np.bincount(labels[clustered])
+        cluster_labels = np.flatnonzero(counts)
+        counts = counts[cluster_labels]
+        centroid_angles = np.bincount(labels[clustered], weights=angles[clustered])[cluster_labels] / counts
+        centroid_ranges = np.bincount(labels[clustered], weights=ranges[clustered])[cluster_labels] / counts
+
+        return cluster_labels, centroid_angles, centroid_ranges
+
+    def update(self, angles: np.ndarray, ranges: np.ndarray, pose: Tuple[float, float, float], stamp: float) -> np.ndarray:
+        """Associates the clusters of a new scan to the tracks, updating them and creating tracks for new clusters
+
+        Args:
+            angles (np.ndarray): cluster centroid angles in baselink frame [RAD]
+            ranges (np.ndarray): cluster centroid ranges [m]
+            pose (Tuple[float, float, float]): robot [x, y, theta] in odometry frame
+            stamp (float): scan time [s]
+
+        Returns:
+            np.ndarray: track ID of each cluster, -1 if no slot was available
+        """
+        x, y, theta = pose
+        angles = np.asarray(angles, dtype=float)
+        ranges = np.asarray(ranges, dtype=float)
+        detections = np.column_stack((x + ranges * np.cos(theta + angles), y + ranges * np.sin(theta + angles)))
+        track_ids = np.full(len(angles), -1)
+
+        # Tracks predicted to this scan time, as angle and range seen from the current pose
+        slots = np.flatnonzero(self.ids >= 0)
+        predicted = self.positions[slots] + self.velocities[slots] * (stamp - self.last_times[slots])[:, None]
+        offsets = predicted - np.array([x, y])
+        track_ranges = np.hypot(offsets[:, 0], offsets[:, 1])
+        track_angles = np.angle(np.exp(1j * (np.arctan2(offsets[:, 1], offsets[:, 0]) - theta)))
+
+        # Greedy matching, walking both lists in angle order
+        matched = np.zeros(len(slots), dtype=bool)
+        track_order = np.argsort(track_angles)
+        j = 0
+        for i in np.argsort(angles):
+            while j + 1 < len(track_order) and track_angles[track_order[j + 1]] <= angles[i]:
+                j += 1
+            best = None
+            for k in (j, j + 1):
+                if k >= len(track_order) or matched[track_order[k]]:
+                    continue
+                t = track_order[k]
+                if abs(track_angles[t] - angles[i]) < self.angle_gate and abs(track_ranges[t] - ranges[i]) < self.range_gate:
+                    if best is None or abs(track_angles[t] - angles[i]) < abs(track_angles[best] - angles[i]):
+                        best = t
+            if best is not None:
+                matched[best] = True
+                track_ids[i] = self._updateTrack(slots[best], detections[i], stamp)
+
+        # Tracks not seen in this scan
+        missed = slots[~matched]
+        self.misses[missed] += 1
+        self.ids[missed[self.misses[missed] > self.max_misses]] = -1
+
+        # New tracks for the clusters that were not associated
+        for i in np.flatnonzero(track_ids < 0):
+            free = np.flatnonzero(self.ids < 0)
+            if free.size == 0:
+                break
+            track_ids[i] = self._newTrack(free[0], detections[i], stamp)
+
+        return track_ids
+
+    def _updateTrack(self, slot: int, position: np.ndarray, stamp: float) -> int:
+        dt = stamp - self.last_times[slot]
+        if dt > 0:
+            measured_velocity = (position - self.positions[slot]) / dt
+            # The first measurement initializes the velocity, later ones are filtered
+            gain = 1.0 if self.hits[slot] == 1 else self.velocity_gain
+            self.velocities[slot] += gain * (measured_velocity - self.velocities[slot])
+        self.positions[slot] = position
+        self.last_times[slot] = stamp
+        self.hits[slot] += 1
+        self.misses[slot] = 0
+
+        return self.ids[slot]
+
+    def _newTrack(self, slot: int, position: np.ndarray, stamp: float) -> int:
+        self.ids[slot] = self.next_id
+        self.next_id += 1
+        self.positions[slot] = position
+        self.velocities[slot] = 0.0
+        self.last_times[slot] = stamp
+        self.hits[slot] = 1
+        self.misses[slot] = 0
+
+        return self.ids[slot]
+
+    def trackSpeeds(self, track_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Speed of some tracks, and whether they had enough matches to be trusted
+
+        Args:
+            track_ids (np.ndarray): track IDs, -1 or unknown IDs give an untrusted zero speed
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: speeds [m/s] and confirmed flags
+        """
+        track_ids = np.asarray(track_ids)
+        speeds = np.zeros(track_ids.shape)
+        confirmed = np.zeros(track_ids.shape, dtype=bool)
+        for i, track_id in enumerate(track_ids):
+            slot = np.flatnonzero(self.ids == track_id) if track_id >= 0 else []
+            if len(slot):
+                speeds[i] = np.hypot(*self.velocities[slot[0]])
+                confirmed[i] = self.hits[slot[0]] >= self.min_hits
+
+        return speeds, confirmed
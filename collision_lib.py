@@ -13,13 +13,41 @@ def areRotatedPointsInRectangle(points: list, length: float, width: float, angle
         angle (float): angle to rotate the points (or the rectangle, depending on the point of view) [RAD]
 
     Returns:
-        bool: True if points fall inside the rectangle
+        bool: True if any of the points falls inside the rectangle
     """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
     R = rotationMatrix(angle=angle)
-    rotated_points = R @ np.array(points).T
+    rotated_points = R @ points.T
     
     # Check if the rotated points are inside the rectangle, doing each for each collumn at once
-    return np.all(np.logical_and(rotated_points[0] > 0, rotated_points[0] < length, np.abs(rotated_points[1]) < width/2))
+    inside = (rotated_points[0] > 0) & (rotated_points[0] < length) & (np.abs(rotated_points[1]) < width/2)
+
+    return bool(np.any(inside))
+
+
+def areRotatedPointsInRectangleBatch(points: list, length: float, width: float, angles: np.ndarray) -> np.ndarray:
+    """Same test as areRotatedPointsInRectangle, for every angle at once, rotating all points by all angles as a single tensor operation
+
+    Args:
+        points (list): list of points [x, y] in baselink frame
+        length (float): length [m]
+        width (float): width [m]
+        angles (np.ndarray): angles to rotate the points (or the rectangle, depending on the point of view) [RAD]
+
+    Returns:
+        np.ndarray: one bool per angle, True if any of the points falls inside the rectangle for that angle
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    angles = np.asarray(angles, dtype=float).reshape(-1, 1)
+    ca = np.cos(angles)
+    sa = np.sin(angles)
+
+    # Rows are angles and columns are points, same rotation as rotationMatrix(angle) @ point
+    rotated_x = ca * points[:, 0] - sa * points[:, 1]
+    rotated_y = sa * points[:, 0] + ca * points[:, 1]
+    inside = (rotated_x > 0) & (rotated_x < length) & (np.abs(rotated_y) < width/2)
+
+    return np.any(inside, axis=1)
 
 
 def createAngleTestSequence(goal_angle: float, angle_step: float, full_test_range: float, start_side: str) -> List[float]:
@@ -64,11 +92,15 @@ def calculateBestTrajectoryGuidedPoint(angle_tests: list, point_distance: float,
     Returns:
         Tuple[np.ndarray, float]: guided waypoint in baselink frame, and angle to the original goal [degrees]
     """
-    for angle in angle_tests:
-        if not areRotatedPointsInRectangle(points=obstacles_baselink_frame_xy, length=point_distance, width=corridor_width, angle=-angle):
-            guided_point_x = point_distance * np.cos(angle)
-            guided_point_y = point_distance * np.sin(angle)
-            return np.array([guided_point_x, guided_point_y]), np.degrees(angle - angle_tests[0])
+    # Test all the corridors at once, then take the first free one in the priority order of angle_tests
+    blocked = areRotatedPointsInRectangleBatch(points=obstacles_baselink_frame_xy, length=point_distance,
+                                               width=corridor_width, angles=-np.asarray(angle_tests))
+    free_indices = np.flatnonzero(~blocked)
+    if free_indices.size > 0:
+        angle = angle_tests[free_indices[0]]
+        guided_point_x = point_distance * np.cos(angle)
+        guided_point_y = point_distance * np.sin(angle)
+        return np.array([guided_point_x, guided_point_y]), np.degrees(angle - angle_tests[0])
 
     return np.array([0, 0]), np.degrees(angle_tests[-1] - angle_tests[0])
 
@@ -84,11 +116,9 @@ def checkSafeFOV(obstacles_baselink_frame_ra: list, goal_angle_baselink_frame: f
         bool: if we can go back to AUTO or not
     """
     safe_fov = np.radians(140)
-    for _, angle in obstacles_baselink_frame_ra:
-        if abs(goal_angle_baselink_frame - angle) < safe_fov/2:
-            return False
+    obstacles_angles = np.asarray(obstacles_baselink_frame_ra, dtype=float).reshape(-1, 2)[:, 1]
 
-    return True
+    return not np.any(np.abs(goal_angle_baselink_frame - obstacles_angles) < safe_fov/2)
 
 # points_to_test = [[1, 0], [0, 0], [0, 1], [1, 1]]
 # length = 2
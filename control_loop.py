@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import threading
+import traceback
+from collections import deque
+from time import monotonic, sleep
+from typing import Any, Callable, Optional, Tuple
+
+
+class LatestValueSlot:
+    """Thread safe slot that only keeps the latest value written, so a slow reader never builds a queue"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._value = None
+        self._stamp = None
+        self._fresh = False
+        self.written = 0  # values written
+        self.overwritten = 0  # values replaced before anyone took them
+
+    def put(self, value: Any, stamp: float) -> None:
+        """Stores a value, replacing the previous one
+
+        Args:
+            value (Any): value to store
+            stamp (float): time the value was received [s]
+        """
+        with self._lock:
+            if self._fresh:
+                self.overwritten += 1
+            self._value = value
+            self._stamp = stamp
+            self._fresh = True
+            self.written += 1
+
+    def take(self) -> Optional[Tuple[Any, float]]:
+        """Returns the latest value if it was not taken yet
+
+        Returns:
+            Optional[Tuple[Any, float]]: value and its stamp, or None if there is nothing new
+        """
+        with self._lock:
+            if not self._fresh:
+                return None
+            self._fresh = False
+            return self._value, self._stamp
+
+
+class FixedRateLoop:
+    """Runs a step function on its own thread at a fixed period, measuring the start time jitter of each cycle"""
+
+    def __init__(self, period: float, step: Callable[[], None], should_stop: Callable[[], bool] = lambda: False,
+                 stats_window: int = 200, clock: Callable[[], float] = monotonic,
+                 sleep: Callable[[float], None] = sleep, log_error: Callable[[str], None] = print) -> None:
+        """
+        Args:
+            period (float): loop period [s]
+            step (Callable[[], None]): function called once per cycle
+            should_stop (Callable[[], bool]): checked every cycle, the loop ends when it returns True
+            stats_window (int): number of recent cycles kept for the jitter statistics
+            clock (Callable[[], float]): time source [s]
+            sleep (Callable[[float], None]): waits for a duration [s], a simulated clock can just advance its time
+            log_error (Callable[[str], None]): error logger, gets the traceback of the steps that raise
+        """
+        self.period = period
+        self.step = step
+        self.should_stop = should_stop
+        self.clock = clock
+        self.sleep = sleep
+        self.log_error = log_error
+        self.cycles = 0  # cycles executed
+        self.failures = 0  # cycles whose step raised an exception
+        self.overruns = 0  # deadlines missed because a cycle took longer than the period
+        self.jitter = deque(maxlen=stats_window)  # [s] delay of each cycle start in relation to its deadline
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="planner_loop", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def _run(self) -> None:
+        deadline = self.clock()
+        while not self._stop_event.is_set() and not self.should_stop():
+            self.jitter.append(self.clock() - deadline)
+            # A failing cycle must not end the loop, the next one may work with new data
+            try:
+                self.step()
+            except Exception:
+                self.failures += 1
+                self.log_error(f"Planner loop step failed:\n{traceback.format_exc()}")
+            self.cycles += 1
+
+            # Keep the original phase, skipping the deadlines already missed
+            deadline += self.period
+            now = self.clock()
+            if now > deadline:
+                missed = int((now - deadline) / self.period) + 1
+                self.overruns += missed
+                deadline += missed * self.period
+            self.sleep(max(deadline - self.clock(), 0.0))
+
+    def jitterStats(self) -> Tuple[float, float]:
+        """Jitter statistics over the recent cycles
+
+        Returns:
+            Tuple[float, float]: mean and maximum jitter [s]
+        """
+        if not self.jitter:
+            return 0.0, 0.0
+        jitter = list(self.jitter)
+
+        return sum(jitter) / len(jitter), max(jitter)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import traceback
+from collections import Counter
+from contextlib import nullcontext
+from time import strftime
+from typing import Callable, Tuple
+
+
+# Returned by cycle between captures, entering and leaving it does nothing
+_NULL_CYCLE = nullcontext()
+
+class CycleProfiler:
+    """Profiles a number of planning cycles on request, while the node keeps running.
+
+    Two profilers run during a capture. cProfile times every call on the thread that runs the cycles, for the
+    top-functions summary. A sampler thread also takes the stacks of that thread, and of the threads named with
+    thread_prefixes, every sample_interval. These samples are counted as collapsed stacks, one "frame;frame;frame count"
+    line per stack, which flamegraph.pl and speedscope read. Nothing runs between captures: cycle returns a shared
+    context that does nothing. The profilers stop on the cycle thread after the last cycle, and the files are written
+    on a background thread, so a slow or failing disk never stalls the planner.
+    """
+
+    def __init__(self, output_dir: str = "profiles", sample_interval: float = 0.001,
+                 thread_prefixes: Tuple[str, ...] = (), log_info: Callable[[str], None] = print,
+                 log_error: Callable[[str], None] = print) -> None:
+        """
+        Args:
+            output_dir (str): directory for the profile files, created if needed
+            sample_interval (float): time between stack samples [s]
+            thread_prefixes (Tuple[str, ...]): other threads to sample, by name prefix, like the scenario pool
+            log_info (Callable[[str], None]): information logger
+            log_error (Callable[[str], None]): error logger
+        """
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.thread_prefixes = thread_prefixes
+        self.log_info = log_info
+        self.log_error = log_error
+        self._lock = threading.Lock()
+        self._requested_cycles = 0  # cycles to capture from the next one, 0 if there is no request
+        self._remaining_cycles = 0  # cycles left in the running capture
+        self._profile = None
+        self._stacks = Counter()  # samples per collapsed stack
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._cycle_thread_id = None
+        self._captures = 0  # captures started, numbers the files of each one
+        self._writer = None  # thread writing the files of the last capture
+
+    @property
+    def active(self) -> bool:
+        return self._remaining_cycles > 0
+
+    def request(self, num_cycles: int) -> None:
+        """Asks for a capture of the next cycles. Safe to call from other threads and from signal handlers, and
+        ignored while a capture is running.
+
+        Args:
+            num_cycles (int): cycles to capture
+        """
+        with self._lock:
+            if not self.active and num_cycles > 0:
+                self._requested_cycles = int(num_cycles)
+
+    def cycle(self):
+        """Context to wrap each planning cycle with, it starts, counts and finishes the captures
+
+        Returns:
+            context manager to use in a with statement
+        """
+        if not self._requested_cycles and not self.active:
+            return _NULL_CYCLE
+        return _ProfiledCycle(self)
+
+    def _start(self) -> None:
+        with self._lock:
+            self._remaining_cycles, self._requested_cycles = self._requested_cycles, 0
+        self._cycle_thread_id = threading.get_ident()
+        self._captures += 1
+        # A new counter, the previous one may still be written
+        self._stacks = Counter()
+        self._stop_sampling.clear()
+        self._sampler = threading.Thread(target=self._sample, name="cycle_profiler", daemon=True)
+        self._sampler.start()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def _finish(self) -> None:
+        self._profile.disable()
+        self._stop_sampling.set()
+        self._sampler.join()
+        self._writer = threading.Thread(target=self._write, args=(self._profile, self._stacks, self._captures),
+                                        name="cycle_profiler_writer", daemon=True)
+        self._writer.start()
+
+    def _write(self, profile: cProfile.Profile, stacks: Counter, capture: int) -> None:
+        """Writer thread: saves one capture, logging the errors instead of raising them"""
+        try:
+            self._save(profile, stacks, capture)
+        except Exception:
+            self.log_error(f"Could not save the profile of the planning cycles:\n{traceback.format_exc()}")
+
+    def _sample(self) -> None:
+        """Sampler thread: counts the stacks of the profiled threads until the capture finishes"""
+        while not self._stop_sampling.wait(self.sample_interval):
+            threads = {self._cycle_thread_id: "planner"}
+            for thread in threading.enumerate():
+                if thread.name.startswith(self.thread_prefixes):
+                    threads[thread.ident] = thread.name
+
+            frames = sys._current_frames()
+            for thread_id, thread_name in threads.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self._stacks[";".join([thread_name] + stack[::-1])] += 1
+
+    def _save(self, profile: cProfile.Profile, stacks: Counter, capture: int, top: int = 30) -> str:
+        """Writes one capture: collapsed stacks, the cProfile statistics and the top functions summary
+
+        Args:
+            profile (cProfile.Profile): cProfile statistics of the capture
+            stacks (Counter): samples per collapsed stack
+            capture (int): capture number
+            top (int): functions listed in the summary
+
+        Returns:
+            str: common absolute path of the files, without extension
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        # The capture number keeps the names unique when several captures finish within the same second
+        path = os.path.abspath(os.path.join(self.output_dir, f"cycles_{strftime('%Y%m%d_%H%M%S')}_{capture:03d}"))
+
+        with open(path + ".collapsed", "w") as file:
+            for stack, count in sorted(stacks.items()):
+                file.write(f"{stack} {count}\n")
+
+        profile.dump_stats(path + ".prof")
+        summary = io.StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+        with open(path + "_top.txt", "w") as file:
+            file.write(summary.getvalue())
+
+        self.log_info(f"Profile of the planning cycles saved to {path}.collapsed, .prof and _top.txt")
+
+        return path
+
+
+class _ProfiledCycle:
+    """One cycle of a capture, the capture starts with the first one and finishes after the last one"""
+
+    __slots__ = ("profiler",)
+
+    def __init__(self, profiler: CycleProfiler) -> None:
+        self.profiler = profiler
+
+    def __enter__(self) -> None:
+        if not self.profiler.active:
+            self.profiler._start()
+
+    def __exit__(self, *exception) -> None:
+        self.profiler._remaining_cycles -= 1
+        if self.profiler._remaining_cycles <= 0:
+            self.profiler._finish()
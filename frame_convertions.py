@@ -52,8 +52,166 @@ def utmToLatLon(utm_e: float, utm_n: float, zn: int, zl: str) -> Tuple[float, fl
     return lat, lon
 
 
+class LocalProjection:
+    """Fast UTM projection for the region around an anchor point (usually home).
+
+    Close to the anchor, the latlon <-> UTM mapping is replaced by its second order expansion, fitted once with
+    the utm lib, which is much cheaper than a full UTM conversion. All coordinates are given in the anchor UTM zone,
+    and points farther than the valid radius fall back to the full conversion forced to that zone.
+    """
+
+    def __init__(self, anchor_lat: float, anchor_lon: float, max_error: float = 0.001, max_radius: float = 1000.0) -> None:
+        """Fits the local expansions and finds the radius where they stay within the error bound
+
+        Args:
+            anchor_lat (float): anchor latitude
+            anchor_lon (float): anchor longitude
+            max_error (float): maximum position error accepted from the fast path [m]
+            max_radius (float): largest radius around the anchor considered for the fast path [m]
+        """
+        self.anchor_lat = anchor_lat
+        self.anchor_lon = anchor_lon
+        self.max_error = max_error
+        self.anchor_east, self.anchor_north, self.zone_number, self.zone_letter = latLonToUtm(
+            lat=anchor_lat, lon=anchor_lon)
+
+        # Expansions of latlon offsets [degrees] -> UTM offsets [m] and back, steps of about 100 m
+        self.forward_coefficients = self._fitExpansion(self._fullToUtmOffset, 1e-3)
+        self.inverse_coefficients = self._fitExpansion(self._fullToLatLon, 100.0)
+        self._forward_scalar = self.forward_coefficients.tolist()
+        self._inverse_scalar = self.inverse_coefficients.tolist()
+
+        # Shrink the radius until the fast path respects the error bound on a ring of test points
+        self.valid_radius = max_radius
+        bearings = np.linspace(0, 2*np.pi, 16, endpoint=False)
+        while self.valid_radius > 1.0:
+            ring = self.valid_radius * np.column_stack((np.cos(bearings), np.sin(bearings)))
+            ring_latlon = self._fullToLatLon(ring)
+            forward_error = np.linalg.norm(
+                self._evaluate(self.forward_coefficients, ring_latlon) - ring, axis=1)
+            # Inverse error measured in meters, going back to UTM with the full conversion
+            inverse_error = np.linalg.norm(
+                self._fullToUtmOffset(self._evaluate(self.inverse_coefficients, ring)) - ring, axis=1)
+            if max(forward_error.max(), inverse_error.max()) <= max_error:
+                break
+            self.valid_radius /= 2
+
+    def _fullToUtmOffset(self, latlon_offset: np.ndarray) -> np.ndarray:
+        latlon = latlon_offset + np.array([self.anchor_lat, self.anchor_lon])
+        east, north, _, _ = utm.from_latlon(latlon[:, 0], latlon[:, 1],
+                                            force_zone_number=self.zone_number, force_zone_letter=self.zone_letter)
+
+        return np.column_stack((east - self.anchor_east, north - self.anchor_north))
+
+    def _fullToLatLon(self, utm_offset: np.ndarray) -> np.ndarray:
+        lat, lon = utmToLatLon(utm_e=utm_offset[:, 0] + self.anchor_east, utm_n=utm_offset[:, 1] + self.anchor_north,
+                               zn=self.zone_number, zl=self.zone_letter)
+
+        return np.column_stack((lat, lon)) - np.array([self.anchor_lat, self.anchor_lon])
+
+    @staticmethod
+    def _fitExpansion(function, step: float) -> np.ndarray:
+        """Second order expansion at the origin from central finite differences
+
+        Args:
+            function (callable): maps rows of 2D offsets to rows of 2D offsets, zero at the origin
+            step (float): finite difference step, in the input units
+
+        Returns:
+            np.ndarray: coefficients for [a, b, a^2, a*b, b^2], shape (5, 2)
+        """
+        h = step
+        samples = function(np.array([[h, 0], [-h, 0], [0, h], [0, -h], [h, h], [h, -h], [-h, h], [-h, -h], [0, 0]]))
+        f_ap, f_am, f_bp, f_bm, f_pp, f_pm, f_mp, f_mm, f_0 = samples
+
+        return np.array([(f_ap - f_am) / (2*h),
+                         (f_bp - f_bm) / (2*h),
+                         (f_ap - 2*f_0 + f_am) / (2*h**2),
+                         (f_pp - f_pm - f_mp + f_mm) / (4*h**2),
+                         (f_bp - 2*f_0 + f_bm) / (2*h**2)])
+
+    @staticmethod
+    def _evaluate(coefficients: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+        a = offsets[:, 0]
+        b = offsets[:, 1]
+
+        return np.column_stack((a, b, a*a, a*b, b*b)) @ coefficients
+
+    @staticmethod
+    def _evaluateScalar(coefficients: list, a: float, b: float) -> Tuple[float, float]:
+        # Plain float version for single points, where numpy call overhead dominates
+        (x1, y1), (x2, y2), (x3, y3), (x4, y4), (x5, y5) = coefficients
+        aa, ab, bb = a*a, a*b, b*b
+
+        return x1*a + x2*b + x3*aa + x4*ab + x5*bb, y1*a + y2*b + y3*aa + y4*ab + y5*bb
+
+    def toUtm(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """Converts latlon coordinates to UTM in the anchor zone
+
+        Args:
+            lat (float or np.ndarray): latitude(s)
+            lon (float or np.ndarray): longitude(s)
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: utm easting(s) and northing(s)
+        """
+        if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+            d_east, d_north = self._evaluateScalar(
+                self._forward_scalar, float(lat) - self.anchor_lat, float(lon) - self.anchor_lon)
+            if d_east*d_east + d_north*d_north <= self.valid_radius*self.valid_radius:
+                return self.anchor_east + d_east, self.anchor_north + d_north
+
+        latlon_offset = np.column_stack((np.ravel(lat), np.ravel(lon))) - np.array([self.anchor_lat, self.anchor_lon])
+        utm_offset = self._evaluate(self.forward_coefficients, latlon_offset)
+
+        # Points out of the valid radius use the full conversion
+        outside = np.hypot(utm_offset[:, 0], utm_offset[:, 1]) > self.valid_radius
+        if np.any(outside):
+            utm_offset[outside] = self._fullToUtmOffset(latlon_offset[outside])
+
+        east = utm_offset[:, 0] + self.anchor_east
+        north = utm_offset[:, 1] + self.anchor_north
+        if np.ndim(lat) == 0:
+            return east[0], north[0]
+
+        return east, north
+
+    def toLatLon(self, utm_e, utm_n) -> Tuple[np.ndarray, np.ndarray]:
+        """Converts UTM coordinates in the anchor zone to latlon
+
+        Args:
+            utm_e (float or np.ndarray): utm easting(s)
+            utm_n (float or np.ndarray): utm northing(s)
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: latitude(s) and longitude(s)
+        """
+        if np.ndim(utm_e) == 0 and np.ndim(utm_n) == 0:
+            d_east = float(utm_e) - self.anchor_east
+            d_north = float(utm_n) - self.anchor_north
+            if d_east*d_east + d_north*d_north <= self.valid_radius*self.valid_radius:
+                d_lat, d_lon = self._evaluateScalar(self._inverse_scalar, d_east, d_north)
+                return self.anchor_lat + d_lat, self.anchor_lon + d_lon
+
+        utm_offset = np.column_stack((np.ravel(utm_e) - self.anchor_east, np.ravel(utm_n) - self.anchor_north))
+        latlon_offset = self._evaluate(self.inverse_coefficients, utm_offset)
+
+        # Points out of the valid radius use the full conversion
+        outside = np.hypot(utm_offset[:, 0], utm_offset[:, 1]) > self.valid_radius
+        if np.any(outside):
+            latlon_offset[outside] = self._fullToLatLon(utm_offset[outside])
+
+        lat = latlon_offset[:, 0] + self.anchor_lat
+        lon = latlon_offset[:, 1] + self.anchor_lon
+        if np.ndim(utm_e) == 0:
+            return lat[0], lon[0]
+
+        return lat, lon
+
+
 def laserScanToXY(range: float, angle: float) -> np.ndarray:
-    """Converts a laser reading in range and angle to xy in baselink frame
+    """Converts a laser reading in range and angle to xy in baselink frame.
+    For whole scans, scan_lib.ScanGeometry.toXY converts every reading at once.
 
     Args:
         range (float): reading range [m]
@@ -68,7 +226,7 @@ def laserScanToXY(range: float, angle: float) -> np.ndarray:
     return np.array([x_baselink, y_baselink])
 
 
-def baselinkToWorld(xy_baselink: np.ndarray, current_lat: float, current_lon: float, current_yaw: float) -> Tuple[float, float]:
+def baselinkToWorld(xy_baselink: np.ndarray, current_lat: float, current_lon: float, current_yaw: float, projection: LocalProjection = None) -> Tuple[float, float]:
     """Converts coordinates from baselink frame [x, y] to global frame [latlon]
 
     Args:
@@ -76,10 +234,17 @@ def baselinkToWorld(xy_baselink: np.ndarray, current_lat: float, current_lon: fl
         current_lat (float): vehicle latitude in degrees
         current_lon (float): vehicle longitude in degrees
         current_yaw (float): current vehicle yaw angle [RAD]
+        projection (LocalProjection): optional local projection used instead of the full UTM conversion
 
     Returns:
         Tuple[float, float]: point latitude and longitude
     """
+    if projection is not None:
+        utm_east, utm_north = projection.toUtm(current_lat, current_lon)
+        world_R_baselink = rotationMatrix(angle=np.pi/2 - current_yaw)
+        utm_output = np.array([utm_east, utm_north]) + world_R_baselink @ xy_baselink
+        return projection.toLatLon(utm_output[0], utm_output[1])
+
     # Get current location from latlon to UTM coordinates
     utm_east, utm_north, zn, zl = latLonToUtm(
         lat=current_lat, lon=current_lon)
@@ -93,7 +258,7 @@ def baselinkToWorld(xy_baselink: np.ndarray, current_lat: float, current_lon: fl
     return utmToLatLon(utm_e=utm_output[0], utm_n=utm_output[1], zn=zn, zl=zl)
 
 
-def worldToBaselink(target_lat: float, target_lon: float, current_location_lat: float, current_location_lon: float, current_yaw: float) -> np.ndarray:
+def worldToBaselink(target_lat: float, target_lon: float, current_location_lat: float, current_location_lon: float, current_yaw: float, projection: LocalProjection = None) -> np.ndarray:
     """Converts a point from global frame [latitude and longitude] to baselink frame [x, y]
 
     Args:
@@ -102,16 +267,21 @@ def worldToBaselink(target_lat: float, target_lon: float, current_location_lat:
         current_location_lat (float): vehicle location latitude
         current_location_lon (float): vehicle location longitude
         current_yaw (float): vehicle yaw angle [RAD]
+        projection (LocalProjection): optional local projection used instead of the full UTM conversion
 
     Returns:
         np.ndarray: target point in baselink frame [x, ]
     """
-    # Get current location from latlon to UTM coordinates
-    utm_east, utm_north, _, _ = latLonToUtm(
-        lat=current_location_lat, lon=current_location_lon)
-    # Get the target location from latlon to UTM coordinates
-    utm_target_east, utm_target_north, _, _ = latLonToUtm(
-        lat=target_lat, lon=target_lon)
+    if projection is not None:
+        utm_east, utm_north = projection.toUtm(current_location_lat, current_location_lon)
+        utm_target_east, utm_target_north = projection.toUtm(target_lat, target_lon)
+    else:
+        # Get current location from latlon to UTM coordinates
+        utm_east, utm_north, _, _ = latLonToUtm(
+            lat=current_location_lat, lon=current_location_lon)
+        # Get the target location from latlon to UTM coordinates
+        utm_target_east, utm_target_north, _, _ = latLonToUtm(
+            lat=target_lat, lon=target_lon)
     # Calculate the offset from the current location to the target location in UTM frame
     d_utm = np.array([utm_target_east - utm_east,
                      utm_target_north - utm_north])
@@ -121,3 +291,76 @@ def worldToBaselink(target_lat: float, target_lon: float, current_location_lat:
     target_baselink_frame = baselink_R_world @ d_utm
 
     return target_baselink_frame
+
+
+def worldToBaselinkBatch(targets_latlon: np.ndarray, current_location_lat: float, current_location_lon: float, current_yaw: float, projection: LocalProjection = None) -> np.ndarray:
+    """Converts many points from global frame [latitude and longitude] to baselink frame [x, y] at once.
+    The vehicle location is converted to UTM only once, and the targets are projected in the same UTM zone.
+
+    Args:
+        targets_latlon (np.ndarray): target points as rows of [latitude, longitude], shape (N, 2)
+        current_location_lat (float): vehicle location latitude
+        current_location_lon (float): vehicle location longitude
+        current_yaw (float): vehicle yaw angle [RAD]
+        projection (LocalProjection): optional local projection used instead of the full UTM conversion
+
+    Returns:
+        np.ndarray: target points in baselink frame, shape (N, 2) as [x, y]
+    """
+    targets_latlon = np.asarray(targets_latlon, dtype=float).reshape(-1, 2)
+    if targets_latlon.shape[0] == 0:
+        return np.empty((0, 2))
+
+    if projection is not None:
+        utm_east, utm_north = projection.toUtm(current_location_lat, current_location_lon)
+        utm_targets_east, utm_targets_north = projection.toUtm(targets_latlon[:, 0], targets_latlon[:, 1])
+    else:
+        # Get current location from latlon to UTM coordinates, and use its zone for every target
+        utm_east, utm_north, zn, zl = latLonToUtm(
+            lat=current_location_lat, lon=current_location_lon)
+        utm_targets_east, utm_targets_north, _, _ = utm.from_latlon(
+            targets_latlon[:, 0], targets_latlon[:, 1], force_zone_number=zn, force_zone_letter=zl)
+    # Offsets from the current location to every target in UTM frame, one per row
+    d_utm = np.column_stack((utm_targets_east - utm_east, utm_targets_north - utm_north))
+    # Create rotation from world to baselink based on the current yaw and apply it to all rows
+    baselink_angle_world = current_yaw - np.pi/2
+    baselink_R_world = rotationMatrix(angle=baselink_angle_world)
+
+    return d_utm @ baselink_R_world.T
+
+
+def baselinkToWorldBatch(xy_baselink: np.ndarray, current_lat: float, current_lon: float, current_yaw: float, projection: LocalProjection = None) -> np.ndarray:
+    """Converts many points from baselink frame [x, y] to global frame [latlon] at once.
+    The vehicle location is converted to UTM only once and a single rotation is applied to all points.
+
+    Args:
+        xy_baselink (np.ndarray): points in baselink frame as rows of [x, y], shape (N, 2)
+        current_lat (float): vehicle latitude in degrees
+        current_lon (float): vehicle longitude in degrees
+        current_yaw (float): current vehicle yaw angle [RAD]
+        projection (LocalProjection): optional local projection used instead of the full UTM conversion
+
+    Returns:
+        np.ndarray: points as rows of [latitude, longitude], shape (N, 2)
+    """
+    xy_baselink = np.asarray(xy_baselink, dtype=float).reshape(-1, 2)
+    if xy_baselink.shape[0] == 0:
+        return np.empty((0, 2))
+
+    # Get current location from latlon to UTM coordinates
+    if projection is not None:
+        utm_east, utm_north = projection.toUtm(current_lat, current_lon)
+    else:
+        utm_east, utm_north, zn, zl = latLonToUtm(
+            lat=current_lat, lon=current_lon)
+    # Create rotation from baselink to world based on the current yaw and apply it to all rows
+    world_angle_baselink = np.pi/2 - current_yaw
+    world_R_baselink = rotationMatrix(angle=world_angle_baselink)
+    utm_output = np.array([utm_east, utm_north]) + xy_baselink @ world_R_baselink.T
+
+    if projection is not None:
+        lat, lon = projection.toLatLon(utm_output[:, 0], utm_output[:, 1])
+    else:
+        lat, lon = utmToLatLon(utm_e=utm_output[:, 0], utm_n=utm_output[:, 1], zn=zn, zl=zl)
+
+    return np.column_stack((lat, lon))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import json
+from collections import deque, namedtuple
+from contextlib import nullcontext
+from time import perf_counter
+from typing import Dict
+import numpy as np
+
+
+# Latency of a stage over the recent spans [s], count is the number of spans since the start
+StageStats = namedtuple("StageStats", ["count", "p50", "p95", "p99", "max"])
+
+# Returned by span while disabled, entering and leaving it does nothing
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    """Times one execution of a stage, from entering to leaving the with block"""
+
+    __slots__ = ("monitor", "stage", "start")
+
+    def __init__(self, monitor: "LatencyMonitor", stage: str) -> None:
+        self.monitor = monitor
+        self.stage = stage
+
+    def __enter__(self) -> "_Span":
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.monitor.record(self.stage, perf_counter() - self.start)
+
+
+class LatencyMonitor:
+    """Timing spans around the stages of the planning cycle, kept in a rolling window per stage for the latency
+    percentiles.
+
+    The spans measure computing time with perf_counter, also when the planner runs on a simulated clock. While
+    disabled, span returns a shared context that does nothing, so the instrumented code costs one attribute check per
+    stage. Spans may be recorded from several threads, like the scenario classification pool.
+    """
+
+    def __init__(self, window: int = 500, enabled: bool = False) -> None:
+        """
+        Args:
+            window (int): number of recent spans per stage kept for the percentiles
+            enabled (bool): record the spans
+        """
+        self.window = window
+        self.enabled = enabled
+        self._durations = {}  # recent durations per stage, in the order the stages were first seen [s]
+        self._counts = {}  # spans recorded per stage
+
+    def span(self, stage: str):
+        """Context that times a stage
+
+        Args:
+            stage (str): stage name
+
+        Returns:
+            context manager to use in a with statement
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage)
+
+    def record(self, stage: str, duration: float) -> None:
+        """Stores the duration of a stage measured elsewhere
+
+        Args:
+            stage (str): stage name
+            duration (float): stage duration [s]
+        """
+        if not self.enabled:
+            return
+        durations = self._durations.get(stage)
+        if durations is None:
+            durations = self._durations.setdefault(stage, deque(maxlen=self.window))
+        durations.append(duration)
+        self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    def reset(self) -> None:
+        self._durations.clear()
+        self._counts.clear()
+
+    def stats(self) -> Dict[str, StageStats]:
+        """Latency percentiles of every stage over its recent spans
+
+        Returns:
+            Dict[str, StageStats]: statistics per stage, in the order the stages were first seen
+        """
+        stats = {}
+        for stage, durations in list(self._durations.items()):
+            durations = np.array(durations)
+            if durations.size == 0:
+                continue
+            p50, p95, p99 = np.percentile(durations, (50, 95, 99))
+            stats[stage] = StageStats(self._counts[stage], p50, p95, p99, durations.max())
+
+        return stats
+
+    def report(self) -> str:
+        """Readable table of the stage statistics, in milliseconds"""
+        lines = [f"{'stage':<16} {'count':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  [ms]"]
+        for stage, stats in self.stats().items():
+            lines.append(f"{stage:<16} {stats.count:>8} {1000*stats.p50:>9.2f} {1000*stats.p95:>9.2f} "
+                         f"{1000*stats.p99:>9.2f} {1000*stats.max:>9.2f}")
+
+        return "\n".join(lines)
+
+    def writeReport(self, path: str, stamp: float) -> None:
+        """Appends the stage statistics to a JSON lines file
+
+        Args:
+            path (str): file path
+            stamp (float): report time [s]
+        """
+        stages = {stage: stats._asdict() for stage, stats in self.stats().items()}
+        with open(path, "a") as file:
+            file.write(json.dumps({"stamp": stamp, "stages": stages}) + "\n")
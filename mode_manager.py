@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Callable
+
+
+class RateCounter:
+    """Counts events and reports how many happened in a recent time window"""
+
+    def __init__(self, window: float = 60.0, clock: Callable[[], float] = monotonic) -> None:
+        """
+        Args:
+            window (float): time window for the rate [s]
+            clock (Callable[[], float]): time source [s]
+        """
+        self.window = window
+        self.clock = clock
+        self.total = 0
+        self._times = deque()
+
+    def record(self) -> None:
+        self.total += 1
+        self._times.append(self.clock())
+
+    def recent(self) -> int:
+        """Number of events in the last window"""
+        limit = self.clock() - self.window
+        while self._times and self._times[0] < limit:
+            self._times.popleft()
+
+        return len(self._times)
+
+
+class AvoidanceHysteresis:
+    """Debounces the decision to avoid obstacles, so the vehicle does not alternate GUIDED and AUTO on consecutive scans.
+
+    Entering and leaving use different conditions (the caller evaluates them with separate distance thresholds),
+    and each state must last a minimum dwell time before it can change, unless entering is urgent.
+    """
+
+    def __init__(self, min_avoid_dwell: float = 1.0, min_free_dwell: float = 0.3,
+                 clock: Callable[[], float] = monotonic) -> None:
+        """
+        Args:
+            min_avoid_dwell (float): minimum time avoiding before going back to the mission [s]
+            min_free_dwell (float): minimum time following the mission before avoiding again [s]
+            clock (Callable[[], float]): time source [s]
+        """
+        self.min_avoid_dwell = min_avoid_dwell
+        self.min_free_dwell = min_free_dwell
+        self.clock = clock
+        self.avoiding = False
+        self.since = -float('inf')  # time of the last state change [s]
+
+    def update(self, enter: bool, exit: bool, urgent: bool = False) -> bool:
+        """Updates the state with the conditions of this cycle
+
+        Args:
+            enter (bool): condition to start avoiding, with the entering thresholds
+            exit (bool): condition to stop avoiding, with the exit thresholds
+            urgent (bool): start avoiding now, ignoring the dwell time
+
+        Returns:
+            bool: True if we must be avoiding obstacles
+        """
+        now = self.clock()
+        dwell = now - self.since
+        if not self.avoiding and (urgent or (enter and dwell >= self.min_free_dwell)):
+            self.avoiding = True
+            self.since = now
+        elif self.avoiding and exit and dwell >= self.min_avoid_dwell:
+            self.avoiding = False
+            self.since = now
+
+        return self.avoiding
+
+
+class ModeTransitionManager:
+    """Asynchronous flight mode transitions.
+
+    A mode request is sent on a worker thread, so the caller keeps planning and publishing setpoints. The transition
+    is only confirmed when the vehicle state reports the new mode. Requests that are not confirmed within the timeout
+    are sent again, up to a maximum number of retries. onState runs on the state callback thread, while requestMode
+    and update run on the planner thread, so the transition state is guarded by a lock.
+    """
+
+    def __init__(self, send_request: Callable[[str], bool], timeout: float = 1.0, max_retries: int = 3,
+                 clock: Callable[[], float] = monotonic, log_info: Callable[[str], None] = print,
+                 log_error: Callable[[str], None] = print, service_calls: RateCounter = None) -> None:
+        """
+        Args:
+            send_request (Callable[[str], bool]): sends the mode change request, returns True if it was accepted
+            timeout (float): time to wait for the state confirmation before sending the request again [s]
+            max_retries (int): requests sent again after the first one before giving up
+            clock (Callable[[], float]): time source [s]
+            log_info (Callable[[str], None]): information logger
+            log_error (Callable[[str], None]): error logger
+            service_calls (RateCounter): counter for the requests sent, can be shared with other service calls
+        """
+        self.send_request = send_request
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.clock = clock
+        self.log_info = log_info
+        self.log_error = log_error
+
+        self.target_mode = None  # mode waiting for confirmation, None if no transition is pending
+        self.attempts = 0  # requests sent for the pending transition
+        self.request_time = None  # time the last request was sent [s]
+        self.transition_start = None  # time the pending transition started [s]
+        self.current_mode = None  # last mode reported by the vehicle state
+        self.service_calls = service_calls if service_calls is not None else RateCounter(clock=clock)
+        self.transitions = 0  # transitions started
+        self.transition_time = 0.0  # [s] total time spent waiting for transitions to be confirmed or abandoned
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mode_request")
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> bool:
+        return self.target_mode is not None
+
+    def requestMode(self, mode: str) -> None:
+        """Starts a transition to a mode without waiting for it, nothing is done if we are already there or going there
+
+        Args:
+            mode (str): mode name, either MANUAL, GUIDED or AUTO
+        """
+        with self._lock:
+            if mode == self.target_mode or (not self.pending and mode == self.current_mode):
+                return
+
+            self.target_mode = mode
+            self.attempts = 0
+            self.transition_start = self.clock()
+            self.transitions += 1
+            self.log_info(f"Changing navigation mode to {mode}...")
+            self._dispatch(mode)
+
+    def onState(self, mode: str) -> None:
+        """Vehicle state update, confirming the pending transition when it reports the target mode
+
+        Args:
+            mode (str): mode reported by the vehicle
+        """
+        with self._lock:
+            self.current_mode = mode
+            if self.pending and mode == self.target_mode:
+                self.log_info(f"Mode {mode} activated after {self.clock() - self.transition_start:.2f} s.")
+                self._finishTransition()
+
+    def update(self) -> None:
+        """Checks the pending transition timeout, sending the request again or giving up. Called every planning cycle."""
+        with self._lock:
+            if not self.pending or self.clock() - self.request_time < self.timeout:
+                return
+
+            if self.attempts > self.max_retries:
+                self.log_error(f"Mode {self.target_mode} not confirmed after {self.attempts} requests, giving up.")
+                self._finishTransition()
+                return
+
+            self.log_info(f"Mode {self.target_mode} not confirmed yet, sending the request again ...")
+            self._dispatch(self.target_mode)
+
+    # The methods below are called with the lock held
+
+    def _finishTransition(self) -> None:
+        self.transition_time += self.clock() - self.transition_start
+        self.target_mode = None
+        self.attempts = 0
+
+    def _dispatch(self, mode: str) -> None:
+        self.attempts += 1
+        self.request_time = self.clock()
+        self.service_calls.record()
+        self._executor.submit(self._send, mode)
+
+    def _send(self, mode: str) -> None:
+        # Runs on the worker thread, so a slow service never blocks the planner
+        try:
+            if not self.send_request(mode):
+                self.log_error(f"Mode change request to {mode} was not accepted.")
+        except Exception as e:
+            self.log_error(f"Failed to change navigation mode to {mode}: {e}")
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import signal
 import rospy
 from mavros_msgs.msg import State, GlobalPositionTarget, WaypointList, HomePosition, PositionTarget
 from mavros_msgs.srv import SetMode, WaypointSetCurrent, CommandTOL
@@ -7,76 +8,82 @@ from std_msgs.msg import Float64, Header
 from sensor_msgs.msg import LaserScan
 from geometry_msgs.msg import TwistStamped
 from visualization_msgs.msg import MarkerArray, Marker
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 import numpy as np
-from time import time
 from collision_lib import *
 from frame_convertions import *
 from log_debug import *
+from control_loop import LatestValueSlot, FixedRateLoop
+from mode_manager import ModeTransitionManager, RateCounter
+from avoidance_core import AvoidanceCore
+from replay import RecordingWriter
+from cycle_profiler import CycleProfiler
 from tf.transformations import euler_from_quaternion
 from nav_msgs.msg import Odometry
-import fuzzy_cbr
-import cbr
 
-class ObstacleAvoidance:
+class ObstacleAvoidance(AvoidanceCore):
     ############################################################################
     # region CONSTRUCTOR
     ############################################################################
-    def __init__(self) -> None:
+    def __init__(self, clock=None) -> None:
+        """
+        Args:
+            clock (WallClock or SimClock): time source for the whole node, by default the system clock
+        """
         rospy.init_node("obstacle_avoidance_node", anonymous=False)
+        super().__init__(log_info=rospy.loginfo, clock=clock)
 
         # Control the time when we last sent a guided point
-        self.last_command_time = time()
+        self.last_command_time = self.clock.now()
         # Variables
         self.current_yaw = 0.0  # [RAD]
         self.current_location = None  # GPS data
         self.current_state = State()  # vehicle driving mode
+        self.mode_manager = None  # asynchronous flight mode transitions, created with the set_mode service
         self.debug_mode = True  # debug mode to print more information
         self.home_waypoint = None  # home waypoint data, contains home lat and lon
+        self.local_projection = None  # fast UTM projection anchored at home, used for the frame conversions
+        self.projection_max_error = 0.001  # [meters] error accepted from the local projection fast path
         self.waypoints_list = None  # list of waypoints in the autonomous mission
+        self.waypoints_utm = None  # mission waypoints in UTM [east, north], computed once per mission and home
         self.current_waypoint_index = -1  # autonomous mission waypoint we are tracking
         self.current_target = None  # target waypoint data in AUTO mode
         self.previous_guided_point_angle = None  # [RAD]
 
-        # Parameters from obstacle avoidance algorithm
-        self.dt = 0.17  # Time step [s]
-        self.closest_obstacle_distance = 0
-        self.x = 0  # Actual x position from odometry
-        self.y = 0  # Actual y position from odometry
-        self.theta = 0  # Actual orientation from odometry
-        self.v = 0  # Actual linear velocity from odometry
-        self.w = 0  # Actual angular velocity from odometry
-        self.max_v = 2.55  # Maximum linear velocity 2.55
-        self.max_w = np.pi  # Maximum angular velocity np.pi/2
-        self.best_v = None  # Best linear velocity
-        self.best_w = None  # Best angular velocity
-        self.min_v = 0.0  # Minimum linear velocity
-        self.max_acc_v = 0.9 #0.5  # Maximum linear acceleration 0.5
-        self.max_acc_w = np.pi/2  # Maximum angular acceleration
-        self.safety_distance_to_start = 6.0  # [meters] 5
-        self.valid_ranges = None  # Lidar valid ranges
+        # Perception, DWA, fuzzy and CBR parameters are set in AvoidanceCore
+        self.service_calls = RateCounter(window=60.0, clock=self.clock.now)  # mavros service calls, for the calls per minute statistics
         self.next_waypoint_dist = 3.5  # [meters] 3
         self.lidar_subdivisions = []  # Subdivion of lidar field of view
         self.actual_lidar_subdivisions = []  # Actual lidar subdivisions values
         self.min_dist_lidar_subdivisions = []  # Minimum distance of lidar subdivisions
         self.waypoints_reached = 0  # Waypoints reached counter
 
-        self.v_reso = 12  # Linear velocity resolution 25
-        self.w_reso = 12  # Angular velocity resolution 25
-
-        self.alpha = 0  # Robot alignment to the objective
-        self.beta = 0  # Distance to the obstacle
-        self.gamma = 0  # Foward speed
-
-        self.angle_min = -2.268889904022217
-        self.angle_max = 2.268899917602539
-        self.goal_angle = 0
-
-        # CBR parameters
-        self.cbr = cbr.CBR()
-        self.scenario = None
-
-        # Fuzzy parameters
-        self.fuzzy = fuzzy_cbr.Fuzzy()
+        # Planning inputs recorded for the offline replay, written in segments when the ~recording_path parameter is set
+        self.recording_path = rospy.get_param("~recording_path", "") or None
+        self.recorder = RecordingWriter(self.recording_path, log_error=rospy.logerr) if self.recording_path else None
+
+        # Computing time of each stage of the planning cycle, published periodically on the diagnostics topic
+        self.latency.enabled = rospy.get_param("~latency_enabled", True)
+        self.latency_report_period = rospy.get_param("~latency_report_period", 5.0)  # [s]
+        # JSON lines file that also gets every report, if set
+        self.latency_log_path = rospy.get_param("~latency_log_path", "") or None
+        self.last_latency_report = self.clock.now()
+
+        # Profiling of the next planning cycles on demand, with SIGUSR1 or the ~profile_cycles parameter
+        self.profile_cycles = 50  # cycles captured for each SIGUSR1
+        self.profile_dir = rospy.get_param("~profile_dir", "profiles")  # relative paths start at ~/.ros under roslaunch
+        self.profiler = CycleProfiler(output_dir=self.profile_dir, thread_prefixes=("scenario",),
+                                      log_info=rospy.logwarn, log_error=rospy.logerr)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.profiler.request(self.profile_cycles))
+
+        # Planner thread, fed by the scan and odometry callbacks through latest-value slots
+        self.use_planner_thread = True  # if False, the whole planning runs inside laserScanCallback
+        self.planner_period = 0.1  # [s] planner loop period
+        self.max_scan_age = 0.3  # [s] scans older than this when the planner picks them are dropped
+        self.scan_slot = LatestValueSlot()
+        self.odom_slot = LatestValueSlot()
+        self.stale_scans = 0  # scans dropped for being too old
+        self.planner_loop = None
 
         # Subscribers to mavros and laserscan messages
         running_on_rover = False
@@ -112,17 +119,36 @@ class ObstacleAvoidance:
             '/obstacle_avoidance/goal_guided_point', MarkerArray, queue_size=1)
         self.robot_path_area_pub = rospy.Publisher(
             '/obstacle_avoidance/robot_path_area', Marker, queue_size=1)
+        self.diagnostics_pub = rospy.Publisher(
+            '/diagnostics', DiagnosticArray, queue_size=1)
 
         # Services
         rospy.wait_for_service('/mavros/set_mode')
         rospy.wait_for_service('/mavros/mission/set_current')
         rospy.wait_for_service('/mavros/cmd/command')
         self.set_mode_service = rospy.ServiceProxy('/mavros/set_mode', SetMode)
+        self.mode_manager = ModeTransitionManager(
+            send_request=lambda mode: self.set_mode_service(custom_mode=mode).mode_sent,
+            timeout=1.0, max_retries=3, clock=self.clock.now, log_info=rospy.logwarn, log_error=rospy.logerr,
+            service_calls=self.service_calls)
         self.set_current_wp_srv = rospy.ServiceProxy(
             '/mavros/mission/set_current', WaypointSetCurrent)
         self.command_tol_srv = rospy.ServiceProxy(
             '/mavros/cmd/command', CommandTOL)
 
+        if self.recorder is not None:
+            rospy.on_shutdown(self.recorder.close)
+
+        # The parameter server is only polled once per second, reading it every cycle would cost a master round trip
+        rospy.set_param("~profile_cycles", 0)
+        rospy.Timer(rospy.Duration(1.0), self.profilerParameterCallback)
+
+        if self.use_planner_thread:
+            self.planner_loop = FixedRateLoop(
+                self.planner_period, self.plannerStep, should_stop=rospy.is_shutdown,
+                clock=self.clock.now, sleep=self.clock.sleep, log_error=rospy.logerr)
+            self.planner_loop.start()
+
         rospy.loginfo("Obstacle avoidance node initialized.")
         rospy.spin()
 
@@ -132,36 +158,32 @@ class ObstacleAvoidance:
     ############################################################################
 
     def odomCallback(self, msg: Odometry) -> None:
-        """Receive odometry data and update robot position and orientation. 
+        """Receive odometry data and update robot position and orientation, or hand it to the planner thread.
+
+        Args:
+            msg (Odometry): Odometry message from mavros
+        """
+        if self.use_planner_thread:
+            self.odom_slot.put(msg, self.clock.now())
+        else:
+            self.applyOdometry(msg)
+
+    def applyOdometry(self, msg: Odometry) -> None:
+        """Update robot position, orientation and velocities from odometry data.
 
         Args:
             msg (Odometry): Odometry message from mavros
         """
         position = msg.pose.pose.position
         orientation = msg.pose.pose.orientation
-        self.x = position.x  # [meters]
-        self.y = position.y  # [meters]
         orientation_list = [orientation.x,
                             orientation.y, orientation.z, orientation.w]
         # Converte quaternionic orientation representation into Euler angles (X,Y,Z)
-        _, _, self.theta = euler_from_quaternion(orientation_list)  # [rad]
-        self.v = msg.twist.twist.linear.x  # [m/s]
-        self.w = msg.twist.twist.angular.z  # [rad/s]
-
-        current_time = msg.header.stamp.to_sec()
-
-        # rospy.loginfo(self.v)
+        _, _, theta = euler_from_quaternion(orientation_list)  # [rad]
 
-        # Calcula aceleração se houver uma velocidade anterior registrada
-        if hasattr(self, 'previous_velocity') and hasattr(self, 'previous_time'):
-            self.dt = current_time - self.previous_time
-            # if self.dt > 0:
-            #     self.acceleration = (self.v - self.previous_velocity) / self.dt
-            #     rospy.loginfo(self.acceleration)
-
-        # Armazena a velocidade e o tempo atuais para a próxima leitura
-        self.previous_velocity = self.v
-        self.previous_time = current_time
+        self.updateOdometry(position.x, position.y, theta,  # [meters], [meters], [rad]
+                            msg.twist.twist.linear.x, msg.twist.twist.angular.z,  # [m/s], [rad/s]
+                            msg.header.stamp.to_sec())
 
     def stateCallback(self, state: State) -> None:
         """Current vehicle driving state.
@@ -170,6 +192,9 @@ class ObstacleAvoidance:
             state (State): current vehicle driving state
         """
         self.current_state = state
+        # Confirm pending mode transitions
+        if self.mode_manager is not None:
+            self.mode_manager.onState(state.mode)
 
     def gpsCallback(self, data: NavSatFix) -> None:
         """Get GPS data.
@@ -208,6 +233,7 @@ class ObstacleAvoidance:
         """
         self.waypoints_list = data.waypoints
         if len(self.waypoints_list) == 0:
+            self.waypoints_utm = None
             return
 
         if self.home_waypoint:
@@ -219,6 +245,9 @@ class ObstacleAvoidance:
             self.waypoints_list[0].x_lat = self.home_waypoint.geo.latitude
             self.waypoints_list[0].y_long = self.home_waypoint.geo.longitude
 
+        # New mission, so the metric waypoints must be computed again
+        self.updateMissionCache()
+
         # If we are in GUIDED mode, no need to update the current target
         if self.current_state.mode == "GUIDED":
             return
@@ -250,9 +279,16 @@ class ObstacleAvoidance:
         # Set the home point so we know what to do if we are returning to launch
         if not self.home_waypoint:
             self.home_waypoint = data
+            self.local_projection = LocalProjection(
+                data.geo.latitude, data.geo.longitude, max_error=self.projection_max_error)
+            self.updateMissionCache()
         else:
             if self.home_waypoint.geo.latitude != data.geo.latitude or self.home_waypoint.geo.longitude != data.geo.longitude:
                 self.home_waypoint = data
+                self.local_projection = LocalProjection(
+                    data.geo.latitude, data.geo.longitude, max_error=self.projection_max_error)
+                # The projection anchor moved, so the metric waypoints must be computed again
+                self.updateMissionCache()
         if self.debug_mode and self.home_waypoint:
             rospy.logwarn(
                 f"Home waypoint set to {self.home_waypoint.geo.latitude}, {self.home_waypoint.geo.longitude}")
@@ -262,26 +298,13 @@ class ObstacleAvoidance:
     # region CONTROL FUNCTIONS
     ############################################################################
     def setFlightMode(self, mode: str) -> None:
-        """Set the flight mode we want to navigate with.
+        """Set the flight mode we want to navigate with, without waiting for the confirmation.
+        The transition is confirmed in stateCallback, and retried by the mode manager if it times out.
 
         Args:
             mode (str): mode name, either MANUAL, GUIDED or AUTO
         """
-        # If we are already in the right mode, don't do anything
-        if self.current_state.mode == mode:
-            return
-        try:
-            response = self.set_mode_service(custom_mode=mode)
-            if response.mode_sent:
-                rospy.logwarn(f"Changing navigation mode to {mode}...")
-                while self.current_state.mode != mode:
-                    response = self.set_mode_service(custom_mode=mode)
-                    rospy.logwarn(
-                        "Waiting for mode change request confirmation ...")
-                    rospy.sleep(0.1)
-                rospy.logwarn(f"Mode {mode} activated.")
-        except rospy.ServiceException as e:
-            rospy.logerr(f"Failed to change navigation mode to {mode}: {e}")
+        self.mode_manager.requestMode(mode)
 
     def advanceToNextWaypoint(self, index) -> None:
         """Advance to the next waypoint in the list."""
@@ -299,6 +322,7 @@ class ObstacleAvoidance:
         next_waypoint_index = index
 
         try:
+            self.service_calls.record()
             response = self.set_current_wp_srv(next_waypoint_index)
             if response.success:
                 rospy.logwarn(
@@ -353,24 +377,36 @@ class ObstacleAvoidance:
         # Publish message
         self.setpoint_local_pub.publish(guided_point_local_frame_msg)
 
+    def updateMissionCache(self) -> None:
+        """Convert the whole mission to UTM once, so each avoidance cycle only needs a subtraction and a rotation.
+        The cache is cleared while the mission or the home position are unknown.
+        """
+        self.waypoints_utm = None
+        if not self.waypoints_list or self.local_projection is None:
+            return
+
+        lat = np.array([waypoint.x_lat for waypoint in self.waypoints_list])
+        lon = np.array([waypoint.y_long for waypoint in self.waypoints_list])
+        self.waypoints_utm = np.column_stack(self.local_projection.toUtm(lat, lon))
+
     def targetWaypoint(self, standard=True):
         """Calculate the target waypoint in baselink frame.
         """
         try:
 
             if standard or self.waypoints_reached == 0:
-                lat = self.current_target.latitude
-                lon = self.current_target.longitude
+                target_utm = np.array(self.local_projection.toUtm(
+                    self.current_target.latitude, self.current_target.longitude))
             else:
-                lat = self.waypoints_list[self.current_waypoint_index +
-                                        self.waypoints_reached].x_lat
-                lon = self.waypoints_list[self.current_waypoint_index +
-                                        self.waypoints_reached].y_long
+                # Mission waypoints are already in UTM
+                target_utm = self.waypoints_utm[self.current_waypoint_index +
+                                                self.waypoints_reached]
 
-            goal_baselink_frame = worldToBaselink(
-                target_lat=lat, target_lon=lon,
-                current_location_lat=self.current_location.latitude, current_location_lon=self.current_location.longitude,
-                current_yaw=self.current_yaw)
+            # Offset from the vehicle to the target, rotated from world to baselink based on the current yaw
+            current_utm = np.array(self.local_projection.toUtm(
+                self.current_location.latitude, self.current_location.longitude))
+            baselink_R_world = rotationMatrix(angle=self.current_yaw - np.pi/2)
+            goal_baselink_frame = baselink_R_world @ (target_utm - current_utm)
 
             goal_distance = np.linalg.norm(goal_baselink_frame)  # [m]
             goal_angle = np.degrees(np.arctan2(
@@ -381,298 +417,95 @@ class ObstacleAvoidance:
         except:
             return 0, 0
 
-    # endregion
-    ############################################################################
-    # region AVOIDANCE METHODS
-    ############################################################################
-
-    def dynamicWindow(self):
-        """Calculate dynamic window obtaining the possible velocities for the next interval of time. 
-
-        Returns:
-            min_v (float): minimal linear velocity,
-            max_v (float): maximal linear velocity,
-            min_w (float): minimal angular velocity,
-            max_w (float): maximal angular velocity."""
-
-        # Calculate dynamic window
-        min_v = max(self.min_v, self.v - self.max_acc_v * self.dt) # The second part simulates the maximum deceleration
-        max_v = min(self.max_v, self.v + self.max_acc_v * self.dt) # The second part simulates the maximum acceleration
-        min_w = max(-self.max_w, self.w - self.max_acc_w * self.dt)
-        max_w = min(self.max_w, self.w + self.max_acc_w * self.dt)
-
-        return min_v, max_v, min_w, max_w
-
-    def dynamicWindowSafetyStop(self, dist_obst, w):
-        """
-        Calculate dynamic window to ensure that the robot can stop in time to avoid a collision.
-        Based on dynamic restriction.
-
-        Args:
-            dist_obst (float): distance to the closest obstacle.
-            w (float): angular velocity.
-        Returns:
-            safe_v_max (float): maximal linear velocity to stop in time,
-            safe_w_max (float): maximal angular velocity to stop in time."""
-
-        safe_v_max = min(np.sqrt(2 * dist_obst * self.max_acc_v), self.max_v)
-        safe_w_max = np.sign(w) * np.sqrt(2 * dist_obst * self.max_acc_w)
-
-        # Guarantees that the velocities are within the robot limits
-        safe_w_max = np.clip(safe_w_max, -self.max_w, self.max_w)
-
-        return safe_v_max, safe_w_max
-
-    def getFovIndexFromTheta(self, theta):
-        """
-        Convert an angle (theta) in relation to the global frame to the Lidar index.
-
-        Args:
-            theta: the angle in relation to the global frame (in radians).
-
-        Returns:
-            The corresponding index in the Lidar field of view.
-        """
-        angle_min = self.angle_min  # Assume that the Lidar has a 260 degree FOV 
-        angle_max = self.angle_max
-        num_readings = len(self.valid_ranges)
-
-        # Convert angle to the corresponding index in the Lidar
-        fov_index = int((theta - angle_min) /
-                (angle_max - angle_min) * num_readings)
-
-        # Guarantees that the index is within the array limits
-        fov_index = np.clip(fov_index, 0, num_readings - 1)
-
-        return fov_index
-
-    def objectiveFunction(self, min_v, max_v, min_w, max_w):
-        """Objective function to be maximazed.
-        Args:
-            min_v (float): minimal linear velocity,
-            max_v (float): maximal linear velocity,
-            min_w (float): minimal angular velocity,
-            max_w (float): maximal angular velocity.
-        Returns:
-            best_v (float): best linear velocity,
-            best_w (float): best angular velocity."""
-
-        max_cost = -float('inf')  # Initialize cost with negative infinity
-        best_v, best_w = 0, 0
-
-        if np.isinf(self.closest_obstacle_distance):
-            dist_obst = 1000
-        else:
-            dist_obst = self.closest_obstacle_distance
-
-        # Change angle from rad to degree just for the fuzzy logic
-        obstacle_angle = np.degrees(self.obstacle_angle)
-
-        # Apply fuzzy logic to discover alpha, beta and gamma
-        self.alpha, self.beta, self.gamma = self.fuzzy.IsolatedObstacle(obstacle_angle, dist_obst)
-
-        for v in np.linspace(min_v, max_v, num=self.v_reso):
-            for w in np.linspace(min_w, max_w, num=self.w_reso):
-
-                # Preview the new robot orientation (theta) after applying w
-                theta_real = w * self.dt # Robot body frame
-                theta_next = self.theta + theta_real # Robot global frame
-
-                # Find the corresponding direction in the Lidar field of view
-                fov_index = self.getFovIndexFromTheta(theta_real)
-
-                # Obtain the distance to the obstacle in that direction
-                dist_obst = self.valid_ranges[fov_index]
-
-                # If no obstacle is on the curvature, this value is set to a large constant
-                if np.isinf(dist_obst):
-                    dist_obst = self.safety_distance_to_start #1000
-
-                else:
-                    safe_v_max, safe_w_max = self.dynamicWindowSafetyStop(
-                        dist_obst, w)
-                    
-                    if safe_w_max > 0 and w > 0:
-
-                        if safe_v_max < v or safe_w_max < w:
-                            continue
-                    else:
-                        if safe_v_max < v or safe_w_max > w:
-                            continue
-
-                cost = self.alpha * \
-                    self.headingCost(theta_next) + self.beta * \
-                    dist_obst + self.gamma * v
-
-                if cost > max_cost:
-
-                    max_cost = cost
-                    best_v, best_w = v, w
-
-        return best_v, best_w
-
-    def headingCost(self, theta_next):
-        """Evaluate the alignment of the robot with the goal.
-
-        Args:
-            v (float): linear velocity,
-            w (float): angular velocity.
-        Returns:
-            angle (float): angle between the robot heading and the goal angle."""
-        
-        # Calculate the goal angle in the global frame
-        goal_angle_global = np.deg2rad(self.goal_angle)
-
-        # Diference between test angle and heading
-        angle_diff = theta_next - goal_angle_global
-
-        # This is necessary to find the smallest angle
-        angle_diff = angle_diff % (2 * np.pi)
-        if angle_diff > np.pi:
-            angle_diff -= 2 * np.pi
-
-        angle = np.abs(angle_diff)
-        angle = np.pi - angle
-
-        return angle
-
-    def replanVelocity(self):
-        """Method to plan dynamic route.
-
-        Returns:
-            best_v (float): best linear velocity,
-            best_w (float): best angular velocity."""
-
-        min_v, max_v, min_w, max_w = self.dynamicWindow()
-
-        best_v, best_w = self.objectiveFunction(min_v, max_v, min_w, max_w)
-
-        best_v = min(best_v, self.max_v)
-        best_w = np.clip(best_w, -self.max_w, self.max_w)
-
-        return best_v, best_w
-
-    def closestObstacleInCentralFov(self, fov_positions=160, center_index=320):
-        """
-        Return the distance of the closest obstacle in the robot's central field of view (degrees)
-        and its angle relative to the LIDAR.
-
-        Args:
-            fov_positions: Number of positions in the central field of view.
-            center_index: Central index of the Lidar readings list (approximately 320).
-
-        Returns:
-            Distance of the closest obstacle in the central field of view, or float('inf') if no obstacles are detected.
-        """
-
-        # New index for the angle range considered
-        half_fov = fov_positions // 2
-        start_index = center_index - half_fov
-        end_index = center_index + half_fov
-
-        # Get the distances within the central field of view
-        central_fov_distances = self.valid_ranges[start_index:end_index]
-
-        min_distance = min(central_fov_distances)
-        min_index = np.argmin(central_fov_distances)
-
-        # Calculate the relative angle between the robot and the closest obstacle
-        angle_increment = (
-            self.angle_max - self.angle_min) / len(self.valid_ranges)
-        obstacle_angle = ( (start_index + min_index) - 
-                            center_index) * angle_increment
-
-        if min_distance == float('inf'):
-            return 1000, obstacle_angle
-
-        return min_distance, obstacle_angle
-
-    def averageFilter(self, window_size=10):
+    def reportLatency(self) -> None:
+        """Publish the latency percentiles of each planning stage on the diagnostics topic, once per report period.
+        Stages whose p95 exceeds the planner time step are reported with a warning level.
         """
-        Apply average filter to smooth Lidar distance readings.
+        now = self.clock.now()
+        if not self.latency.enabled or now - self.last_latency_report < self.latency_report_period:
+            return
+        self.last_latency_report = now
+
+        diagnostics = DiagnosticArray()
+        diagnostics.header.stamp = rospy.Time.now()
+        for stage, stats in self.latency.stats().items():
+            status = DiagnosticStatus()
+            status.level = DiagnosticStatus.WARN if stats.p95 > self.dt else DiagnosticStatus.OK
+            status.name = f"obstacle_avoidance/latency/{stage}"
+            status.message = f"p95 {1000*stats.p95:.1f} ms"
+            status.values = [KeyValue(key="count", value=str(stats.count))] + [
+                KeyValue(key=f"{key} [ms]", value=f"{1000*getattr(stats, key):.3f}") for key in ("p50", "p95", "p99", "max")]
+            diagnostics.status.append(status)
+        self.diagnostics_pub.publish(diagnostics)
+
+        if self.latency_log_path:
+            self.latency.writeReport(self.latency_log_path, diagnostics.header.stamp.to_sec())
+
+    def profilerParameterCallback(self, event) -> None:
+        """Start a profile when ~profile_cycles is set to a number of cycles, then set it back to 0.
 
         Args:
-            window_size: Size of the moving average window.
-
-        Returns:
-            Readings of smoothed distance.
+            event (rospy.TimerEvent): timer information, not used
         """
+        num_cycles = rospy.get_param("~profile_cycles", 0)
+        if num_cycles > 0:
+            self.profiler.request(num_cycles)
+            rospy.set_param("~profile_cycles", 0)
 
-        # The moving average window should be normalized by dividing by the window size
-        kernel = np.ones(window_size) / window_size
-
-        # Apply the moving average filter
-        smoothed_ranges = np.convolve(self.valid_ranges, kernel, mode='same')
-
-        return smoothed_ranges
-    
+    # endregion
     ############################################################################
-    # region AUXILIARY FUNCTIONS
+    # region MAIN CONTROL LOOP CALLBACK
     ############################################################################
 
-    def CBRAnalysis(self, main_dt):
-        """
-        Perform the CBR analysis to adjust the solution.
-        
-        Args:
-            main_dt (float): Main time step.
-
-        Returns:
-            str: Case status (New case or Old case).
-        """
-        
-        # Retrive case information
-        case = self.cbr.Retrieve(self.closest_obstacle_distance, self.obstacle_angle, self.scenario)
-
-        # If there is no similar case
-        if case is None:
-
-            print("No similar case")
-
-            return "New case"
-        
-        v_case = case[4]
-        w_case = case[5]
-
-        # Revise and adjust new solution after DWA and Fuzzy
-        new_v, new_w, situation = self.cbr.Revise(self.closest_obstacle_distance, self.best_v, self.best_w, v_case, w_case, main_dt)
-
-        # If the new solution is better then the case one, update velocities
-        if new_v is not None and new_w is not None:
-            
-            self.best_v = new_v
-            self.best_w = new_w
-
-            print("Modified case")
-
-            return situation
-
-        else:
-
-            print("New case")
-
-            return situation
+    def laserScanCallback(self, scan) -> None:
+        """Receive a Lidar scan and plan with it, or hand it to the planner thread.
 
-    def AdjustLaserScan(self, scan):
-        """
-        Adjust the Lidar scan data before processing it.
-        
         Args:
             scan (LaserScan): Lidar scan data.
         """
+        if self.use_planner_thread:
+            self.scan_slot.put(scan, self.clock.now())
+        else:
+            with self.profiler.cycle(), self.latency.span("cycle"):
+                self.planningCycle(scan)
+            self.reportLatency()
+
+    def plannerStep(self) -> None:
+        """One cycle of the planner thread: use the latest odometry and scan, dropping the scan if it is stale."""
+        odom = self.odom_slot.take()
+        if odom is not None:
+            self.applyOdometry(odom[0])
+
+        planned = False
+        latest_scan = self.scan_slot.take()
+        if latest_scan is not None:
+            scan, received_time = latest_scan
+            if self.clock.now() - received_time > self.max_scan_age:
+                self.stale_scans += 1
+            else:
+                with self.profiler.cycle(), self.latency.span("cycle"):
+                    self.planningCycle(scan)
+                planned = True
 
-        # Make sure the scan values are valid before doing any math
-        self.valid_ranges = np.array(scan.ranges)
-        self.valid_ranges[self.valid_ranges == 0] = 1e6
-
-        # Apply average filter to smooth the Lidar readings and reduce noise
-        self.valid_ranges = self.averageFilter(window_size=5)
-
-    ############################################################################
-    # region MAIN CONTROL LOOP CALLBACK
-    ############################################################################
+        # Keep the setpoint stream at the loop rate while avoiding, even when no new scan was planned
+        if not planned and self.avoidance_hysteresis.avoiding and self.best_v is not None \
+                and self.current_state.mode == "GUIDED":
+            with self.latency.span("publishing"):
+                self.sendGuidedPointLocalFrame(self.best_v, self.best_w)
+        self.reportLatency()
 
-    def laserScanCallback(self, scan) -> None:
+        if self.debug_mode:
+            mean_jitter, max_jitter = self.planner_loop.jitterStats()
+            rospy.loginfo_throttle(
+                10, f"Planner loop: {self.planner_loop.cycles} cycles, jitter mean {1000*mean_jitter:.1f} ms max {1000*max_jitter:.1f} ms, "
+                f"{self.planner_loop.overruns} overruns, {self.planner_loop.failures} failed, dropped scans: {self.scan_slot.overwritten} overwritten, {self.stale_scans} stale")
+            rospy.loginfo_throttle(
+                10, f"Mode switching: {self.service_calls.recent()} service calls in the last minute, "
+                f"{self.mode_manager.transitions} transitions, {self.mode_manager.transition_time:.2f} s in transitions")
+            rospy.loginfo_throttle(
+                10, f"Scenario classification skipped in {100*self.cbr.change_detector.skip_rate:.0f}% of the scans")
+
+    def planningCycle(self, scan) -> None:
         """ 
         We use lidar points to define obstacle in baselink frame and find the available path that is the closest to the waypoint we should travel to.
         We work with two main frames: baselink and world
@@ -681,108 +514,69 @@ class ObstacleAvoidance:
         World: latlon, so X (lat) points up and Y (lon) points to the right. 0~360 degrees, clockwise, 0 is in positive X 
         """
 
+        # Resend or give up mode requests that were not confirmed in time
+        with self.latency.span("mode_switching"):
+            self.mode_manager.update()
+
         # Avoiding the callback if the conditions are not met
         if not scan.ranges or self.current_state.mode == "MANUAL" or not self.current_target or not self.current_location or not self.home_waypoint:
             return
 
-        # Adjust laser scan data
-        self.AdjustLaserScan(scan)
-
         # If we are in AUTO mode we must reset the previous guided point angle
         if self.current_state.mode == "AUTO":
             self.previous_guided_point_angle = None
 
-        # Verify the distance to the closest obstacle for 60 degrees in front of the robot
-        closest_in_fov_60, obstacle_angle_60 = self.closestObstacleInCentralFov(
-            fov_positions=148)
-
-        # # Verify the distance to the closest obstacle for 260 degrees in front of the robot
-        # closest_in_fov_260, obstacle_angle_260 = self.closestObstacleInCentralFov(
-        #     fov_positions=640)
-        
-        # Verify the distance to the closest obstacle for 260 degrees in front of the robot
-        closest_in_fov_180, obstacle_angle_180 = self.closestObstacleInCentralFov(
-            fov_positions=443)
-
-        if closest_in_fov_60 > self.safety_distance_to_start:
-            closest_in_fov = closest_in_fov_180
-            self.obstacle_angle = obstacle_angle_180
-            safety_distance = 2.5
-            fov = 443
-
-        else:
-            # Minimun distance to start the avoidance behavior
-            closest_in_fov = closest_in_fov_60
-            self.obstacle_angle = obstacle_angle_60
-            safety_distance = self.safety_distance_to_start
-            fov = 148
-
-        # Apply DBSCAN to find clusters and classify the scenario
-        self.scenario = self.cbr.FindScenario(self.valid_ranges, self.v, time(), fov_positions=fov)
+        stamp = self.clock.now()
+        if self.recorder is not None:
+            self.recorder.add(stamp, scan, (self.x, self.y, self.theta, self.v, self.w), self.goal_angle, self.dt)
 
-        if closest_in_fov < safety_distance:
-            self.closest_obstacle_distance = closest_in_fov
-
-            # REPLAN VELOCITY - DWA
-            self.best_v, self.best_w = self.replanVelocity()
-
-            main_dt = time() - self.last_command_time
-
-            if main_dt >= self.dt:
-
-                rospy.loginfo(
-                    f"BEFORE CBR -> Best v: {self.best_v} m/s, Best w: {self.best_w} rad/s")
-                
-                # CBR Analysis
-                case = self.CBRAnalysis(main_dt)
-
-                # Adjust velocities
-                self.best_v = min(self.best_v, self.max_v)
-                self.best_w = np.clip(self.best_w, -self.max_w, self.max_w)
+        # Perception, DWA, fuzzy and CBR
+        decision = self.planAvoidance(scan, stamp)
 
+        if decision.command:
+            with self.latency.span("mode_switching"):
                 self.setFlightMode(mode="GUIDED")
+            with self.latency.span("publishing"):
                 self.sendGuidedPointLocalFrame(
                     self.best_v, self.best_w)
-                self.last_command_time = time()
-
-                # Retain performed obstacle avoidance
-                self.cbr.Retain(case, self.closest_obstacle_distance, self.obstacle_angle, self.scenario, self.best_v, self.best_w)
 
-                # Results conference
-                rospy.loginfo(
-                    f"obst_dist: {self.closest_obstacle_distance} m, obstacle_angle: {self.obstacle_angle} degrees")
-                rospy.loginfo(
-                    f"Alpha: {self.alpha}, Beta: {self.beta}, Gamma: {self.gamma}")
-                rospy.loginfo(
-                    f"Best v: {self.best_v} m/s, Best w: {self.best_w} rad/s")
-                rospy.loginfo(
-                    " ")
+            # Results conference
+            rospy.loginfo(
+                f"obst_dist: {self.closest_obstacle_distance} m, obstacle_angle: {self.obstacle_angle} degrees")
+            rospy.loginfo(
+                f"Alpha: {self.alpha}, Beta: {self.beta}, Gamma: {self.gamma}")
+            rospy.loginfo(
+                f"Best v: {self.best_v} m/s, Best w: {self.best_w} rad/s")
+            rospy.loginfo(
+                " ")
 
-                self.goal_distance, self.goal_angle = self.targetWaypoint(
-                    False)
-                
-                if self.goal_distance == 0 and self.goal_angle == 0:
-                    return
+            self.goal_distance, self.goal_angle = self.targetWaypoint(
+                False)
+            
+            if self.goal_distance == 0 and self.goal_angle == 0:
+                return
 
-                if self.goal_distance < self.next_waypoint_dist:
+            if self.goal_distance < self.next_waypoint_dist:
 
-                    self.waypoints_reached += 1
-                    rospy.loginfo(
-                        f"Waypoint counted {self.waypoints_reached}.")
+                self.waypoints_reached += 1
+                rospy.loginfo(
+                    f"Waypoint counted {self.waypoints_reached}.")
 
-        else:
+        elif not decision.avoiding:
             # Verify if the path is completely free ahead and on the sides, if so, finish the obstacle avoidance
-            if time() - self.last_command_time > 1.1*self.dt and self.current_state.mode != "AUTO" and closest_in_fov_180 > 2.5 and closest_in_fov_60 > self.safety_distance_to_start:
+            if self.clock.now() - self.last_command_time > 1.1*self.dt and self.current_state.mode != "AUTO" and self.mode_manager.target_mode != "AUTO":
                 self.best_v = None
                 self.best_w = None
                 self.lidar_subdivisions = []
 
                 rospy.logwarn("Obstacle avoidance finished.")
-                self.setFlightMode(mode="AUTO")
+                with self.latency.span("mode_switching"):
+                    self.setFlightMode(mode="AUTO")
 
                 if self.waypoints_reached != 0:
-                    self.advanceToNextWaypoint(
-                        self.current_waypoint_index + self.waypoints_reached)
+                    with self.latency.span("mode_switching"):
+                        self.advanceToNextWaypoint(
+                            self.current_waypoint_index + self.waypoints_reached)
                     rospy.loginfo(
                         f"Next waypoint to go: {self.current_waypoint_index}.")
                     self.waypoints_reached = 0
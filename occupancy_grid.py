@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import Tuple
+from scan_lib import ScanGeometry
+
+
+class RollingOccupancyGrid:
+    """Bounded occupancy grid centred on the robot, in the odometry frame.
+
+    The grid keeps obstacles that already left the Lidar field of view. Its memory footprint is fixed: when the robot
+    moves, the grid scrolls and the cells that leave it are forgotten.
+    """
+
+    def __init__(self, size: int = 200, resolution: float = 0.1, log_odds_hit: float = 0.85, log_odds_miss: float = -0.4,
+                 log_odds_limit: float = 3.5, occupied_threshold: float = 0.5) -> None:
+        """Preallocates the grid
+
+        Args:
+            size (int): number of cells on each side of the grid
+            resolution (float): cell side [m]
+            log_odds_hit (float): log odds added to a cell where a beam ended
+            log_odds_miss (float): log odds added to a cell crossed by a beam
+            log_odds_limit (float): cells are clamped to [-limit, limit], so they can change state quickly
+            occupied_threshold (float): log odds above which a cell is considered occupied
+        """
+        self.size = size
+        self.resolution = resolution
+        self.log_odds_hit = log_odds_hit
+        self.log_odds_miss = log_odds_miss
+        self.log_odds_limit = log_odds_limit
+        self.occupied_threshold = occupied_threshold
+        self.log_odds = np.zeros((size, size), dtype=np.float32)
+        self.origin_cell = np.array([-(size // 2), -(size // 2)])  # odometry cell of grid cell [0, 0]
+
+        # Scratch masks reused every update
+        self._free_mask = np.zeros(size * size, dtype=bool)
+        self._hit_mask = np.zeros(size * size, dtype=bool)
+
+    @property
+    def max_range(self) -> float:
+        """Distance from the robot to the closest grid border, after scrolling [m]"""
+        return (self.size // 2 - 1) * self.resolution
+
+    def scrollTo(self, x: float, y: float) -> None:
+        """Moves the grid so the robot is in the central cell, clearing the cells that enter the grid
+
+        Args:
+            x (float): robot x position in odometry frame [m]
+            y (float): robot y position in odometry frame [m]
+        """
+        robot_cell = np.floor(np.array([x, y]) / self.resolution).astype(int)
+        shift = robot_cell - (self.origin_cell + self.size // 2)
+        if not np.any(shift):
+            return
+
+        self.origin_cell += shift
+        if np.any(np.abs(shift) >= self.size):
+            self.log_odds.fill(0)
+            return
+
+        self.log_odds = np.roll(self.log_odds, shift=(-shift[0], -shift[1]), axis=(0, 1))
+        # Cells that wrapped around are new space, so they are unknown
+        if shift[0] > 0:
+            self.log_odds[-shift[0]:, :] = 0
+        elif shift[0] < 0:
+            self.log_odds[:-shift[0], :] = 0
+        if shift[1] > 0:
+            self.log_odds[:, -shift[1]:] = 0
+        elif shift[1] < 0:
+            self.log_odds[:, :-shift[1]] = 0
+
+    def _cellIndices(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Flat grid indices of points in odometry frame, and the mask of points inside the grid"""
+        cells = np.floor(points / self.resolution).astype(int) - self.origin_cell
+        inside = np.all((cells >= 0) & (cells < self.size), axis=-1)
+
+        return cells[..., 0] * self.size + cells[..., 1], inside
+
+    def update(self, ranges: np.ndarray, geometry: ScanGeometry, x: float, y: float, theta: float) -> None:
+        """Inserts one scan, marking the cells crossed by each beam as free and the cells where beams ended as occupied.
+        All rays are traced at once, sampled with the grid resolution.
+
+        Args:
+            ranges (np.ndarray): Lidar readings [m], inf, 0 or >= 1e6 for beams with no return, NaN or negative for
+                invalid readings
+            geometry (ScanGeometry): geometry of the readings
+            x (float): robot x position in odometry frame [m]
+            y (float): robot y position in odometry frame [m]
+            theta (float): robot yaw in odometry frame [RAD]
+        """
+        self.scrollTo(x, y)
+
+        ranges = np.asarray(ranges, dtype=float)
+        # Invalid readings carry no information, beams with no return are free up to the grid limit, so obstacles that
+        # moved away or left the view decay
+        valid = ranges >= 0
+        hit = valid & (ranges > 0) & (ranges <= self.max_range)
+        free_length = np.where(hit, ranges, self.max_range)[valid]
+        angles = theta + geometry.angles[valid]
+        directions = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+
+        # Free space along every ray, stopping one cell before the hit
+        steps = np.arange(0, self.max_range, self.resolution)
+        free_samples = steps[None, :] < (free_length[:, None] - self.resolution)
+        ray_points = np.array([x, y]) + steps[None, :, None] * directions[:, None, :]
+        free_indices, inside = self._cellIndices(ray_points)
+        self._free_mask[free_indices[free_samples & inside]] = True
+
+        hit_points = np.array([x, y]) + ranges[valid][hit[valid], None] * directions[hit[valid]]
+        hit_indices, inside = self._cellIndices(hit_points)
+        self._hit_mask[hit_indices[inside]] = True
+
+        log_odds = self.log_odds.reshape(-1)
+        log_odds[self._free_mask & ~self._hit_mask] += self.log_odds_miss
+        log_odds[self._hit_mask] += self.log_odds_hit
+        np.clip(log_odds, -self.log_odds_limit, self.log_odds_limit, out=log_odds)
+
+        self._free_mask.fill(False)
+        self._hit_mask.fill(False)
+
+    def occupiedPoints(self, x: float, y: float, theta: float) -> np.ndarray:
+        """Centres of the occupied cells in baselink frame, ready for collision_lib
+
+        Args:
+            x (float): robot x position in odometry frame [m]
+            y (float): robot y position in odometry frame [m]
+            theta (float): robot yaw in odometry frame [RAD]
+
+        Returns:
+            np.ndarray: occupied cell centres [x, y] in baselink frame, shape (N, 2)
+        """
+        cells = np.argwhere(self.log_odds > self.occupied_threshold)
+        points = (cells + self.origin_cell + 0.5) * self.resolution - np.array([x, y])
+        ct, st = np.cos(theta), np.sin(theta)
+
+        return points @ np.array([[ct, -st], [st, ct]])
+
+    def rayClearance(self, x: float, y: float, angles: np.ndarray, max_range: float = None) -> np.ndarray:
+        """Distance to the first occupied cell along several directions, all rays traced at once
+
+        Args:
+            x (float): ray origin x in odometry frame [m]
+            y (float): ray origin y in odometry frame [m]
+            angles (np.ndarray): ray directions in odometry frame [RAD]
+            max_range (float): rays are traced up to this distance, by default up to the grid limit [m]
+
+        Returns:
+            np.ndarray: clearance per direction [m], inf if no occupied cell was found
+        """
+        if max_range is None:
+            max_range = self.max_range
+        angles = np.asarray(angles, dtype=float)
+        steps = np.arange(self.resolution, max_range, self.resolution)
+        directions = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+        ray_points = np.array([x, y]) + steps[None, :, None] * directions[..., None, :]
+
+        indices, inside = self._cellIndices(ray_points)
+        occupied = inside & (self.log_odds.reshape(-1)[np.where(inside, indices, 0)] > self.occupied_threshold)
+        first = np.argmax(occupied, axis=-1)
+
+        return np.where(np.any(occupied, axis=-1), steps[first], np.inf)
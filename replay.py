@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import traceback
+from collections import Counter, namedtuple
+from time import perf_counter
+from typing import Callable, List
+import numpy as np
+from clock import SimClock
+
+
+# Decisions of a replay, one row per scan: [avoiding, command, v, w], NaN velocities while nothing was planned.
+# cycle_times holds the computing time of each planning cycle [s]
+ReplayResult = namedtuple("ReplayResult", ["decisions", "scenarios", "elapsed", "decisions_per_second", "cycle_times"])
+
+
+class RecordingWriter:
+    """Records the planning inputs of the live node, as compressed npz segments of a fixed number of frames.
+
+    Each frame holds a scan, the odometry state and the goal angle the planner used with it. All scans of a
+    recording must have the same beam count. Full segments are written by a background thread, so the memory stays
+    bounded over long missions and a crash only loses the frames of the segment being filled. The segments of a
+    recording at path "name.npz" are "name_0000.npz", "name_0001.npz" and so on, and loadRecording joins them.
+    """
+
+    def __init__(self, path: str, segment_frames: int = 300, max_queued_segments: int = 4,
+                 log_error: Callable[[str], None] = print) -> None:
+        """
+        Args:
+            path (str): recording path, the segments are numbered after it
+            segment_frames (int): frames per segment, and frames held in memory while a segment fills
+            max_queued_segments (int): full segments waiting to be written, further segments are dropped while the
+                disk is behind, so the memory never holds more than (max_queued_segments + 1) * segment_frames frames
+            log_error (Callable[[str], None]): error logger
+        """
+        self.root = path[:-len(".npz")] if path.endswith(".npz") else path
+        if _segmentPaths(self.root):
+            raise FileExistsError(f"Recording segments {self.root}_*.npz already exist, choose another recording path")
+        self.segment_frames = segment_frames
+        self.log_error = log_error
+        self.frames = 0  # frames recorded, including those already written
+        self._segments = 0  # segments handed to the writer thread
+        self._clearFrames()
+        self._queue = queue.Queue(maxsize=max_queued_segments)
+        self._writer = threading.Thread(target=self._write, name="recording_writer", daemon=True)
+        self._writer.start()
+
+    def __len__(self) -> int:
+        return self.frames
+
+    def _clearFrames(self) -> None:
+        self.stamps = []
+        self.ranges = []
+        self.angle_min = []
+        self.angle_increment = []
+        self.odometry = []
+        self.time_steps = []
+        self.goal_angles = []
+
+    def add(self, stamp: float, scan, odometry, goal_angle: float, time_step: float = 0.17) -> None:
+        """Stores one frame, handing the segment to the writer thread when it is full
+
+        Args:
+            stamp (float): scan time [s]
+            scan (LaserScan): Lidar scan, any object with the ScanData fields
+            odometry (tuple): robot [x, y, theta, v, w] when the scan was planned
+            goal_angle (float): goal direction in baselink frame [degrees]
+            time_step (float): planner time step [s]
+        """
+        self.stamps.append(stamp)
+        self.ranges.append(np.asarray(scan.ranges, dtype=np.float32))
+        self.angle_min.append(scan.angle_min)
+        self.angle_increment.append(scan.angle_increment)
+        self.odometry.append(odometry)
+        self.time_steps.append(time_step)
+        self.goal_angles.append(goal_angle)
+        self.frames += 1
+        if len(self.stamps) >= self.segment_frames:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hands the frames stored so far to the writer thread as one segment, nothing is done if there are none"""
+        if not self.stamps:
+            return
+        segment = dict(stamps=np.array(self.stamps), ranges=np.stack(self.ranges),
+                       angle_min=np.array(self.angle_min), angle_increment=np.array(self.angle_increment),
+                       odometry=np.array(self.odometry, dtype=float), time_steps=np.array(self.time_steps),
+                       goal_angles=np.array(self.goal_angles, dtype=float))
+        self._clearFrames()
+        try:
+            self._queue.put_nowait((f"{self.root}_{self._segments:04d}.npz", segment))
+            self._segments += 1
+        except queue.Full:
+            self.log_error(f"Recording writer is behind, {len(segment['stamps'])} frames dropped")
+
+    def close(self) -> None:
+        """Writes the remaining frames and waits for the writer thread to finish"""
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write(self) -> None:
+        # Writer thread: saves the segments in order until close, logging the errors instead of raising them
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, segment = item
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                np.savez_compressed(path, **segment)
+            except Exception:
+                self.log_error(f"Could not save the recording segment {path}:\n{traceback.format_exc()}")
+
+
+def _segmentPaths(root: str) -> List[str]:
+    return sorted(glob.glob(glob.escape(root) + "_[0-9][0-9][0-9][0-9].npz"))
+
+
+def loadRecording(path: str) -> dict:
+    """Loads a recording saved by RecordingWriter, joining its segments, or a single npz file
+
+    Args:
+        path (str): recording path given to RecordingWriter, or npz file path
+
+    Returns:
+        dict: arrays of the recording, indexed by frame
+    """
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    segment_paths = _segmentPaths(path[:-len(".npz")] if path.endswith(".npz") else path)
+    if not segment_paths:
+        raise FileNotFoundError(f"No recording or recording segments found at {path}")
+    segments = []
+    for segment_path in segment_paths:
+        with np.load(segment_path) as data:
+            segments.append({key: data[key] for key in data.files})
+
+    return {key: np.concatenate([segment[key] for segment in segments]) for key in segments[0]}
+
+
+def replayRecording(core, recording: dict) -> ReplayResult:
+    """Feeds every frame of a recording to an AvoidanceCore as fast as possible, restoring the recorded state
+    before each planning cycle and planning with the recorded stamp. A SimClock in the core is also moved to the stamp
+
+    Args:
+        core (AvoidanceCore): planner to replay with. Its state carries over from frame to frame
+        recording (dict): recording from loadRecording
+
+    Returns:
+        ReplayResult: decisions, scenarios, total planning time [s], decisions per second and time per cycle [s]
+    """
+    from avoidance_core import ScanData
+
+    num_frames = len(recording["stamps"])
+    decisions = np.full((num_frames, 4), np.nan)
+    scenarios = []
+    cycle_times = np.zeros(num_frames)
+
+    start = perf_counter()
+    for i in range(num_frames):
+        core.x, core.y, core.theta, core.v, core.w = recording["odometry"][i]
+        core.dt = recording["time_steps"][i]
+        core.goal_angle = recording["goal_angles"][i]
+        scan = ScanData(recording["ranges"][i], recording["angle_min"][i], recording["angle_increment"][i])
+
+        stamp = recording["stamps"][i]
+        if isinstance(core.clock, SimClock):
+            core.clock.set(stamp)
+        cycle_start = perf_counter()
+        decision = core.planAvoidance(scan, stamp)
+        cycle_times[i] = perf_counter() - cycle_start
+        decisions[i, :2] = decision.avoiding, decision.command
+        if decision.avoiding:
+            decisions[i, 2:] = decision.v, decision.w
+        scenarios.append(decision.scenario)
+    elapsed = perf_counter() - start
+
+    return ReplayResult(decisions, scenarios, elapsed, num_frames / elapsed if elapsed > 0 else float('inf'), cycle_times)
+
+
+if __name__ == "__main__":
+    import cases
+    from avoidance_core import AvoidanceCore
+
+    parser = argparse.ArgumentParser(description="Replay a recording through the obstacle avoidance core, without ROS.")
+    parser.add_argument("recording", help="recording path given to the node, or a single npz file")
+    parser.add_argument("--case-base", default="casos.db",
+                        help="case base to start from, it is copied so the replay never changes it")
+    parser.add_argument("--sequential", action="store_true",
+                        help="classify the scenario after DWA instead of concurrently")
+    parser.add_argument("--save-decisions", help="npz file to store the decisions, to compare replays")
+    parser.add_argument("--latency", action="store_true", help="report the computing time of each planning stage")
+    args = parser.parse_args()
+
+    recording = loadRecording(args.recording)
+    with tempfile.TemporaryDirectory() as work_dir:
+        case_base_path = os.path.join(work_dir, "casos.db")
+        if os.path.exists(args.case_base):
+            shutil.copy(args.case_base, case_base_path)
+        core = AvoidanceCore(case_base=cases.CaseDatabase(case_base_path), log_info=lambda message: None,
+                             clock=SimClock())
+        if args.sequential:
+            core.scenario_pool = None
+        core.latency.enabled = args.latency
+        result = replayRecording(core, recording)
+
+    decisions = result.decisions
+    print(f"{len(decisions)} frames in {result.elapsed:.3f} s: {result.decisions_per_second:.1f} decisions per second")
+    print(f"Avoiding in {int(np.sum(decisions[:, 0]))} frames, {int(np.sum(decisions[:, 1]))} commands")
+    print(f"Scenarios: {dict(Counter(result.scenarios))}")
+    if args.latency:
+        print(core.latency.report())
+
+    if args.save_decisions:
+        np.savez_compressed(args.save_decisions, decisions=decisions,
+                            scenarios=np.array([str(scenario) for scenario in result.scenarios]))
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+import numpy as np
+from functools import lru_cache
+from typing import Tuple
+
+
+class RangeMinimumTable:
+    """Sparse table over one Lidar scan that answers the closest reading (and its index) in any beam window in O(1)"""
+
+    def __init__(self, ranges: np.ndarray) -> None:
+        """Builds the table levels for the scan, O(n log n) once per scan
+
+        Args:
+            ranges (np.ndarray): Lidar ranges for this scan [m]
+        """
+        self.ranges = np.asarray(ranges, dtype=float)
+        n = self.ranges.size
+
+        # Level k stores, for each beam i, the index of the minimum reading in [i, i + 2^k)
+        self.levels = [np.arange(n)]
+        k = 1
+        while (1 << k) <= n:
+            previous = self.levels[-1]
+            half = 1 << (k - 1)
+            left = previous[:-half]
+            right = previous[half:]
+            # Keep the left index on ties, so we match np.argmin (first occurrence)
+            self.levels.append(np.where(self.ranges[right] < self.ranges[left], right, left))
+            k += 1
+
+    def __len__(self) -> int:
+        return self.ranges.size
+
+    def query(self, start_index: int, end_index: int) -> Tuple[float, int]:
+        """Closest reading in the beam window [start_index, end_index)
+
+        Args:
+            start_index (int): first beam in the window
+            end_index (int): beam after the last one in the window
+
+        Returns:
+            Tuple[float, int]: minimum range [m] and its beam index, or (inf, start_index) if the window is empty
+        """
+        start_index = max(int(start_index), 0)
+        end_index = min(int(end_index), self.ranges.size)
+        if end_index <= start_index:
+            return float('inf'), start_index
+
+        k = (end_index - start_index).bit_length() - 1
+        left = self.levels[k][start_index]
+        right = self.levels[k][end_index - (1 << k)]
+        index = right if self.ranges[right] < self.ranges[left] else left
+
+        return self.ranges[index], int(index)
+
+    def queryBatch(self, start_indices: np.ndarray, end_indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Closest reading for many beam windows at once, [start, end) each
+
+        Args:
+            start_indices (np.ndarray): first beam of each window
+            end_indices (np.ndarray): beam after the last one of each window
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: minimum ranges [m] and their beam indices (inf and start for empty windows)
+        """
+        n = self.ranges.size
+        start_indices = np.clip(np.asarray(start_indices, dtype=int), 0, n)
+        end_indices = np.clip(np.asarray(end_indices, dtype=int), 0, n)
+        if n == 0:
+            return np.full(start_indices.shape, np.inf), start_indices
+
+        lengths = end_indices - start_indices
+        empty = lengths <= 0
+
+        # Compute floor(log2(length)) per window, empty windows are mapped to a dummy level and masked later
+        k = np.floor(np.log2(np.where(empty, 1, lengths))).astype(int)
+        safe_start = np.where(empty, 0, start_indices)
+        safe_end = np.where(empty, 1, end_indices)
+
+        indices = np.empty(k.shape, dtype=int)
+        for level in np.unique(k):
+            mask = k == level
+            left = self.levels[level][safe_start[mask]]
+            right = self.levels[level][safe_end[mask] - (1 << level)]
+            indices[mask] = np.where(self.ranges[right] < self.ranges[left], right, left)
+
+        values = np.where(empty, np.inf, self.ranges[np.where(empty, 0, indices)])
+        indices = np.where(empty, start_indices, indices)
+
+        return values, indices
+
+
+class ScanGeometry:
+    """Per-beam angles and trigonometric tables for one Lidar configuration, shared by every scan with the same metadata"""
+
+    def __init__(self, angle_min: float, angle_increment: float, num_readings: int) -> None:
+        """Precomputes the beam angles and their cos/sin tables
+
+        Args:
+            angle_min (float): angle of the first beam [RAD]
+            angle_increment (float): angle between two consecutive beams [RAD]
+            num_readings (int): number of beams in the scan
+        """
+        self.angle_min = angle_min
+        self.angle_increment = angle_increment
+        self.num_readings = num_readings
+        self.angles = angle_min + angle_increment * np.arange(num_readings)  # [RAD]
+        self.cos = np.cos(self.angles)
+        self.sin = np.sin(self.angles)
+
+        # Never written after creation, since the instances are shared through the cache
+        for table in (self.angles, self.cos, self.sin):
+            table.setflags(write=False)
+
+    @property
+    def angle_max(self) -> float:
+        """Angle of the last beam [RAD]"""
+        return self.angle_min + self.angle_increment * (self.num_readings - 1)
+
+    def angleToIndex(self, theta):
+        """Converts angles in baselink frame to the closest beam indices, clipped to the scan limits
+
+        Args:
+            theta (float or np.ndarray): angle(s) [RAD]
+
+        Returns:
+            int or np.ndarray: beam index(es)
+        """
+        index = np.rint((np.asarray(theta) - self.angle_min) / self.angle_increment).astype(int)
+        index = np.clip(index, 0, self.num_readings - 1)
+
+        return int(index) if index.ndim == 0 else index
+
+    def indexToAngle(self, index):
+        """Converts beam indices to angles in baselink frame
+
+        Args:
+            index (int or np.ndarray): beam index(es)
+
+        Returns:
+            float or np.ndarray: beam angle(s) [RAD]
+        """
+        return self.angles[index]
+
+    def fovPositions(self, fov: float) -> int:
+        """Number of beams that cover a field of view
+
+        Args:
+            fov (float): field of view width [RAD]
+
+        Returns:
+            int: number of beams
+        """
+        return min(int(round(fov / self.angle_increment)), self.num_readings)
+
+    def toXY(self, ranges: np.ndarray) -> np.ndarray:
+        """Converts a whole scan to points in baselink frame, with one multiply instead of one laserScanToXY per reading
+
+        Args:
+            ranges (np.ndarray): readings for every beam [m]
+
+        Returns:
+            np.ndarray: points in baselink frame, shape (num_readings, 2) as [x, y]
+        """
+        ranges = np.asarray(ranges, dtype=float)
+
+        return np.stack((ranges * self.cos, ranges * self.sin), axis=-1)
+
+
+@lru_cache(maxsize=8)
+def _cachedScanGeometry(angle_min: float, angle_increment: float, num_readings: int) -> ScanGeometry:
+    return ScanGeometry(angle_min, angle_increment, num_readings)
+
+
+def getScanGeometry(angle_min: float, angle_increment: float, num_readings: int) -> ScanGeometry:
+    """Returns the geometry for a Lidar configuration, creating it only the first time this metadata is seen
+
+    Args:
+        angle_min (float): angle of the first beam [RAD], usually LaserScan.angle_min
+        angle_increment (float): angle between beams [RAD], usually LaserScan.angle_increment
+        num_readings (int): number of beams, usually len(LaserScan.ranges)
+
+    Returns:
+        ScanGeometry: cached geometry for this configuration
+    """
+    return _cachedScanGeometry(float(angle_min), float(angle_increment), int(num_readings))
+
+
+def decimateScan(ranges: np.ndarray, geometry: ScanGeometry, num_beams: int) -> Tuple[np.ndarray, ScanGeometry]:
+    """Reduces a scan to at most num_beams readings with min-pooling, so the closest reading of every group is kept
+    and no obstacle is lost. NaN readings are ignored, so a group is only NaN when all its readings are, and inf
+    readings (no return) only win when the group has no finite reading.
+
+    Args:
+        ranges (np.ndarray): readings for every beam of the original scan [m]
+        geometry (ScanGeometry): geometry of the original scan
+        num_beams (int): maximum number of beams after decimation
+
+    Returns:
+        Tuple[np.ndarray, ScanGeometry]: pooled readings and the geometry that describes them
+    """
+    ranges = np.asarray(ranges, dtype=float)
+    num_readings = ranges.size
+    if num_beams <= 0 or num_readings <= num_beams:
+        return ranges, geometry
+
+    # Split the beams in num_beams contiguous groups, with sizes differing by at most one beam
+    group_starts = (np.arange(num_beams) * num_readings) // num_beams
+    pooled_ranges = np.fmin.reduceat(ranges, group_starts)
+
+    # Each pooled beam points to the middle of its group
+    factor = num_readings / num_beams
+    pooled_geometry = getScanGeometry(geometry.angle_min + 0.5 * (factor - 1) * geometry.angle_increment,
+                                      geometry.angle_increment * factor, num_beams)
+
+    return pooled_ranges, pooled_geometry
+
+
+class ScanChangeDetector:
+    """Cheap test to know if a scan window changed since a reference scan, comparing min-pooled digests of the readings"""
+
+    def __init__(self, num_bins: int = 64, threshold: float = 0.1, max_range: float = 20.0, max_skips: int = 10) -> None:
+        """
+        Args:
+            num_bins (int): number of min-pooled bins in the digest
+            threshold (float): largest bin difference still considered the same scene [m]
+            max_range (float): readings are capped at this distance, so long and invalid readings compare equal [m]
+            max_skips (int): consecutive unchanged results before a change is forced, to refresh the reference
+        """
+        self.num_bins = num_bins
+        self.threshold = threshold
+        self.max_range = max_range
+        self.max_skips = max_skips
+        self.reference = None  # digest of the reference scan
+        self.reference_key = None  # identifies the window the reference was taken from
+        self.checks = 0
+        self.skips = 0
+        self.consecutive_skips = 0
+
+    @property
+    def skip_rate(self) -> float:
+        """Fraction of the checks that found no change"""
+        return self.skips / self.checks if self.checks else 0.0
+
+    def digest(self, ranges: np.ndarray) -> np.ndarray:
+        """Min-pooled and capped readings, so no close obstacle is averaged out
+
+        Args:
+            ranges (np.ndarray): readings [m]
+
+        Returns:
+            np.ndarray: digest with at most num_bins values [m]
+        """
+        ranges = np.minimum(np.asarray(ranges, dtype=float), self.max_range)
+        if ranges.size <= self.num_bins:
+            return ranges
+
+        return np.minimum.reduceat(ranges, (np.arange(self.num_bins) * ranges.size) // self.num_bins)
+
+    def hasChanged(self, ranges: np.ndarray, key=None) -> bool:
+        """Compares a scan window with the reference, counting the result for the skip rate
+
+        Args:
+            ranges (np.ndarray): readings of the window [m]
+            key (hashable): identifies the window, a different key than the reference always counts as a change
+
+        Returns:
+            bool: True if the window changed and must be processed again
+        """
+        self.checks += 1
+        digest = self.digest(ranges)
+        if (self.reference is None or key != self.reference_key or digest.shape != self.reference.shape
+                or self.consecutive_skips >= self.max_skips
+                or np.max(np.abs(digest - self.reference), initial=0.0) > self.threshold):
+            self.consecutive_skips = 0
+            return True
+
+        self.skips += 1
+        self.consecutive_skips += 1
+        return False
+
+    def setReference(self, ranges: np.ndarray, key=None) -> None:
+        """Stores the window that was just processed as the reference
+
+        Args:
+            ranges (np.ndarray): readings of the window [m]
+            key (hashable): identifies the window
+        """
+        self.reference = self.digest(ranges)
+        self.reference_key = key
+
+
+class ScanRingBuffer:
+    """Last scans, with their timestamps and odometry poses, in preallocated arrays of fixed capacity"""
+
+    def __init__(self, capacity: int = 5) -> None:
+        """
+        Args:
+            capacity (int): number of scans kept
+        """
+        self.capacity = capacity
+        self.ranges = None  # (capacity, beams), allocated with the first scan
+        self.times = np.zeros(capacity)  # [s]
+        self.poses = np.zeros((capacity, 3))  # [x, y, theta] in odometry frame
+        self.head = 0  # next row to be written
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def push(self, ranges: np.ndarray, stamp: float, pose: Tuple[float, float, float]) -> None:
+        """Stores a scan over the oldest one. The buffer is only reallocated (and emptied) if the beam count changes.
+
+        Args:
+            ranges (np.ndarray): readings [m]
+            stamp (float): scan time [s]
+            pose (Tuple[float, float, float]): robot [x, y, theta] in odometry frame when the scan was taken
+        """
+        if self.ranges is None or self.ranges.shape[1] != np.size(ranges):
+            self.ranges = np.empty((self.capacity, np.size(ranges)))
+            self.head = 0
+            self.count = 0
+
+        self.ranges[self.head] = ranges
+        self.times[self.head] = stamp
+        self.poses[self.head] = pose
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Stored scans from the oldest to the newest
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: ranges (count, beams), times (count,) and poses (count, 3)
+        """
+        rows = (self.head - self.count + np.arange(self.count)) % self.capacity
+
+        return self.ranges[rows], self.times[rows], self.poses[rows]
+
+    def egoCompensatedResiduals(self, geometry: ScanGeometry, free_range: float = 30.0) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-beam difference between the newest scan and each older one, after moving the older readings to the
+        newest robot pose, so static obstacles give residuals close to zero. All scans and beams are handled at once.
+        Directions where the older scan had no return are compared as free up to free_range.
+
+        Args:
+            geometry (ScanGeometry): geometry of the stored scans
+            free_range (float): range used for readings with no return [m]
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: residuals (count - 1, beams) [m], NaN where a beam has no comparable reading,
+            and the age of each older scan in relation to the newest [s]
+        """
+        ranges, times, poses = self.ordered()
+        newest, older = ranges[-1], ranges[:-1]
+        x_n, y_n, theta_n = poses[-1]
+        valid = np.isfinite(older) & (older > 0) & (older < 1e6)
+
+        # Older readings as points in their own baselink frame, then in the newest baselink frame
+        d_theta = poses[:-1, 2] - theta_n
+        c, s = np.cos(theta_n), np.sin(theta_n)
+        d_x = poses[:-1, 0] - x_n
+        d_y = poses[:-1, 1] - y_n
+        t_x = (c * d_x + s * d_y)[:, None]
+        t_y = (-s * d_x + c * d_y)[:, None]
+        beam_angles = geometry.angles[None, :] + d_theta[:, None]
+        r = np.where(valid, older, 0.0)
+        q_x = r * np.cos(beam_angles) + t_x
+        q_y = r * np.sin(beam_angles) + t_y
+
+        # Bin the moved readings in the newest scan beams, keeping the closest one per beam
+        q_angles = np.arctan2(q_y, q_x)
+        half_step = geometry.angle_increment / 2
+        in_fov = valid & (q_angles >= geometry.angle_min - half_step) & (q_angles <= geometry.angle_max + half_step)
+        beams = geometry.angleToIndex(q_angles)
+        flat = (np.arange(older.shape[0])[:, None] * older.shape[1] + beams)[in_fov]
+        predicted = np.full(older.shape, np.inf)
+        np.minimum.at(predicted.reshape(-1), flat, np.hypot(q_x, q_y)[in_fov])
+
+        # Older beams with no return, only rotated to the newest heading, mark free directions that no reading reached
+        no_return = ~valid & ((older == np.inf) | (older >= 1e6))
+        free_beams = geometry.angleToIndex(beam_angles)
+        free = np.zeros(older.shape, dtype=bool)
+        free[np.nonzero(no_return)[0], free_beams[no_return]] = True
+        predicted = np.where(np.isinf(predicted) & free, free_range, predicted)
+
+        # Newest readings with no return are compared as free as well
+        newest = np.where(np.isinf(newest) | (newest >= 1e6), free_range, newest)
+        comparable = np.isfinite(predicted) & (newest > 0)[None, :]
+        residuals = np.where(comparable, newest[None, :] - np.where(comparable, predicted, 0.0), np.nan)
+
+        return residuals, times[-1] - times[:-1]
+
+
+class TimeToCollisionMap:
+    """Time to collision of every beam, from the range rate between consecutive scans and the robot velocity.
+
+    The previous scan is rotated by the heading change, so the range rate of each beam only carries the robot
+    translation and the obstacle motion. The part explained by the robot velocity is removed to get the speed the
+    obstacle itself approaches with, which the planner can combine with any candidate velocity.
+    """
+
+    def __init__(self, speed_deadband: float = 0.3, max_obstacle_speed: float = 5.0, max_dt: float = 0.5) -> None:
+        """
+        Args:
+            speed_deadband (float): obstacle approach speeds below this are range noise and count as static [m/s]
+            max_obstacle_speed (float): faster range rates are jumps between different surfaces and are ignored [m/s]
+            max_dt (float): scans further apart than this are not differentiated [s]
+        """
+        self.speed_deadband = speed_deadband
+        self.max_obstacle_speed = max_obstacle_speed
+        self.max_dt = max_dt
+
+        self.ttc = None  # [s] per beam, inf for beams that are not getting closer
+        self.closing_speed = None  # [m/s] per beam, positive when the range decreases
+        self.approach_speed = None  # [m/s] per beam, closing speed due to the obstacle motion only
+        self._previous = None  # (ranges, geometry, stamp, yaw) of the last scan
+
+    def update(self, ranges: np.ndarray, geometry: ScanGeometry, stamp: float, v: float, yaw: float) -> np.ndarray:
+        """Computes the map for a new scan, all beams at once
+
+        Args:
+            ranges (np.ndarray): readings [m], 0, inf or >= 1e6 for beams with no obstacle
+            geometry (ScanGeometry): geometry of the readings
+            stamp (float): scan time [s]
+            v (float): robot linear velocity [m/s]
+            yaw (float): robot heading in odometry frame [RAD]
+
+        Returns:
+            np.ndarray: time to collision per beam [s]
+        """
+        ranges = np.asarray(ranges, dtype=float)
+        valid = (ranges > 0) & (ranges < 1e6)
+
+        # A static obstacle gets closer with the projection of the robot velocity on the beam
+        ego_closing = v * geometry.cos
+        approach = np.zeros(ranges.shape)
+
+        if self._previous is not None:
+            previous_ranges, previous_geometry, previous_stamp, previous_yaw = self._previous
+            dt = stamp - previous_stamp
+            same_beams = (previous_geometry.num_readings, previous_geometry.angle_min, previous_geometry.angle_increment) \
+                == (geometry.num_readings, geometry.angle_min, geometry.angle_increment)
+            if same_beams and 0 < dt <= self.max_dt:
+                # After turning by d_yaw, the direction of beam i was seen by the previous beam i + shift. The closest
+                # of its neighbours is used, so the rounding of the shift does not show up as motion on the obstacle borders
+                d_yaw = np.angle(np.exp(1j * (yaw - previous_yaw)))
+                shift = int(np.rint(d_yaw / geometry.angle_increment))
+                neighbours = np.minimum(previous_ranges, np.minimum(np.roll(previous_ranges, 1), np.roll(previous_ranges, -1)))
+                source = np.arange(ranges.size) + shift
+                inside = (source >= 0) & (source < ranges.size)
+                aligned = np.full(ranges.shape, np.nan)
+                aligned[inside] = neighbours[source[inside]]
+                comparable = valid & (aligned > 0) & (aligned < 1e6)
+
+                rates = np.where(comparable, (np.where(comparable, aligned, 0.0) - ranges) / dt, 0.0)
+                approach = rates - ego_closing
+                approach[(np.abs(approach) < self.speed_deadband) | (np.abs(approach) > self.max_obstacle_speed)] = 0.0
+                approach[~comparable] = 0.0
+
+        closing = ego_closing + approach
+        getting_closer = valid & (closing > 0)
+        self.ttc = np.full(ranges.shape, np.inf)
+        self.ttc[getting_closer] = ranges[getting_closer] / closing[getting_closer]
+        self.closing_speed = closing
+        self.approach_speed = approach
+        self._previous = (ranges.copy(), geometry, stamp, yaw)
+
+        return self.ttc
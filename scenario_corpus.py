@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+from collections import namedtuple
+from time import perf_counter
+from typing import Tuple
+import numpy as np
+from simulator import ObstacleMap
+
+
+# Scenario classes, in the order of the corpus labels, as named by CBR.FindScenario
+SCENARIOS = ("Isolated obstacle", "Narrow corridor", "Moving obstacle", "Unknown scenario")
+
+# Parameters of a synthetic corpus. The robot starts at the origin heading along x and drives straight at
+# robot_speed, with a scan every dt. Obstacles are placed ahead, up to max_bearing from the heading [RAD], and moving
+# obstacles cross with a speed drawn from obstacle_speed [m/s]. Every range gets gaussian noise with range_noise
+# standard deviation [m], and a dropout fraction of the beams has no return.
+CorpusSpec = namedtuple("CorpusSpec", ["num_beams", "angle_min", "angle_max", "max_range", "frames", "dt",
+                                       "robot_speed", "range_noise", "dropout", "max_bearing", "obstacle_speed",
+                                       "seed"],
+                        defaults=[640, -2.268889904022217, 2.268889904022217, 30.0, 5, 0.1, 1.0, 0.01, 0.0,
+                                  np.radians(25), (0.8, 2.0), 0])
+
+
+def _obstacleAhead(rng: np.random.Generator, spec: CorpusSpec) -> Tuple[float, float, float]:
+    """Random circle [x, y, radius] in front of the robot start"""
+    distance = rng.uniform(2.0, 8.0)
+    bearing = rng.uniform(-spec.max_bearing, spec.max_bearing)
+
+    return distance * np.cos(bearing), distance * np.sin(bearing), rng.uniform(0.3, 1.0)
+
+
+def sampleScene(scenario: int, rng: np.random.Generator, spec: CorpusSpec) -> ObstacleMap:
+    """Random obstacles of one scenario class
+
+    Args:
+        scenario (int): index in SCENARIOS
+        rng (np.random.Generator): random source
+        spec (CorpusSpec): corpus parameters
+
+    Returns:
+        ObstacleMap: obstacles in the robot start frame
+    """
+    if scenario == 0:
+        return ObstacleMap(circles=[_obstacleAhead(rng, spec)])
+
+    if scenario == 1:
+        # Two walls along the path, the robot drives into the passage between them
+        half_width = rng.uniform(1.0, 2.5)
+        start = rng.uniform(1.0, 5.0)
+        end = start + rng.uniform(5.0, 15.0)
+        offset = rng.uniform(-0.5, 0.5)
+        return ObstacleMap(segments=[(start, offset - half_width, end, offset - half_width),
+                                     (start, offset + half_width, end, offset + half_width)])
+
+    if scenario == 2:
+        heading = rng.uniform(-np.pi, np.pi)
+        speed = rng.uniform(*spec.obstacle_speed)
+        return ObstacleMap(circles=[_obstacleAhead(rng, spec)],
+                           circle_velocities=[(speed * np.cos(heading), speed * np.sin(heading))])
+
+    return ObstacleMap(circles=[_obstacleAhead(rng, spec) for _ in range(rng.integers(3, 6))])
+
+
+def generateSample(spec: CorpusSpec, index: int) -> Tuple[int, np.ndarray, np.ndarray]:
+    """One labelled sequence of scans. Samples only depend on the seed and their index, so any part of a corpus can be
+    generated again on its own. The labels cycle through SCENARIOS, so every prefix of a corpus is balanced.
+
+    Args:
+        spec (CorpusSpec): corpus parameters
+        index (int): sample index
+
+    Returns:
+        Tuple[int, np.ndarray, np.ndarray]: scenario label, ranges per frame (frames, num_beams) [m] and robot pose per
+            frame (frames, 3) [m, m, RAD]
+    """
+    rng = np.random.default_rng((spec.seed, index))
+    label = index % len(SCENARIOS)
+    obstacle_map = sampleScene(label, rng, spec)
+
+    angles = np.linspace(spec.angle_min, spec.angle_max, spec.num_beams)
+    ranges = np.empty((spec.frames, spec.num_beams), dtype=np.float32)
+    poses = np.zeros((spec.frames, 3))
+    for frame in range(spec.frames):
+        poses[frame, 0] = spec.robot_speed * spec.dt * frame
+        ranges[frame] = obstacle_map.castRays(poses[frame, :2], angles, spec.max_range)
+        obstacle_map.move(spec.dt)
+
+    if spec.range_noise > 0:
+        ranges += rng.normal(0.0, spec.range_noise, ranges.shape).astype(np.float32)
+    if spec.dropout > 0:
+        ranges[rng.random(ranges.shape) < spec.dropout] = np.inf
+
+    return label, ranges, poses
+
+
+def generateCorpus(path: str, num_samples: int, spec: CorpusSpec = CorpusSpec()) -> None:
+    """Writes a corpus as .npy arrays, filled sample by sample through memory maps, so it never has to fit in memory
+
+    Files in the corpus directory:
+        ranges.npy: float32 (num_samples, frames, num_beams) [m], inf for beams with no return
+        poses.npy: float64 (num_samples, frames, 3) robot [x, y, theta] [m, m, RAD]
+        labels.npy: int8 (num_samples,) index in SCENARIOS
+        corpus.json: the CorpusSpec and the scenario names
+
+    Args:
+        path (str): corpus directory, created if needed
+        num_samples (int): sequences of scans to generate
+        spec (CorpusSpec): corpus parameters
+    """
+    os.makedirs(path, exist_ok=True)
+    ranges = np.lib.format.open_memmap(os.path.join(path, "ranges.npy"), mode="w+", dtype=np.float32,
+                                       shape=(num_samples, spec.frames, spec.num_beams))
+    poses = np.lib.format.open_memmap(os.path.join(path, "poses.npy"), mode="w+", dtype=np.float64,
+                                      shape=(num_samples, spec.frames, 3))
+    labels = np.lib.format.open_memmap(os.path.join(path, "labels.npy"), mode="w+", dtype=np.int8,
+                                       shape=(num_samples,))
+
+    for index in range(num_samples):
+        labels[index], ranges[index], poses[index] = generateSample(spec, index)
+
+    for array in (ranges, poses, labels):
+        array.flush()
+    with open(os.path.join(path, "corpus.json"), "w") as file:
+        json.dump({"spec": spec._asdict(), "scenarios": SCENARIOS}, file, indent=4)
+
+
+def loadCorpus(path: str) -> dict:
+    """Opens a corpus saved by generateCorpus, the arrays are read-only memory maps
+
+    Args:
+        path (str): corpus directory
+
+    Returns:
+        dict: "ranges", "poses" and "labels" arrays, indexed by sample, and the "spec"
+    """
+    with open(os.path.join(path, "corpus.json")) as file:
+        metadata = json.load(file)
+    corpus = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("ranges", "poses", "labels")}
+    corpus["spec"] = CorpusSpec(**metadata["spec"])
+
+    return corpus
+
+
+def evaluateClassifier(corpus: dict, num_samples: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Classifies every sample with CBR.FindScenario, frame by frame like the node, and compares with the labels.
+    Every sample starts from a new CBR, since the classification keeps the scan history.
+
+    Args:
+        corpus (dict): corpus from loadCorpus
+        num_samples (int): samples to classify, the whole corpus by default
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: confusion matrix, with a row per label and a column per classified scenario
+            plus a last column for the samples left unclassified, and the time of every FindScenario call [s]
+    """
+    import cases
+    from cbr import CBR
+    from clock import SimClock
+    from scan_lib import getScanGeometry
+
+    spec = corpus["spec"]
+    num_samples = len(corpus["labels"]) if num_samples is None else min(num_samples, len(corpus["labels"]))
+    geometry = getScanGeometry(spec.angle_min, (spec.angle_max - spec.angle_min) / (spec.num_beams - 1), spec.num_beams)
+    fov = geometry.fovPositions(np.radians(60))
+    center_index = geometry.angleToIndex(0.0)
+    case_base = cases.CaseDatabase(":memory:")
+
+    confusion = np.zeros((len(SCENARIOS), len(SCENARIOS) + 1), dtype=int)
+    call_times = np.zeros(num_samples * spec.frames)
+    for index in range(num_samples):
+        cbr = CBR(case_base=case_base, clock=SimClock())
+        scenario = None
+        for frame in range(spec.frames):
+            valid_ranges = np.array(corpus["ranges"][index, frame], dtype=float)
+            valid_ranges[valid_ranges == 0] = 1e6
+            start = perf_counter()
+            scenario = cbr.FindScenario(valid_ranges, spec.robot_speed, frame * spec.dt, fov_positions=fov,
+                                        center_index=center_index, geometry=geometry,
+                                        pose=corpus["poses"][index, frame])
+            call_times[index * spec.frames + frame] = perf_counter() - start
+        column = SCENARIOS.index(scenario) if scenario in SCENARIOS else len(SCENARIOS)
+        confusion[corpus["labels"][index], column] += 1
+
+    return confusion, call_times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic scan corpora and check the scenario classifier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="write a new corpus")
+    generate_parser.add_argument("path", help="corpus directory")
+    generate_parser.add_argument("--samples", type=int, default=10000, help="sequences of scans")
+    generate_parser.add_argument("--beams", type=int, default=640, help="beams per scan")
+    generate_parser.add_argument("--frames", type=int, default=5, help="scans per sequence")
+    generate_parser.add_argument("--noise", type=float, default=0.01, help="range noise standard deviation [m]")
+    generate_parser.add_argument("--dropout", type=float, default=0.0, help="fraction of beams with no return")
+    generate_parser.add_argument("--obstacle-speed", type=float, nargs=2, default=(0.8, 2.0),
+                                 help="speed range of the moving obstacles [m/s]")
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="classification accuracy and latency on a corpus")
+    evaluate_parser.add_argument("path", help="corpus directory")
+    evaluate_parser.add_argument("--samples", type=int, default=None, help="samples to classify, all by default")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        spec = CorpusSpec(num_beams=args.beams, frames=args.frames, range_noise=args.noise, dropout=args.dropout,
+                          obstacle_speed=tuple(args.obstacle_speed), seed=args.seed)
+        start = perf_counter()
+        generateCorpus(args.path, args.samples, spec)
+        print(f"{args.samples * args.frames} scans in {perf_counter() - start:.1f} s")
+    else:
+        confusion, call_times = evaluateClassifier(loadCorpus(args.path), args.samples)
+        print("Confusion matrix, rows are the labels:")
+        for scenario, row in zip(SCENARIOS, confusion):
+            print(f"    {scenario:<18} {row}  recall {row[SCENARIOS.index(scenario)] / max(row.sum(), 1):.2f}")
+        print(f"Accuracy {np.trace(confusion) / confusion.sum():.3f}")
+        print(f"FindScenario latency: mean {1000 * call_times.mean():.2f} ms, "
+              f"p95 {1000 * np.percentile(call_times, 95):.2f} ms, max {1000 * call_times.max():.2f} ms")
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+import numpy as np
+from collections import namedtuple
+from time import perf_counter
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+from frame_convertions import LocalProjection
+from clock import SimClock
+
+
+# Outcome of a closed loop episode, cycle_times holds the computing time of each planning cycle [s]
+EpisodeResult = namedtuple("EpisodeResult", ["collided", "completed", "time", "min_clearance", "commands", "cycle_times"])
+
+
+class ObstacleMap:
+    """2D obstacles for the simulator: circles, which may move with constant velocity, and static wall segments.
+    All coordinates are in the simulator local frame (x east, y north) [m].
+    """
+
+    def __init__(self, circles: np.ndarray = None, segments: np.ndarray = None, circle_velocities: np.ndarray = None) -> None:
+        """
+        Args:
+            circles (np.ndarray): [x, y, radius] per circle, shape (N, 3)
+            segments (np.ndarray): [x1, y1, x2, y2] per wall, shape (M, 4)
+            circle_velocities (np.ndarray): [vx, vy] per circle, shape (N, 2), static circles by default [m/s]
+        """
+        self.circles = np.zeros((0, 3)) if circles is None else np.array(circles, dtype=float).reshape(-1, 3)
+        self.segments = np.zeros((0, 4)) if segments is None else np.array(segments, dtype=float).reshape(-1, 4)
+        self.circle_velocities = np.zeros((len(self.circles), 2)) if circle_velocities is None else \
+            np.array(circle_velocities, dtype=float).reshape(-1, 2)
+
+    def move(self, dt: float) -> None:
+        self.circles[:, :2] += self.circle_velocities * dt
+
+    def castRays(self, origin: Tuple[float, float], angles: np.ndarray, max_range: float) -> np.ndarray:
+        """Distance to the first obstacle along each ray, all rays and obstacles at once
+
+        Args:
+            origin (Tuple[float, float]): rays origin [m]
+            angles (np.ndarray): ray directions in the local frame [RAD]
+            max_range (float): rays longer than this have no return [m]
+
+        Returns:
+            np.ndarray: range per ray [m], inf for rays with no return
+        """
+        directions = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+        ranges = np.full(len(angles), np.inf)
+
+        if len(self.circles):
+            # |o + t*d - c| = r, with |d| = 1: t = b -+ sqrt(b**2 - |c - o|**2 + r**2)
+            centers = self.circles[:, :2] - np.asarray(origin)
+            b = directions @ centers.T
+            discriminant = b**2 - np.sum(centers**2, axis=1) + self.circles[:, 2]**2
+            hit = discriminant >= 0
+            root = np.sqrt(np.where(hit, discriminant, 0.0))
+            t = np.where(b - root > 0, b - root, b + root)
+            t = np.where(hit & (t >= 0), t, np.inf)
+            ranges = np.minimum(ranges, t.min(axis=1))
+
+        if len(self.segments):
+            # o + t*d = p + u*(q - p), solved with 2D cross products
+            p = self.segments[:, :2] - np.asarray(origin)
+            e = self.segments[:, 2:] - self.segments[:, :2]
+            denominator = directions[:, 0:1] * e[:, 1] - directions[:, 1:2] * e[:, 0]
+            parallel = np.abs(denominator) < 1e-12
+            denominator = np.where(parallel, 1.0, denominator)
+            t = (p[:, 0] * e[:, 1] - p[:, 1] * e[:, 0]) / denominator
+            u = (p[:, 0] * directions[:, 1:2] - p[:, 1] * directions[:, 0:1]) / denominator
+            t = np.where(~parallel & (t >= 0) & (u >= 0) & (u <= 1), t, np.inf)
+            ranges = np.minimum(ranges, t.min(axis=1))
+
+        ranges[ranges > max_range] = np.inf
+
+        return ranges
+
+    def clearance(self, point: Tuple[float, float]) -> float:
+        """Distance from a point to the closest obstacle surface, negative inside a circle [m]"""
+        point = np.asarray(point, dtype=float)
+        distances = [np.inf]
+        if len(self.circles):
+            distances.append(np.min(np.hypot(*(self.circles[:, :2] - point).T) - self.circles[:, 2]))
+        if len(self.segments):
+            p = self.segments[:, :2]
+            e = self.segments[:, 2:] - p
+            u = np.clip(np.sum((point - p) * e, axis=1) / np.maximum(np.sum(e**2, axis=1), 1e-12), 0, 1)
+            distances.append(np.min(np.hypot(*(p + u[:, None] * e - point).T)))
+
+        return min(distances)
+
+
+class KinematicSimulator:
+    """Headless stand-in for the vehicle, mavros and the Lidar, much faster than real time.
+
+    The vehicle is a unicycle with acceleration limits. In GUIDED mode it follows the last velocity setpoint, in AUTO
+    mode it steers to the current mission waypoint, like the autopilot would. The Lidar is ray-cast against an
+    ObstacleMap, and the topics consumed by the node are emulated with objects that have the same fields as the ROS
+    messages. Positions are kept in a local frame (x east, y north) centred at home.
+    """
+
+    def __init__(self, obstacle_map: ObstacleMap, waypoints: np.ndarray, home_lat: float = -22.9, home_lon: float = -43.2,
+                 pose: Tuple[float, float, float] = (0.0, 0.0, 0.0), num_beams: int = 640,
+                 angle_min: float = -2.268889904022217, angle_max: float = 2.268889904022217, max_range: float = 30.0,
+                 range_noise: float = 0.0, max_acc_v: float = 0.9, max_acc_w: float = np.pi/2, cruise_speed: float = 2.0,
+                 waypoint_radius: float = 2.0, robot_radius: float = 0.5, mode_latency: float = 0.0,
+                 command_timeout: float = 3.0, seed: Optional[int] = None, clock: SimClock = None) -> None:
+        """
+        Args:
+            obstacle_map (ObstacleMap): obstacles of the world
+            waypoints (np.ndarray): mission [x, y] in the local frame, shape (K, 2) [m]
+            home_lat (float): home latitude, origin of the local frame
+            home_lon (float): home longitude, origin of the local frame
+            pose (Tuple[float, float, float]): initial [x, y, theta], theta counter-clockwise from east [RAD]
+            num_beams (int): Lidar beams
+            angle_min (float): first beam angle in baselink frame [RAD]
+            angle_max (float): last beam angle in baselink frame [RAD]
+            max_range (float): Lidar range [m]
+            range_noise (float): standard deviation of the range noise [m]
+            max_acc_v (float): linear acceleration limit [m/s^2]
+            max_acc_w (float): angular acceleration limit [RAD/s^2]
+            cruise_speed (float): speed in AUTO mode [m/s]
+            waypoint_radius (float): distance to consider a waypoint reached in AUTO mode [m]
+            robot_radius (float): the vehicle collides when an obstacle is closer than this [m]
+            mode_latency (float): time the autopilot takes to apply a mode change [s]
+            command_timeout (float): the vehicle stops in GUIDED mode if no setpoint arrives for this long [s]
+            seed (Optional[int]): seed of the range noise
+            clock (SimClock): simulation time, advanced by step, so the planner can share it
+        """
+        self.obstacle_map = obstacle_map
+        self.waypoints = np.array(waypoints, dtype=float).reshape(-1, 2)
+        self.projection = LocalProjection(home_lat, home_lon)
+        self.home_lat = home_lat
+        self.home_lon = home_lon
+        self.num_beams = num_beams
+        self.angle_min = angle_min
+        self.angle_max = angle_max
+        self.angle_increment = (angle_max - angle_min) / (num_beams - 1)
+        self.beam_angles = angle_min + self.angle_increment * np.arange(num_beams)
+        self.max_range = max_range
+        self.range_noise = range_noise
+        self.max_acc_v = max_acc_v
+        self.max_acc_w = max_acc_w
+        self.cruise_speed = cruise_speed
+        self.waypoint_radius = waypoint_radius
+        self.robot_radius = robot_radius
+        self.mode_latency = mode_latency
+        self.command_timeout = command_timeout
+        self.rng = np.random.default_rng(seed)
+
+        self.clock = clock if clock is not None else SimClock()
+        self.x, self.y, self.theta = pose
+        self.v = 0.0  # [m/s]
+        self.w = 0.0  # [RAD/s]
+        self.mode = "AUTO"
+        self.pending_mode = None  # (mode, time it is applied)
+        self.command = (0.0, 0.0)  # last GUIDED velocity setpoint
+        self.command_time = -np.inf  # [s]
+        self.current_waypoint_index = 0
+        self.mission_complete = len(self.waypoints) == 0
+        self.collided = False
+        self.min_clearance = np.inf  # [m] closest the vehicle surface got to an obstacle
+
+    @property
+    def time(self) -> float:
+        """Simulation time [s]"""
+        return self.clock.now()
+
+    # region COMMANDS
+    def setMode(self, mode: str) -> bool:
+        """Emulates the set_mode service, the change is applied after the mode latency
+
+        Args:
+            mode (str): mode name, either MANUAL, GUIDED or AUTO
+
+        Returns:
+            bool: True if the request was accepted
+        """
+        if mode not in ("MANUAL", "GUIDED", "AUTO"):
+            return False
+        self.pending_mode = (mode, self.time + self.mode_latency)
+        if self.mode_latency <= 0:
+            self._applyPendingMode()
+
+        return True
+
+    def setVelocity(self, v: float, w: float) -> None:
+        """Velocity setpoint in baselink frame, as sent by sendGuidedPointLocalFrame. Only used in GUIDED mode.
+
+        Args:
+            v (float): linear velocity [m/s]
+            w (float): angular velocity [RAD/s]
+        """
+        self.command = (float(v), float(w))
+        self.command_time = self.time
+
+    def setCurrentWaypoint(self, index: int) -> bool:
+        """Emulates the mission set_current service
+
+        Args:
+            index (int): waypoint index
+
+        Returns:
+            bool: True if the index exists
+        """
+        if not 0 <= index < len(self.waypoints):
+            return False
+        self.current_waypoint_index = index
+        self.mission_complete = False
+
+        return True
+
+    # endregion
+    # region SIMULATION
+    def _applyPendingMode(self) -> None:
+        if self.pending_mode is not None and self.time >= self.pending_mode[1]:
+            self.mode = self.pending_mode[0]
+            self.pending_mode = None
+
+    def _targetVelocities(self) -> Tuple[float, float]:
+        """Velocities the autopilot tries to reach in the current mode"""
+        if self.mode == "GUIDED":
+            if self.time - self.command_time > self.command_timeout:
+                return 0.0, 0.0
+            return self.command
+
+        if self.mode == "AUTO" and not self.mission_complete:
+            # Steer to the current waypoint, advancing the mission when it is reached
+            offset = self.waypoints[self.current_waypoint_index] - (self.x, self.y)
+            if np.hypot(*offset) < self.waypoint_radius:
+                self.current_waypoint_index += 1
+                if self.current_waypoint_index >= len(self.waypoints):
+                    self.mission_complete = True
+                    return 0.0, 0.0
+                offset = self.waypoints[self.current_waypoint_index] - (self.x, self.y)
+            heading_error = np.angle(np.exp(1j * (np.arctan2(offset[1], offset[0]) - self.theta)))
+            # Slow down in sharp turns
+            return self.cruise_speed * max(np.cos(heading_error), 0.1), 2.0 * heading_error
+
+        return 0.0, 0.0
+
+    def step(self, dt: float) -> None:
+        """Advances the simulation, integrating the unicycle exactly for constant velocities during dt
+
+        Args:
+            dt (float): time step [s]
+        """
+        self._applyPendingMode()
+        target_v, target_w = self._targetVelocities()
+        self.v += np.clip(target_v - self.v, -self.max_acc_v * dt, self.max_acc_v * dt)
+        self.w += np.clip(target_w - self.w, -self.max_acc_w * dt, self.max_acc_w * dt)
+
+        if abs(self.w) > 1e-9:
+            new_theta = self.theta + self.w * dt
+            self.x += self.v / self.w * (np.sin(new_theta) - np.sin(self.theta))
+            self.y -= self.v / self.w * (np.cos(new_theta) - np.cos(self.theta))
+            self.theta = np.angle(np.exp(1j * new_theta))
+        else:
+            self.x += self.v * dt * np.cos(self.theta)
+            self.y += self.v * dt * np.sin(self.theta)
+
+        self.obstacle_map.move(dt)
+        self.clock.advance(dt)
+
+        clearance = self.obstacle_map.clearance((self.x, self.y)) - self.robot_radius
+        self.min_clearance = min(self.min_clearance, clearance)
+        self.collided = self.collided or clearance < 0
+
+    def scanRanges(self) -> np.ndarray:
+        """Lidar ranges from the current pose, inf for beams with no return [m]"""
+        ranges = self.obstacle_map.castRays((self.x, self.y), self.theta + self.beam_angles, self.max_range)
+        if self.range_noise > 0:
+            ranges = ranges + self.rng.normal(0.0, self.range_noise, ranges.shape)
+
+        return ranges
+
+    def goalAngle(self) -> Tuple[float, float]:
+        """Distance and direction of the current waypoint in baselink frame, like targetWaypoint
+
+        Returns:
+            Tuple[float, float]: goal distance [m] and angle [degrees]
+        """
+        if self.mission_complete:
+            return 0, 0
+        offset = self.waypoints[self.current_waypoint_index] - (self.x, self.y)
+
+        return np.hypot(*offset), np.degrees(np.angle(np.exp(1j * (np.arctan2(offset[1], offset[0]) - self.theta))))
+
+    # endregion
+    # region EMULATED TOPICS
+    def _header(self) -> SimpleNamespace:
+        stamp = self.time
+        return SimpleNamespace(stamp=SimpleNamespace(to_sec=lambda: stamp, secs=int(stamp), nsecs=int(stamp % 1 * 1e9)))
+
+    def _latLon(self, x, y) -> Tuple[float, float]:
+        return self.projection.toLatLon(self.projection.anchor_east + x, self.projection.anchor_north + y)
+
+    def scanMessage(self) -> SimpleNamespace:
+        """/mavros/lidar LaserScan"""
+        return SimpleNamespace(header=self._header(), angle_min=self.angle_min, angle_max=self.angle_max,
+                               angle_increment=self.angle_increment, range_min=0.0, range_max=self.max_range,
+                               ranges=self.scanRanges().tolist())
+
+    def stateMessage(self) -> SimpleNamespace:
+        """/mavros/state State"""
+        return SimpleNamespace(header=self._header(), connected=True, armed=True, guided=self.mode == "GUIDED",
+                               mode=self.mode)
+
+    def navSatFixMessage(self) -> SimpleNamespace:
+        """/mavros/global_position/global NavSatFix"""
+        latitude, longitude = self._latLon(self.x, self.y)
+        return SimpleNamespace(header=self._header(), latitude=latitude, longitude=longitude, altitude=0.0)
+
+    def compassMessage(self) -> SimpleNamespace:
+        """/mavros/global_position/compass_hdg Float64, 0~360 degrees, 0 to the north, increasing clockwise"""
+        return SimpleNamespace(data=(90.0 - np.degrees(self.theta)) % 360.0)
+
+    def odometryMessage(self) -> SimpleNamespace:
+        """/mavros/local_position/odom Odometry"""
+        position = SimpleNamespace(x=self.x, y=self.y, z=0.0)
+        orientation = SimpleNamespace(x=0.0, y=0.0, z=np.sin(self.theta / 2), w=np.cos(self.theta / 2))
+        linear = SimpleNamespace(x=self.v, y=0.0, z=0.0)
+        angular = SimpleNamespace(x=0.0, y=0.0, z=self.w)
+        return SimpleNamespace(header=self._header(),
+                               pose=SimpleNamespace(pose=SimpleNamespace(position=position, orientation=orientation)),
+                               twist=SimpleNamespace(twist=SimpleNamespace(linear=linear, angular=angular)))
+
+    def homePositionMessage(self) -> SimpleNamespace:
+        """/mavros/home_position/home HomePosition"""
+        return SimpleNamespace(geo=SimpleNamespace(latitude=self.home_lat, longitude=self.home_lon, altitude=0.0))
+
+    def waypointListMessage(self) -> SimpleNamespace:
+        """/mavros/mission/waypoints WaypointList"""
+        waypoints: List[SimpleNamespace] = []
+        for i, (x, y) in enumerate(self.waypoints):
+            latitude, longitude = self._latLon(x, y)
+            waypoints.append(SimpleNamespace(x_lat=latitude, y_long=longitude, z_alt=0.0,
+                                             is_current=i == self.current_waypoint_index))
+        return SimpleNamespace(current_seq=self.current_waypoint_index, waypoints=waypoints)
+
+    def publishTo(self, node) -> None:
+        """Delivers the emulated topics to the callbacks of an ObstacleAvoidance node, or any object with them"""
+        node.stateCallback(self.stateMessage())
+        node.gpsCallback(self.navSatFixMessage())
+        node.compassCallback(self.compassMessage())
+        node.odomCallback(self.odometryMessage())
+        node.laserScanCallback(self.scanMessage())
+
+    # endregion
+
+
+def runEpisode(core, simulator: KinematicSimulator, max_time: float = 120.0, control_period: float = 0.1,
+               physics_steps: int = 2) -> EpisodeResult:
+    """Closed loop avoidance episode between an AvoidanceCore and the simulator, with the node mode logic:
+    GUIDED while avoiding, back to AUTO once the path is free. The core should be built with clock=simulator.clock,
+    so everything reading the time follows the simulation.
+
+    Args:
+        core (AvoidanceCore): planner under test
+        simulator (KinematicSimulator): vehicle and world
+        max_time (float): the episode ends after this simulated time [s]
+        control_period (float): planner period [s]
+        physics_steps (int): simulation steps per planner period
+
+    Returns:
+        EpisodeResult: whether it collided or completed the mission, simulated time [s], minimum clearance [m],
+        velocity commands sent and planning time per cycle [s]
+    """
+    from avoidance_core import ScanData
+
+    commands = 0
+    cycle_times = []
+    while simulator.time < max_time and not simulator.collided and not simulator.mission_complete:
+        core.updateOdometry(simulator.x, simulator.y, simulator.theta, simulator.v, simulator.w, simulator.time)
+        core.goal_angle = simulator.goalAngle()[1]
+        scan = ScanData(simulator.scanRanges(), simulator.angle_min, simulator.angle_increment)
+
+        start = perf_counter()
+        decision = core.planAvoidance(scan, simulator.time)
+        cycle_times.append(perf_counter() - start)
+        if decision.command:
+            simulator.setMode("GUIDED")
+            simulator.setVelocity(decision.v, decision.w)
+            commands += 1
+        elif not decision.avoiding and simulator.mode != "AUTO":
+            simulator.setMode("AUTO")
+
+        for _ in range(physics_steps):
+            simulator.step(control_period / physics_steps)
+
+    return EpisodeResult(simulator.collided, simulator.mission_complete, simulator.time, simulator.min_clearance, commands,
+                         np.array(cycle_times))
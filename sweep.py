@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import numpy as np
+
+
+# Columns of the results table, after the swept parameters
+RESULT_COLUMNS = ["episode", "success", "collided", "min_clearance", "time_to_goal", "cycles",
+                  "latency_mean", "latency_p50", "latency_p95", "latency_max"]
+
+
+def parameterGrid(grid: Dict[str, list]) -> List[dict]:
+    """Every combination of the swept values
+
+    Args:
+        grid (Dict[str, list]): values of each parameter, see applyParameters for the names
+
+    Returns:
+        List[dict]: one parameter set per combination
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def applyParameters(core, parameters: dict) -> None:
+    """Sets parameters of an AvoidanceCore by name.
+
+    Names are attribute paths from the core, like "v_reso", "safety_distance_to_start" or "cbr.tol". Fuzzy membership
+    functions are named "fuzzy.<variable>.<term>", with the skfuzzy function name and its parameters as value,
+    like ["sigmf", 2.0, -6] for "fuzzy.distance_to_obstacle.near".
+
+    Args:
+        core (AvoidanceCore): planner to configure
+        parameters (dict): values by name
+    """
+    import skfuzzy as fuzz
+
+    for name, value in parameters.items():
+        path = name.split(".")
+        if path[0] == "fuzzy" and len(path) == 3:
+            variable = getattr(core.fuzzy, path[1])
+            function, *arguments = value
+            variable[path[2]] = getattr(fuzz, function)(variable.universe, *arguments)
+            continue
+
+        target = core
+        for attribute in path[:-1]:
+            target = getattr(target, attribute)
+        if not hasattr(target, path[-1]):
+            raise AttributeError(f"Unknown parameter {name}")
+        setattr(target, path[-1], value)
+
+
+def randomEpisode(seed: int, length: float = 40.0, num_obstacles: int = 4, width: float = 2.5) -> dict:
+    """Simulated episode with a straight mission through randomly placed round obstacles
+
+    Args:
+        seed (int): seed of the obstacle placement and of the range noise
+        length (float): mission length [m]
+        num_obstacles (int): obstacles along the mission
+        width (float): obstacles are placed up to this lateral distance from the mission line [m]
+
+    Returns:
+        dict: episode description for runSweepJob
+    """
+    rng = np.random.default_rng(seed)
+    circles = np.column_stack((rng.uniform(8.0, length - 5.0, num_obstacles),
+                               rng.uniform(-width, width, num_obstacles),
+                               rng.uniform(0.3, 1.0, num_obstacles)))
+
+    return {"obstacles": {"circles": circles.tolist()}, "waypoints": [[length, 0.0]], "seed": seed,
+            "range_noise": 0.01, "max_time": 3 * length}
+
+
+def runSweepJob(job) -> dict:
+    """Runs one episode with one parameter set, with its own in-memory case base. Runs in a worker process.
+
+    Args:
+        job (tuple): parameters (dict), episode index (int), episode (dict) and the case base file to start from
+            (str or None). Episodes with a "recording" path are replayed, the others are simulated.
+
+    Returns:
+        dict: one row of the results table
+    """
+    import cases
+    from avoidance_core import AvoidanceCore
+    from clock import SimClock
+    from replay import loadRecording, replayRecording
+    from simulator import KinematicSimulator, ObstacleMap, runEpisode
+
+    parameters, index, episode, case_base_path = job
+    case_base = cases.CaseDatabase(":memory:")
+    if case_base_path:
+        case_base.CopyFrom(case_base_path)
+
+    # The planner prints every CBR decision, which would only flood the sweep output
+    with contextlib.redirect_stdout(io.StringIO()):
+        if "recording" in episode:
+            core = AvoidanceCore(case_base=case_base, log_info=lambda message: None, clock=SimClock())
+            # The processes already use every core, so the scenario is classified on the planning thread
+            core.scenario_pool = None
+            applyParameters(core, parameters)
+            replay_result = replayRecording(core, loadRecording(episode["recording"]))
+            success = collided = min_clearance = time_to_goal = np.nan
+            cycle_times = replay_result.cycle_times
+        else:
+            simulator = KinematicSimulator(ObstacleMap(**episode["obstacles"]), episode["waypoints"],
+                                           pose=episode.get("pose", (0.0, 0.0, 0.0)), seed=episode.get("seed"),
+                                           range_noise=episode.get("range_noise", 0.0))
+            core = AvoidanceCore(case_base=case_base, log_info=lambda message: None, clock=simulator.clock)
+            core.scenario_pool = None
+            applyParameters(core, parameters)
+            episode_result = runEpisode(core, simulator, max_time=episode.get("max_time", 120.0))
+            success = float(episode_result.completed and not episode_result.collided)
+            collided = float(episode_result.collided)
+            min_clearance = float(episode_result.min_clearance)
+            time_to_goal = episode_result.time if success else np.nan
+            cycle_times = episode_result.cycle_times
+
+    row = {name: json.dumps(value) if isinstance(value, (list, tuple)) else value for name, value in parameters.items()}
+    row.update(episode=index, success=success, collided=collided, min_clearance=min_clearance,
+               time_to_goal=time_to_goal, cycles=len(cycle_times))
+    if len(cycle_times):
+        row.update(latency_mean=np.mean(cycle_times), latency_p50=np.percentile(cycle_times, 50),
+                   latency_p95=np.percentile(cycle_times, 95), latency_max=np.max(cycle_times))
+    else:
+        row.update(latency_mean=np.nan, latency_p50=np.nan, latency_p95=np.nan, latency_max=np.nan)
+
+    return row
+
+
+def runSweep(parameter_sets: List[dict], episodes: List[dict], case_base_path: Optional[str] = None,
+             workers: Optional[int] = None) -> List[dict]:
+    """Runs every episode with every parameter set, spread over a process pool
+
+    Args:
+        parameter_sets (List[dict]): parameter sets, like the ones from parameterGrid
+        episodes (List[dict]): episode descriptions, like the ones from randomEpisode
+        case_base_path (Optional[str]): case base each episode starts from, empty if None
+        workers (Optional[int]): worker processes, all the CPUs by default
+
+    Returns:
+        List[dict]: results table, one row per parameter set and episode
+    """
+    jobs = [(parameters, index, episode, case_base_path)
+            for parameters in parameter_sets for index, episode in enumerate(episodes)]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return list(executor.map(runSweepJob, jobs))
+
+
+def writeResults(rows: List[dict], path: str) -> None:
+    """Writes the results table as CSV
+
+    Args:
+        rows (List[dict]): results table from runSweep
+        path (str): CSV file path
+    """
+    columns = [name for name in rows[0] if name not in RESULT_COLUMNS] + RESULT_COLUMNS
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep planner parameters over simulated or replayed episodes.")
+    parser.add_argument("config", help='JSON file with "parameters" (values per name), and optionally "episodes" '
+                                       'and "case_base"')
+    parser.add_argument("--episodes", type=int, default=20, help="random episodes when the config has none")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, all the CPUs by default")
+    parser.add_argument("--output", default="sweep_results.csv", help="CSV file for the results table")
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        config = json.load(file)
+    parameter_sets = parameterGrid(config.get("parameters", {}))
+    episodes = config.get("episodes") or [randomEpisode(seed) for seed in range(args.episodes)]
+
+    rows = runSweep(parameter_sets, episodes, config.get("case_base"), args.workers)
+    writeResults(rows, args.output)
+
+    # Summary per parameter set
+    names = list(config.get("parameters", {}))
+    # Parameter sets that never reached the goal have no time to goal, NaN is printed for them
+    warnings.simplefilter("ignore", RuntimeWarning)
+    for key, group in itertools.groupby(rows, key=lambda row: tuple(str(row[name]) for name in names)):
+        group = list(group)
+        print(", ".join(f"{name}={value}" for name, value in zip(names, key)) or "defaults")
+        print(f"    success {np.nanmean([row['success'] for row in group]):.2f}, "
+              f"min clearance {np.nanmin([row['min_clearance'] for row in group]):.2f} m, "
+              f"time to goal {np.nanmean([row['time_to_goal'] for row in group]):.1f} s, "
+              f"latency p95 {1000*np.nanmax([row['latency_p95'] for row in group]):.1f} ms")